@@ -1,7 +1,10 @@
 from django.urls import path
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
 from django.contrib import messages
 from django.urls import reverse
+from django.utils.functional import cached_property
 from django.utils.http import urlencode
 from django.views.generic import FormView
 from django.template.response import TemplateResponse
@@ -9,6 +12,8 @@ from django import forms
 
 import json
 
+from django_sloop.dispatch import PRIORITY_BULK
+from django_sloop.dryrun import DryRunReport
 from django_sloop.models import PushMessage
 
 
@@ -17,6 +22,7 @@ class PushNotificationForm(forms.Form):
     message = forms.CharField(max_length=255, label='Message:')
     extra = forms.CharField(max_length=255, widget=forms.Textarea, required=False, initial=json.dumps(dict()), label='Extra data as JSON:')
     url = forms.CharField(max_length=255, required=False, label='URL:')
+    dry_run = forms.BooleanField(required=False, label='Dry run, only count the receivers:')
     receivers = forms.CharField(widget=forms.HiddenInput)
 
     def clean(self):
@@ -42,9 +48,14 @@ class PushNotificationView(FormView):
         self.receivers = form.cleaned_data['receivers']
         model_admin = self.kwargs.get('model_admin')
         receiver_ids = model_admin.get_receivers_queryset(self.receivers)
+        self.report = DryRunReport() if form.cleaned_data['dry_run'] else None
         for receiver_id in receiver_ids:
             user = model_admin.model.objects.get(pk=receiver_id)
-            user.send_push_notification_async(form.cleaned_data['message'], extra=form.cleaned_data['extra'])
+            result = user.send_push_notification_async(
+                form.cleaned_data['message'], extra=form.cleaned_data['extra'], priority_class=PRIORITY_BULK, dry_run=self.report is not None
+            )
+            if self.report is not None and result:
+                self.report.update(result)
 
         return super(PushNotificationView, self).form_valid(form)
 
@@ -55,7 +66,10 @@ class PushNotificationView(FormView):
         return initial
 
     def get_success_url(self):
-        messages.info(self.request, "Push notification has been sent.")
+        if self.report is not None:
+            messages.info(self.request, "Dry run: push notification would be sent to %s." % self.report)
+        else:
+            messages.info(self.request, "Push notification has been sent.")
         model_admin = self.kwargs.get('model_admin')
         url = reverse('admin:%s_%s_send_push_notification' % (model_admin.model._meta.app_label, model_admin.model._meta.model_name))
         url += "?" + urlencode({
@@ -121,13 +135,41 @@ class SloopAdminMixin(object):
         return TemplateResponse(request, 'django_sloop/push_notification.html', context=context)
 
 
+class EstimatedCountPaginator(Paginator):
+    """
+    Counts unfiltered changelists of large tables from the planner statistics on PostgreSQL instead of a COUNT(*).
+    Filtered and small changelists are counted exactly.
+    """
+
+    min_estimated_count = 100000
+
+    @cached_property
+    def count(self):
+        query = self.object_list.query
+        connection = connections[self.object_list.db]
+        if not query.where and connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass", [self.object_list.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] >= self.min_estimated_count:
+                return int(row[0])
+        return super().count
+
+
 class PushMessageAdmin(admin.ModelAdmin):
 
-    search_fields = ["body", "sns_message_id"]
+    search_fields = ["=sns_message_id"]
     list_display = ["id", "body", "error_message", "device", "sns_message_id", "date_created", "date_updated"]
+    list_select_related = ["device", "device__user"]
     readonly_fields = ["id", "device",  "body",  "data", "sns_message_id", "sns_response", "date_created", "date_updated"]
+    date_hierarchy = "date_created"
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     def error_message(self, obj):
+        # Successful responses have no error, skip parsing them.
+        if '"Error"' not in obj.sns_response:
+            return None
         error = json.loads(obj.sns_response).get("Error")
         if error:
             return error.get("Message")
@@ -1,6 +1,21 @@
 from django.apps import AppConfig
+from django.core import checks
+from django.db.models.signals import post_delete, post_save
 
 
 class DjangoSloopConfig(AppConfig):
     name = "django_sloop"
     verbose_name = "Sloop"
+
+    def ready(self):
+        from .checks import check_coalesce_cache
+        from .signals import invalidate_active_device, mark_recent_device_write, queue_segment_update
+        from .utils import get_device_model
+
+        device_model = get_device_model()
+        post_save.connect(invalidate_active_device, sender=device_model, dispatch_uid="sloop_invalidate_active_device")
+        post_delete.connect(invalidate_active_device, sender=device_model, dispatch_uid="sloop_invalidate_active_device")
+        post_save.connect(mark_recent_device_write, sender=device_model, dispatch_uid="sloop_mark_recent_device_write")
+        post_save.connect(queue_segment_update, sender=device_model, dispatch_uid="sloop_queue_segment_update")
+        post_delete.connect(queue_segment_update, sender=device_model, dispatch_uid="sloop_queue_segment_update")
+        checks.register(check_coalesce_cache)
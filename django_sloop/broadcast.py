@@ -0,0 +1,180 @@
+import json
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.db import connections
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .cache import get_cache
+from .dispatch import create_campaign, get_campaign_payload
+from .routing import bind_to_primary, using_read_database
+from .settings import DJANGO_SLOOP_SETTINGS
+from .utils import RateLimiter, get_device_model, iter_pk_ranges
+
+logger = logging.getLogger(__name__)
+
+
+def get_broadcast_sent_cache_key(broadcast_id, device_id):
+    return "sloop:broadcast-sent:%s:%s" % (broadcast_id, device_id)
+
+
+def get_broadcast_devices(broadcast):
+    device_model = get_device_model()
+    return using_read_database(device_model._default_manager.filter(deleted_at__isnull=True, **json.loads(broadcast.filters or "{}")))
+
+
+def create_broadcast(message, url=None, sound=None, extra=None, category=None, filters=None, range_size=10000, **kwargs):
+    """
+    Stores the broadcast with its campaign and splits the matching devices into primary key ranges.
+    Devices created after this are not part of the broadcast.
+    """
+    from .models import Broadcast, BroadcastRange
+
+    sound = sound or DJANGO_SLOOP_SETTINGS.get("DEFAULT_SOUND") or None
+    campaign = create_campaign({"": message}, url, sound, extra, category, kwargs)
+    broadcast = Broadcast.objects.create(campaign=campaign, filters=json.dumps(filters or {}))
+    BroadcastRange.objects.bulk_create([
+        BroadcastRange(broadcast=broadcast, lower_pk=lower, upper_pk=upper)
+        for lower, upper in iter_pk_ranges(get_broadcast_devices(broadcast), range_size)
+    ])
+    return broadcast
+
+
+def get_broadcast_progress(broadcast):
+    """
+    Returns the total of the sent and failed counters and the number of completed and all ranges.
+    """
+    ranges = broadcast.ranges.all()
+    progress = ranges.aggregate(sent=Sum("sent"), failed=Sum("failed"))
+    return {
+        "sent": progress["sent"] or 0,
+        "failed": progress["failed"] or 0,
+        "completed_ranges": ranges.filter(date_completed__isnull=False).count(),
+        "ranges": ranges.count(),
+    }
+
+
+def init_broadcast_process():
+    """
+    Runs in every forked process, which must not share the SNS clients of the parent.
+    The parent closes its database connections before forking, see run_broadcast().
+    """
+    from .handlers import reset_shard_clients
+
+    reset_shard_clients()
+
+
+def run_broadcast(broadcast, processes, report, report_interval=5, **options):
+    """
+    Sends the incomplete ranges of the broadcast from a pool of `processes` forked processes, or from this process
+    if it is 1. report(progress) is called with get_broadcast_progress() every report_interval seconds.
+    """
+    from .models import BroadcastRange
+
+    range_ids = list(BroadcastRange.objects.filter(broadcast=broadcast, date_completed__isnull=True).order_by("lower_pk").values_list("pk", flat=True))
+    if processes <= 1:
+        for range_id in range_ids:
+            send_broadcast_range(range_id, **options)
+            report(get_broadcast_progress(broadcast))
+    else:
+        connections.close_all()
+        with multiprocessing.get_context("fork").Pool(processes, initializer=init_broadcast_process) as pool:
+            result = pool.map_async(partial(send_broadcast_range, **options), range_ids, chunksize=1)
+            while not result.ready():
+                result.wait(report_interval)
+                report(get_broadcast_progress(broadcast))
+            result.get()
+
+    broadcast.date_completed = timezone.now()
+    broadcast.save(update_fields=["date_completed"])
+
+
+def send_broadcast_range(range_id, batch_size=500, concurrency=10, rate=None):
+    """
+    Sends the broadcast to the devices of the range after its checkpoint, saving the checkpoint after every batch.
+
+    Every device is marked as sent in the cache for IDEMPOTENCY_KEY_TTL seconds after its publish succeeds, so on
+    resume the devices of the batch that was in flight when a process died are skipped if they were sent. A device
+    whose publish was interrupted is sent again, delivery is at least once. The marks must outlive the process,
+    so CACHE_ALIAS has to be a shared cache, such as Redis or Memcached.
+    """
+    from .models import BroadcastRange
+
+    broadcast_range = BroadcastRange.objects.select_related("broadcast").get(pk=range_id)
+    if broadcast_range.date_completed:
+        return 0
+    rate_limiter = RateLimiter(rate)
+
+    broadcast = broadcast_range.broadcast
+    payload = get_campaign_payload(broadcast.campaign_id)
+
+    def send(device):
+        device.send_push_notification(
+            payload["messages"][""], payload["url"], None, payload["sound"], dict(payload["extra"]) if payload["extra"] else None,
+            payload["category"], **payload["kwargs"]
+        )
+        get_cache().set(get_broadcast_sent_cache_key(broadcast.pk, device.pk), True, DJANGO_SLOOP_SETTINGS["IDEMPOTENCY_KEY_TTL"])
+
+    devices = get_broadcast_devices(broadcast).filter(pk__lt=broadcast_range.upper_pk).order_by("pk")
+    last_pk = broadcast_range.last_pk
+    total = 0
+    while True:
+        if last_pk is None:
+            batch = list(devices.filter(pk__gte=broadcast_range.lower_pk)[:batch_size])
+        else:
+            batch = list(devices.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+        for device in batch:
+            bind_to_primary(device)
+
+        # Devices sent before the process died count as sent, but are not sent again.
+        sent_keys = get_cache().get_many([get_broadcast_sent_cache_key(broadcast.pk, device.pk) for device in batch])
+        unsent = [device for device in batch if get_broadcast_sent_cache_key(broadcast.pk, device.pk) not in sent_keys]
+
+        sent, failed = len(batch) - len(unsent), 0
+        for device, exc in send_concurrently(send, unsent, concurrency, rate_limiter):
+            if exc is None:
+                sent += 1
+            else:
+                failed += 1
+                logger.error("Could not send broadcast %s to device %s: %s", broadcast.pk, device.pk, exc)
+
+        last_pk = batch[-1].pk
+        BroadcastRange.objects.filter(pk=range_id).update(last_pk=last_pk, sent=F("sent") + sent, failed=F("failed") + failed)
+        total += sent
+
+    BroadcastRange.objects.filter(pk=range_id).update(date_completed=timezone.now())
+    return total
+
+
+def send_concurrently(send, devices, concurrency, rate_limiter):
+    """
+    Calls send(device) from `concurrency` threads and returns (device, exception) tuples.
+    Each thread takes a slice of the devices and closes its database connection when it is done.
+    """
+    def send_slice(devices, close_connections=True):
+        results = []
+        try:
+            for device in devices:
+                rate_limiter.wait()
+                try:
+                    send(device)
+                except Exception as exc:
+                    results.append((device, exc))
+                else:
+                    results.append((device, None))
+        finally:
+            if close_connections:
+                connections.close_all()
+        return results
+
+    if concurrency <= 1:
+        return send_slice(devices, close_connections=False)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        slices = executor.map(send_slice, [devices[index::concurrency] for index in range(concurrency)])
+        return [result for results in slices for result in results]
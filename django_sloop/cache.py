@@ -0,0 +1,46 @@
+from django.core.cache import caches
+from django.db import router, transaction
+
+from .settings import DJANGO_SLOOP_SETTINGS
+
+
+ACTIVE_DEVICE_FIELDS = ("id", "user_id", "platform", "sns_platform_endpoint_arn")
+
+
+def get_cache():
+    return caches[DJANGO_SLOOP_SETTINGS["CACHE_ALIAS"]]
+
+
+def get_active_device_cache_key(user_id):
+    return "sloop:active-device:%s" % user_id
+
+
+def dump_active_device(device):
+    """
+    Returns the cache value of the active device of a user, an empty dict if the user has none.
+    """
+    return {field: getattr(device, field) for field in ACTIVE_DEVICE_FIELDS} if device else {}
+
+
+def load_active_device(data):
+    """
+    Rebuilds the device cached by dump_active_device() with only ACTIVE_DEVICE_FIELDS loaded, or returns None.
+    """
+    from .utils import get_device_model
+
+    if not data:
+        return None
+    device_model = get_device_model()
+    return device_model.from_db(router.db_for_write(device_model), ACTIVE_DEVICE_FIELDS, [data[field] for field in ACTIVE_DEVICE_FIELDS])
+
+
+def invalidate_active_devices(user_ids):
+    """
+    Drops the cached active devices of the given users, right away and again when the transaction commits,
+    since a lookup by another process before the commit caches the old rows.
+    """
+    if not DJANGO_SLOOP_SETTINGS["ACTIVE_DEVICE_CACHE_TIMEOUT"]:
+        return
+    cache_keys = [get_active_device_cache_key(user_id) for user_id in set(user_ids)]
+    get_cache().delete_many(cache_keys)
+    transaction.on_commit(lambda: get_cache().delete_many(cache_keys))
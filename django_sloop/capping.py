@@ -0,0 +1,121 @@
+import datetime
+import time
+
+from .cache import get_cache
+from .settings import DJANGO_SLOOP_SETTINGS
+
+
+FREQUENCY_CAP_DROP = "drop"
+FREQUENCY_CAP_DEFER = "defer"
+
+
+def get_frequency_cap(category=None, priority_class=None):
+    """
+    Returns the (name, (limit, period)) of the cap for the category, or else for the priority class,
+    or else the "default" cap. Returns (None, None) if no cap applies.
+    """
+    caps = DJANGO_SLOOP_SETTINGS["FREQUENCY_CAPS"]
+    for name in (category, priority_class, "default"):
+        if name and name in caps:
+            return name, caps[name]
+    return None, None
+
+
+def apply_frequency_cap(user_ids, category=None, priority_class=None, now=None):
+    """
+    Counts a notification for each user under the cap and returns (allowed_user_ids, retry_at).
+    retry_at is when all the capped users may receive notifications again, if nothing else is counted for them.
+
+    Uses a sliding window counter: the count of the previous fixed window is weighted by how much of it
+    still overlaps the sliding window, which takes two cache keys per user. The current window is incremented
+    before it is compared and decremented again for capped users, so concurrent sends cannot all pass the check.
+    """
+    name, cap = get_frequency_cap(category, priority_class)
+    if cap is None:
+        return list(user_ids), None
+
+    limit, period = cap
+    now = now or time.time()
+    window = int(now // period)
+    previous_weight = 1 - (now % period) / period
+
+    cache = get_cache()
+    keys = {}
+    for user_id in user_ids:
+        keys[user_id] = (
+            "sloop:frequency-cap:%s:%s:%d" % (name, user_id, window),
+            "sloop:frequency-cap:%s:%s:%d" % (name, user_id, window - 1),
+        )
+    previous_counts = cache.get_many([previous_key for _, previous_key in keys.values()])
+
+    allowed_user_ids = []
+    retry_at = None
+    for user_id, (current_key, previous_key) in keys.items():
+        if cache.add(current_key, 1, period * 2):
+            current = 0
+        else:
+            current = cache.incr(current_key) - 1
+        previous = previous_counts.get(previous_key, 0)
+        if previous * previous_weight + current >= limit:
+            cache.decr(current_key)
+            if current < limit:
+                # Later in this window, once less of the previous window overlaps.
+                user_retry_at = (window + 1 - (limit - current) / previous) * period
+            else:
+                user_retry_at = (window + 2 - limit / current) * period
+            retry_at = max(retry_at or 0, user_retry_at)
+            continue
+        allowed_user_ids.append(user_id)
+
+    if retry_at is None:
+        retry_at = (window + 1) * period
+    return allowed_user_ids, datetime.datetime.fromtimestamp(retry_at, tz=datetime.timezone.utc)
+
+
+def defer_notification(notification, user_id, category=None):
+    """
+    Marks a deferred or scheduled notification, so it is counted against its cap when it is released.
+    """
+    notification["frequency_cap"] = {"user_id": user_id, "category": category}
+    return notification
+
+
+def reapply_frequency_caps(notifications, now=None):
+    """
+    Counts the deferred notifications against their caps again and returns (allowed_notifications, capped), where
+    capped is a list of (notification, retry_at) pairs. A user with several deferred notifications gets at most
+    as many of them as the cap allows, the rest stay deferred. Other notifications are allowed as they are.
+    """
+    allowed_notifications, capped, deferred = [], [], {}
+    for notification in notifications:
+        if notification.get("frequency_cap"):
+            deferred.setdefault((notification["frequency_cap"]["category"], notification.get("priority_class")), []).append(notification)
+        else:
+            allowed_notifications.append(notification)
+
+    for (category, priority_class), pending in deferred.items():
+        while pending:
+            # Each round counts one notification per user.
+            first, rest = {}, []
+            for notification in pending:
+                user_id = notification["frequency_cap"]["user_id"]
+                if user_id in first:
+                    rest.append(notification)
+                else:
+                    first[user_id] = notification
+
+            allowed_user_ids, retry_at = apply_frequency_cap(list(first), category=category, priority_class=priority_class, now=now)
+            allowed_user_ids = set(allowed_user_ids)
+            for user_id, notification in first.items():
+                if user_id in allowed_user_ids:
+                    allowed_notifications.append(notification)
+                else:
+                    capped.append((notification, retry_at))
+            pending = []
+            for notification in rest:
+                if notification["frequency_cap"]["user_id"] in allowed_user_ids:
+                    pending.append(notification)
+                else:
+                    capped.append((notification, retry_at))
+
+    return allowed_notifications, capped
@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.core.checks import Warning
+
+from .settings import DJANGO_SLOOP_SETTINGS
+
+
+PROCESS_LOCAL_CACHE_BACKENDS = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+def is_process_local_cache():
+    """
+    Returns whether the CACHE_ALIAS cache is private to each process.
+    """
+    return settings.CACHES.get(DJANGO_SLOOP_SETTINGS["CACHE_ALIAS"], {}).get("BACKEND") in PROCESS_LOCAL_CACHE_BACKENDS
+
+
+def check_coalesce_cache(app_configs, **kwargs):
+    """
+    Coalesced notifications are buffered in the cache by the web process and sent by a Celery worker,
+    so a cache that is not shared between processes loses all of them.
+    """
+    if not DJANGO_SLOOP_SETTINGS["COALESCE_WINDOW"] or not is_process_local_cache():
+        return []
+    return [
+        Warning(
+            "COALESCE_WINDOW is set, but the %r cache is not shared between processes." % DJANGO_SLOOP_SETTINGS["CACHE_ALIAS"],
+            hint="Coalesced notifications are flushed by Celery workers. Point CACHE_ALIAS at a Redis or Memcached cache.",
+            id="django_sloop.W001",
+        )
+    ]
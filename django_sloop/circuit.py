@@ -0,0 +1,121 @@
+import time
+
+from .cache import get_cache
+from .settings import DJANGO_SLOOP_SETTINGS
+
+
+# Error codes of SNS that mean the service, not the request, is failing.
+SERVICE_ERROR_CODES = ("InternalError", "InternalFailure", "ServiceUnavailable", "Throttling", "ThrottlingException", "RequestTimeout")
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling SNS while the circuit of the shard is open.
+    """
+    pass
+
+
+def is_service_failure(exc):
+    """
+    Returns True for errors that count against the circuit: connection errors, timeouts, throttling and 5xx responses.
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    if isinstance(exc, ClientError):
+        error = exc.response.get("Error", {})
+        status = exc.response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+        return error.get("Code") in SERVICE_ERROR_CODES or status >= 500
+    return isinstance(exc, BotoCoreError)
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the error rate of the SNS calls of a shard in the cache, so all workers share the state of the circuit.
+
+    The circuit opens when at least CIRCUIT_BREAKER_MIN_CALLS calls were made in the last CIRCUIT_BREAKER_WINDOW
+    seconds and CIRCUIT_BREAKER_ERROR_RATE of them failed. After CIRCUIT_BREAKER_COOLDOWN seconds a single
+    trial call is let through; the circuit closes if it succeeds and stays open for another cooldown if not.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    @property
+    def enabled(self):
+        return DJANGO_SLOOP_SETTINGS["CIRCUIT_BREAKER_ERROR_RATE"] is not None
+
+    def get_cache_key(self, suffix):
+        return "sloop:circuit:%s:%s" % (self.name, suffix)
+
+    def is_open(self):
+        return self.enabled and get_cache().get(self.get_cache_key("opened")) is not None
+
+    def allow_request(self, now=None):
+        if not self.enabled:
+            return True
+
+        cache = get_cache()
+        opened_at = cache.get(self.get_cache_key("opened"))
+        if opened_at is None:
+            return True
+
+        cooldown = DJANGO_SLOOP_SETTINGS["CIRCUIT_BREAKER_COOLDOWN"]
+        if (now or time.time()) - opened_at < cooldown:
+            return False
+        return cache.add(self.get_cache_key("trial"), True, cooldown)
+
+    def record_success(self, now=None):
+        """
+        Returns True if the call closed the circuit.
+        """
+        if not self.enabled:
+            return False
+
+        self.count_calls(failed=False, now=now)
+        cache = get_cache()
+        if cache.get(self.get_cache_key("opened")) is None:
+            return False
+        cache.delete_many([self.get_cache_key("opened"), self.get_cache_key("trial")])
+        return True
+
+    def record_failure(self, now=None):
+        """
+        Returns True if the call opened the circuit.
+        """
+        if not self.enabled:
+            return False
+
+        now = now or time.time()
+        calls, failures = self.count_calls(failed=True, now=now)
+        cache = get_cache()
+        if cache.get(self.get_cache_key("opened")) is not None:
+            # The trial call failed, wait for another cooldown.
+            cache.set(self.get_cache_key("opened"), now, None)
+            cache.delete(self.get_cache_key("trial"))
+            return False
+
+        if calls < DJANGO_SLOOP_SETTINGS["CIRCUIT_BREAKER_MIN_CALLS"] or failures < calls * DJANGO_SLOOP_SETTINGS["CIRCUIT_BREAKER_ERROR_RATE"]:
+            return False
+        return cache.add(self.get_cache_key("opened"), now, None)
+
+    def count_calls(self, failed, now=None):
+        """
+        Counts the call and returns the (calls, failures) of the sliding window,
+        weighting the previous fixed window like capping.apply_frequency_cap().
+        """
+        period = DJANGO_SLOOP_SETTINGS["CIRCUIT_BREAKER_WINDOW"]
+        now = now or time.time()
+        window = int(now // period)
+        previous_weight = 1 - (now % period) / period
+
+        cache = get_cache()
+        names = ("calls", "failures") if failed else ("calls",)
+        for name in names:
+            key = self.get_cache_key("%s:%d" % (name, window))
+            if not cache.add(key, 1, period * 2):
+                cache.incr(key)
+
+        keys = [self.get_cache_key("%s:%d" % (name, window - offset)) for name in ("calls", "failures") for offset in (0, 1)]
+        counts = cache.get_many(keys)
+        current_calls, previous_calls, current_failures, previous_failures = (counts.get(key, 0) for key in keys)
+        return current_calls + previous_calls * previous_weight, current_failures + previous_failures * previous_weight
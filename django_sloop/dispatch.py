@@ -0,0 +1,514 @@
+import datetime
+import json
+import logging
+from functools import lru_cache
+
+from django.db import transaction
+from django.utils import timezone
+
+from .cache import get_cache
+from .exceptions import DeviceIsNotActive
+from .settings import DJANGO_SLOOP_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+PUSH_NOTIFICATION = "push"
+SILENT_PUSH_NOTIFICATION = "silent"
+# A scheduled batch of a campaign, see schedule_campaign_batch().
+CAMPAIGN_BATCH = "campaign_batch"
+
+# Priority classes, each routed to its own queue by the QUEUES setting.
+PRIORITY_TRANSACTIONAL = "transactional"
+PRIORITY_SILENT = "silent"
+PRIORITY_BULK = "bulk"
+
+PRIORITY_CLASSES = (PRIORITY_TRANSACTIONAL, PRIORITY_SILENT, PRIORITY_BULK)
+
+OUTBOX_RELAY_LOCK_KEY = "sloop:outbox-relay"
+SPOOL_DRAIN_LOCK_KEY = "sloop:spool-drain"
+
+
+def build_notification(kind, device_id, args, kwargs, priority_class=None):
+    """
+    Returns the JSON serializable form of a notification that is passed between the outbox and the tasks.
+    """
+    if priority_class is None:
+        priority_class = PRIORITY_TRANSACTIONAL if kind == PUSH_NOTIFICATION else PRIORITY_SILENT
+    assert priority_class in PRIORITY_CLASSES, "Unknown priority class: %s" % priority_class
+
+    return {
+        "kind": kind,
+        "device_id": device_id,
+        "args": list(args),
+        "kwargs": kwargs,
+        "priority_class": priority_class,
+    }
+
+
+def get_routing_options(priority_class):
+    """
+    Returns the apply_async() options routing a task of the priority class to its queue.
+    """
+    queue = DJANGO_SLOOP_SETTINGS["QUEUES"].get(priority_class)
+    if queue:
+        return {"queue": queue}
+    return {}
+
+
+def enqueue_notification(notification):
+    """
+    Hands the notification over to Celery, or to the outbox when OUTBOX_ENABLED is set.
+    """
+    from . import tasks
+
+    if DJANGO_SLOOP_SETTINGS["OUTBOX_ENABLED"]:
+        from .models import PushOutbox
+
+        PushOutbox.objects.create(notification=json.dumps(notification))
+        transaction.on_commit(schedule_outbox_relay)
+        return
+
+    if notification["kind"] == PUSH_NOTIFICATION:
+        task = tasks.send_push_notification
+    else:
+        task = tasks.send_silent_push_notification
+    task.apply_async(
+        [notification["device_id"]] + notification["args"],
+        notification["kwargs"],
+        **get_routing_options(notification.get("priority_class"))
+    )
+
+
+def enqueue_notification_batches(notifications, batch_size, spread=0):
+    """
+    Hands the notifications over to batch tasks, one queue per priority class.
+    The batches are spread evenly over `spread` seconds.
+    """
+    from . import tasks
+
+    by_priority_class = {}
+    for notification in notifications:
+        by_priority_class.setdefault(notification.get("priority_class"), []).append(notification)
+
+    batch_count = sum((len(batch) + batch_size - 1) // batch_size for batch in by_priority_class.values())
+    batch_index = 0
+    for priority_class, batch in by_priority_class.items():
+        for index in range(0, len(batch), batch_size):
+            options = get_routing_options(priority_class)
+            if spread:
+                options["countdown"] = spread * batch_index / batch_count
+            tasks.send_push_notification_batch.apply_async((batch[index:index + batch_size],), **options)
+            batch_index += 1
+
+
+def create_campaign(messages, url, sound, extra, category, kwargs, priority_class=None):
+    """
+    Stores the payload shared by the notifications of a bulk send. messages are the rendered messages keyed by locale.
+    """
+    from .models import Campaign
+
+    payload = {
+        "messages": messages,
+        "url": url,
+        "sound": sound,
+        "extra": extra,
+        "category": category,
+        "kwargs": kwargs,
+    }
+    return Campaign.objects.create(payload=json.dumps(payload), priority_class=priority_class or "")
+
+
+def enqueue_campaign_batch(campaign, locale, device_ids):
+    """
+    Queues a batch of the campaign after the current transaction commits, so the task always finds the campaign.
+    """
+    from . import tasks
+
+    args = (campaign.pk, locale, device_ids)
+    options = get_routing_options(campaign.priority_class)
+    transaction.on_commit(lambda: tasks.send_campaign_batch.apply_async(args, **options))
+
+
+def enqueue_campaign_devices(campaign, locale, devices, batch_size, category=None, priority_class=None):
+    """
+    Queues batches of the campaign for the (device_id, user_id) pairs. The devices of users over their
+    FREQUENCY_CAPS are skipped, or scheduled as single notifications with FREQUENCY_CAP_ACTION = "defer".
+    Returns the number of devices queued.
+    """
+    from .capping import FREQUENCY_CAP_DEFER, apply_frequency_cap, defer_notification
+    from .utils import chunked
+
+    enqueued = 0
+    for chunk in chunked(devices, batch_size):
+        allowed_user_ids, retry_at = apply_frequency_cap(set(user_id for _, user_id in chunk), category=category, priority_class=priority_class)
+        allowed_user_ids = set(allowed_user_ids)
+        device_ids = [device_id for device_id, user_id in chunk if user_id in allowed_user_ids]
+        if device_ids:
+            enqueue_campaign_batch(campaign, locale, device_ids)
+        enqueued += len(device_ids)
+
+        if DJANGO_SLOOP_SETTINGS["FREQUENCY_CAP_ACTION"] == FREQUENCY_CAP_DEFER and len(device_ids) < len(chunk):
+            payload = json.loads(campaign.payload)
+            schedule_notifications([
+                defer_notification(build_campaign_notification(payload, locale, device_id, campaign.priority_class or None), user_id, category=category)
+                for device_id, user_id in chunk if user_id not in allowed_user_ids
+            ], retry_at)
+    return enqueued
+
+
+def enqueue_campaign_rows(campaign, rows, batch_size, localized=True, category=None, priority_class=None, deliver_at=None):
+    """
+    Queues the campaign for (device_id, user_id, locale) rows read in a single pass, collecting a full batch per locale.
+    Plain messages are stored under the "" locale, which all the devices share. Returns the number of devices queued.
+
+    With deliver_at, the batches are scheduled instead. A datetime.time is delivered at its next occurrence in the
+    timezone of the device locale, so the batches are also grouped by timezone.
+    """
+    from .utils import get_delivery_time, get_locale_timezone
+
+    def flush(locale, timezone_name, devices):
+        if deliver_at is None:
+            return enqueue_campaign_devices(campaign, locale, devices, batch_size, category=category, priority_class=priority_class)
+        schedule_campaign_batch(campaign, locale, devices, get_delivery_time(deliver_at, timezone_name), category=category)
+        return len(devices)
+
+    local_time = isinstance(deliver_at, datetime.time)
+    enqueued = 0
+    pending = {}
+    for device_id, user_id, device_locale in rows:
+        key = ((device_locale or "") if localized else "", get_locale_timezone(device_locale) if local_time else None)
+        devices = pending.setdefault(key, [])
+        devices.append((device_id, user_id))
+        if len(devices) >= batch_size:
+            enqueued += flush(*key, devices)
+            del pending[key]
+    for key, devices in pending.items():
+        enqueued += flush(*key, devices)
+    return enqueued
+
+
+def schedule_campaign_batch(campaign, locale, devices, deliver_at, category=None):
+    """
+    Stores a batch of the campaign for the (device_id, user_id) pairs in the bucket of its delivery minute.
+    FREQUENCY_CAPS are applied when it is released.
+    """
+    schedule_notification({
+        "kind": CAMPAIGN_BATCH,
+        "campaign_id": campaign.pk,
+        "locale": locale,
+        "devices": [list(device) for device in devices],
+        "category": category,
+        "priority_class": campaign.priority_class or None,
+    }, deliver_at)
+
+
+def release_campaign_batches(batches):
+    """
+    Queues the scheduled campaign batches, returns the number of devices queued.
+    """
+    from .models import Campaign
+
+    campaigns = Campaign.objects.in_bulk(set(batch["campaign_id"] for batch in batches))
+    released = 0
+    for batch in batches:
+        campaign = campaigns.get(batch["campaign_id"])
+        if campaign is None:
+            logger.warning("Campaign %s of a scheduled batch was deleted.", batch["campaign_id"])
+            continue
+        released += enqueue_campaign_devices(
+            campaign, batch["locale"], batch["devices"], len(batch["devices"]), category=batch["category"], priority_class=batch["priority_class"]
+        )
+    return released
+
+
+@lru_cache(maxsize=32)
+def get_campaign_payload(campaign_id):
+    """
+    Loads the campaign payload once per worker process, campaigns are not changed after they are created.
+    """
+    from .models import Campaign
+
+    return json.loads(Campaign.objects.values_list("payload", flat=True).get(pk=campaign_id))
+
+
+def build_campaign_notification(payload, locale, device_id, priority_class=None):
+    """
+    Returns the notification of a single device of a campaign.
+    """
+    return build_notification(
+        PUSH_NOTIFICATION,
+        device_id,
+        # The handler adds the url to extra, so every notification gets its own copy.
+        (payload["messages"][locale], payload["url"], None, payload["sound"], dict(payload["extra"]) if payload["extra"] else None, payload["category"]),
+        payload["kwargs"],
+        priority_class=priority_class
+    )
+
+
+def send_campaign(campaign_id, locale, device_ids, report=None):
+    """
+    Sends a batch of the campaign. The payload is built and serialized once per platform and sandbox setting,
+    rather than once per device. Failures are logged and do not stop the rest of the batch.
+    """
+    from .handlers import SNSHandler
+    from .routing import get_devices
+
+    payload = get_campaign_payload(campaign_id)
+    if report is not None:
+        notifications = [build_campaign_notification(payload, locale, device_id) for device_id in device_ids]
+        return send_notifications(notifications, report=report)
+
+    message = payload["messages"][locale]
+    devices = get_devices(device_ids)
+    messages = {}
+    sent = 0
+    for device_id in device_ids:
+        device = devices.get(device_id)
+        if device is None or device.deleted_at:
+            continue
+        try:
+            handler = SNSHandler(device=device)
+            key = (device.platform, bool(handler.shard_settings.get("SNS_IOS_SANDBOX_ENABLED")))
+            if key not in messages:
+                # The handler adds the url to extra, so it gets its own copy.
+                data, message_attributes = handler.build_push_notification(
+                    device.prepare_message(message), payload["url"], None, payload["sound"],
+                    dict(payload["extra"]) if payload["extra"] else None, payload["category"], **payload["kwargs"]
+                )
+                messages[key] = (json.dumps(data, ensure_ascii=False), message_attributes)
+            message_payload, message_attributes = messages[key]
+            device.send_push_message(message_payload, message_attributes, body=message, handler=handler)
+        except Exception:
+            logger.exception("Could not send the notification to device %s.", device.pk)
+            continue
+        sent += 1
+    return sent
+
+
+def schedule_notification(notification, deliver_at):
+    """
+    Stores the notification in the bucket of its delivery minute.
+    """
+    schedule_notifications([notification], deliver_at)
+
+
+def schedule_notifications(notifications, deliver_at):
+    """
+    Stores the notifications in the bucket of their delivery minute with a single insert.
+    """
+    from .models import ScheduledPush
+
+    deliver_at = deliver_at.replace(second=0, microsecond=0)
+    ScheduledPush.objects.bulk_create([
+        ScheduledPush(notification=json.dumps(notification), deliver_at=deliver_at) for notification in notifications
+    ])
+
+
+def release_scheduled_notifications(batch_size, spread=0, now=None):
+    """
+    Moves the notifications of all the due minute buckets to batch tasks, spreading them over `spread` seconds.
+
+    Deferred and scheduled notifications are counted against their FREQUENCY_CAPS on release. With
+    FREQUENCY_CAP_ACTION = "defer", the ones over the cap are deferred to the next window, so a burst of deferred
+    notifications is not sent all at once. Otherwise they are dropped. Scheduled campaign batches are queued
+    like the batches of an immediate campaign send.
+    """
+    from .capping import FREQUENCY_CAP_DEFER, reapply_frequency_caps
+    from .models import ScheduledPush
+
+    now = now or timezone.now()
+    released = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                ScheduledPush.objects.select_for_update(skip_locked=True).filter(deliver_at__lte=now).order_by("deliver_at", "pk")[:batch_size * 10]
+            )
+            if not rows:
+                break
+            notifications, campaign_batches = [], []
+            for row in rows:
+                notification = json.loads(row.notification)
+                (campaign_batches if notification["kind"] == CAMPAIGN_BATCH else notifications).append(notification)
+            notifications, capped = reapply_frequency_caps(notifications, now=now.timestamp())
+            enqueue_notification_batches(notifications, batch_size, spread=spread)
+            released += release_campaign_batches(campaign_batches)
+            if DJANGO_SLOOP_SETTINGS["FREQUENCY_CAP_ACTION"] == FREQUENCY_CAP_DEFER:
+                for notification, retry_at in capped:
+                    # At least a minute later, so this loop does not release it again.
+                    schedule_notification(notification, max(retry_at, now + datetime.timedelta(minutes=1)))
+            ScheduledPush.objects.filter(pk__in=[row.pk for row in rows]).delete()
+        released += len(notifications)
+    return released
+
+
+def schedule_outbox_relay():
+    """
+    Schedules a single relay task for all the notifications committed within OUTBOX_RELAY_COUNTDOWN seconds.
+    """
+    from . import tasks
+
+    countdown = DJANGO_SLOOP_SETTINGS["OUTBOX_RELAY_COUNTDOWN"]
+    if get_cache().add(OUTBOX_RELAY_LOCK_KEY, True, timeout=countdown + 60):
+        tasks.relay_push_outbox.apply_async(countdown=countdown)
+
+
+def schedule_spool_drain():
+    """
+    Schedules a single drain task when a circuit closes, see drain_spool().
+    """
+    from . import tasks
+
+    if get_cache().add(SPOOL_DRAIN_LOCK_KEY, True, timeout=60 * 10):
+        tasks.drain_push_spool.apply_async()
+
+
+def drain_spool(batch_size, rate=None):
+    """
+    Publishes the spooled payloads at most `rate` per second, oldest first. Payloads of shards whose circuit
+    is still open, or that failed with a service error, stay in the spool for the next drain.
+    """
+    from .circuit import CircuitOpen, is_service_failure
+    from .handlers import SNSHandler
+    from .models import PushMessage, PushSpool
+    from .utils import RateLimiter
+
+    rate_limiter = RateLimiter(rate)
+    drained = 0
+    last_pk = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                PushSpool.objects.select_for_update(skip_locked=True, of=("self",)).select_related("device")
+                .filter(pk__gt=last_pk).order_by("pk")[:batch_size]
+            )
+            if not rows:
+                break
+            last_pk = rows[-1].pk
+
+            done_pks = []
+            for row in rows:
+                if row.device.deleted_at:
+                    done_pks.append(row.pk)
+                    continue
+
+                rate_limiter.wait()
+                message_attributes = json.loads(row.message_attributes) if row.message_attributes else None
+                try:
+                    message, response = SNSHandler(row.device)._publish(row.data, message_attributes)
+                except CircuitOpen:
+                    continue
+                except Exception as exc:
+                    logger.exception("Could not send the spooled payload to device %s.", row.device_id)
+                    if not is_service_failure(exc):
+                        done_pks.append(row.pk)
+                    continue
+
+                done_pks.append(row.pk)
+                drained += 1
+                if DJANGO_SLOOP_SETTINGS["LOG_SENT_MESSAGES"]:
+                    PushMessage.objects.create(
+                        device=row.device,
+                        body=row.body,
+                        data=message,
+                        sns_message_id=response.get("MessageId") or None,
+                        sns_response=json.dumps(response)
+                    )
+            PushSpool.objects.filter(pk__in=done_pks).delete()
+    return drained
+
+
+def get_coalesce_cache_keys(device_id, collapse_key):
+    key = "sloop:coalesce:%s:%s" % (device_id, collapse_key)
+    return key + ":notification", key + ":count"
+
+
+def coalesce_notification(notification, collapse_key):
+    """
+    Buffers the notification for COALESCE_WINDOW seconds after the current transaction commits. The first
+    notification of a window schedules tasks.flush_coalesced_notification, which sends the last buffered
+    notification with a summarized message.
+    """
+    transaction.on_commit(lambda: buffer_coalesced_notification(notification, collapse_key))
+
+
+def buffer_coalesced_notification(notification, collapse_key):
+    cache = get_cache()
+    window = DJANGO_SLOOP_SETTINGS["COALESCE_WINDOW"]
+    notification_key, count_key = get_coalesce_cache_keys(notification["device_id"], collapse_key)
+
+    # The notification is stored before it is counted, so a flush that counts it also sees it.
+    cache.set(notification_key, notification, window * 2)
+    if cache.add(count_key, 1, window * 2):
+        count = 1
+    else:
+        try:
+            count = cache.incr(count_key)
+        except ValueError:
+            # The counter expired in the meantime, start a new window.
+            cache.set(count_key, 1, window * 2)
+            count = 1
+    if count == 1:
+        cache.touch(count_key, window * 2)
+        schedule_coalesced_flush(notification, collapse_key, countdown=window)
+
+
+def schedule_coalesced_flush(notification, collapse_key, countdown):
+    from . import tasks
+
+    tasks.flush_coalesced_notification.apply_async(
+        (notification["device_id"], collapse_key), countdown=countdown, **get_routing_options(notification.get("priority_class"))
+    )
+
+
+def pop_coalesced_notification(device_id, collapse_key):
+    """
+    Returns the last buffered notification with the number of buffered notifications and clears the buffer.
+
+    The counter is decremented by the number read rather than deleted, so notifications buffered meanwhile are
+    not lost: they are left in the buffer and another flush is scheduled for them.
+    """
+    cache = get_cache()
+    notification_key, count_key = get_coalesce_cache_keys(device_id, collapse_key)
+    count = cache.get(count_key) or 0
+    if not count:
+        return None, 0
+    notification = cache.get(notification_key)
+    try:
+        remaining = cache.decr(count_key, count)
+    except ValueError:
+        remaining = 0
+    if remaining > 0 and notification is not None:
+        schedule_coalesced_flush(notification, collapse_key, countdown=DJANGO_SLOOP_SETTINGS["COALESCE_WINDOW"])
+    return notification, count
+
+
+def send_notification(device, notification, dry_run=False):
+    if notification["kind"] == PUSH_NOTIFICATION:
+        return device.send_push_notification(*notification["args"], dry_run=dry_run, **notification["kwargs"])
+    return device.send_silent_push_notification(*notification["args"], dry_run=dry_run, **notification["kwargs"])
+
+
+def send_notifications(notifications, report=None):
+    """
+    Sends the notifications with one device query. Failures are logged and do not stop the rest of the batch.
+    If a DryRunReport is given, the payloads are added to it instead of being published.
+    """
+    from .routing import get_devices
+
+    devices = get_devices([notification["device_id"] for notification in notifications])
+    sent = 0
+    for notification in notifications:
+        device = devices.get(notification["device_id"])
+        if device is None:
+            continue
+        try:
+            result = send_notification(device, notification, dry_run=report is not None)
+        except DeviceIsNotActive:
+            continue
+        except Exception:
+            logger.exception("Could not send the notification to device %s.", device.pk)
+            continue
+        if report is not None:
+            report.update(result)
+        sent += 1
+    return sent
@@ -0,0 +1,90 @@
+from .sharding import get_shard_settings, get_shards
+
+# APNs and FCM reject payloads larger than 4 KB.
+MAX_PAYLOAD_SIZE = 4096
+
+
+def get_total_publish_rate():
+    """
+    Returns the sum of the SNS_PUBLISH_RATE of the shards, or None if any of them is unlimited.
+    """
+    rates = [get_shard_settings(shard).get("SNS_PUBLISH_RATE") for shard in get_shards()]
+    if not all(rates):
+        return None
+    return sum(rates)
+
+
+class DryRunReport(object):
+    """
+    Counts the recipients of a dry-run send per platform with the sizes of their payloads.
+    Payloads are counted once per distinct size, so a report over millions of devices stays small.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.platforms = {}
+        self.sizes = {}
+
+    def add(self, platform, data, count=1):
+        """
+        Counts `count` recipients of the payload built by the SNSHandler generators.
+        """
+        size = max(len(payload.encode("utf-8")) for payload in data.values())
+        self.platforms[platform] = self.platforms.get(platform, 0) + count
+        self.sizes[size] = self.sizes.get(size, 0) + count
+
+    def update(self, report):
+        for platform, count in report.platforms.items():
+            self.platforms[platform] = self.platforms.get(platform, 0) + count
+        for size, count in report.sizes.items():
+            self.sizes[size] = self.sizes.get(size, 0) + count
+
+    @property
+    def total(self):
+        return sum(self.platforms.values())
+
+    def get_size_percentile(self, percentile):
+        threshold = self.total * percentile / 100.0
+        seen = 0
+        for size in sorted(self.sizes):
+            seen += self.sizes[size]
+            if seen >= threshold:
+                return size
+        return None
+
+    def get_eta(self):
+        """
+        Returns the seconds the send takes at `rate` publishes per second, by default the total SNS_PUBLISH_RATE of
+        the shards in a single process. Returns None if the rate is unlimited.
+        """
+        rate = self.rate or get_total_publish_rate()
+        if not rate:
+            return None
+        return self.total / float(rate)
+
+    def as_dict(self):
+        total = self.total
+        return {
+            "total": total,
+            "platforms": dict(self.platforms),
+            "payload_size": {
+                "min": min(self.sizes) if self.sizes else None,
+                "max": max(self.sizes) if self.sizes else None,
+                "mean": sum(size * count for size, count in self.sizes.items()) / float(total) if total else None,
+                "p50": self.get_size_percentile(50),
+                "p95": self.get_size_percentile(95),
+            },
+            "oversized": sum(count for size, count in self.sizes.items() if size > MAX_PAYLOAD_SIZE),
+            "eta_seconds": self.get_eta(),
+        }
+
+    def __str__(self):
+        report = self.as_dict()
+        platforms = ", ".join("%s: %d" % (platform, count) for platform, count in sorted(report["platforms"].items()))
+        text = "%d devices (%s)" % (report["total"], platforms or "none")
+        if report["total"]:
+            text += ", payloads of %(min)d-%(max)d bytes (p95 %(p95)d)" % report["payload_size"]
+            text += ", %d over %d bytes" % (report["oversized"], MAX_PAYLOAD_SIZE)
+        if report["eta_seconds"] is not None:
+            text += ", ETA %ds" % report["eta_seconds"]
+        return text
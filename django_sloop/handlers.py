@@ -1,65 +1,169 @@
 import json
+import re
+import threading
 
-import boto3
-from botocore.exceptions import ClientError
 from django.conf import settings
 
+from .cache import get_cache
+from .circuit import CircuitBreaker, CircuitOpen, is_service_failure
 from .settings import DJANGO_SLOOP_SETTINGS
+from .sharding import get_device_shard, get_shard_settings, get_shards
+from .utils import RateLimiter
 
 from .models import AbstractSNSDevice
 
+APNS_COLLAPSE_ID_ATTRIBUTE = "AWS.SNS.MOBILE.APNS.COLLAPSE_ID"
+EXISTING_ENDPOINT_RE = re.compile(r"Endpoint (\S+) already exists with the same [Tt]oken")
+
+# SNS clients and publish rate limiters of this process, keyed by shard.
+_shard_clients = {}
+_shard_rate_limiters = {}
+_shard_lock = threading.Lock()
+
+
+def create_client(shard_settings):
+    # boto3 takes a while to import, web processes that never send a push do not load it.
+    import boto3
+    from botocore.config import Config
+
+    client_config = DJANGO_SLOOP_SETTINGS["SNS_CLIENT_CONFIG"]
+    return boto3.client(
+        'sns',
+        region_name=shard_settings.get("AWS_REGION_NAME") or None,
+        aws_access_key_id=shard_settings.get("AWS_ACCESS_KEY_ID") or None,
+        aws_secret_access_key=shard_settings.get("AWS_SECRET_ACCESS_KEY") or None,
+        config=Config(**client_config) if client_config else None
+    )
+
+
+def get_shard_client(shard):
+    with _shard_lock:
+        if shard not in _shard_clients:
+            _shard_clients[shard] = create_client(get_shard_settings(shard))
+        return _shard_clients[shard]
+
+
+def get_endpoint_client(endpoint_arn):
+    """
+    Returns a client with the top level credentials in the region of the endpoint, for endpoints of shards that are
+    no longer configured.
+    """
+    parts = endpoint_arn.split(":")
+    region = parts[3] if len(parts) > 3 and parts[0] == "arn" else None
+    with _shard_lock:
+        key = ("endpoint-region", region)
+        if key not in _shard_clients:
+            shard_settings = get_shard_settings(None)
+            if region:
+                shard_settings["AWS_REGION_NAME"] = region
+            _shard_clients[key] = create_client(shard_settings)
+        return _shard_clients[key]
+
+
+def get_shard_rate_limiter(shard):
+    with _shard_lock:
+        if shard not in _shard_rate_limiters:
+            _shard_rate_limiters[shard] = RateLimiter(get_shard_settings(shard).get("SNS_PUBLISH_RATE"))
+        return _shard_rate_limiters[shard]
+
+
+def reset_shard_clients():
+    """
+    Drops the SNS clients and rate limiters of the process, forked processes must create their own.
+    """
+    with _shard_lock:
+        _shard_clients.clear()
+        _shard_rate_limiters.clear()
+
 
 class SNSHandler(object):
 
     client = None
 
-    def __init__(self, device):
+    def __init__(self, device, client=None, shard=None):
         self.device = device
-        self.client = self.get_client()
+        self.shard = shard or get_device_shard(device)
+        self.shard_settings = get_shard_settings(self.shard)
+        self.client = client or self.get_client()
 
     def get_client(self):
         if self.client:
             return self.client
 
-        client = boto3.client(
-            'sns',
-            region_name=DJANGO_SLOOP_SETTINGS.get("AWS_REGION_NAME") or None,
-            aws_access_key_id=DJANGO_SLOOP_SETTINGS.get("AWS_ACCESS_KEY_ID") or None,
-            aws_secret_access_key=DJANGO_SLOOP_SETTINGS.get("AWS_SECRET_ACCESS_KEY") or None
-        )
+        if self.shard not in get_shards() and self.device.sns_platform_endpoint_arn:
+            return get_endpoint_client(self.device.sns_platform_endpoint_arn)
+        return get_shard_client(self.shard)
+
+    @property
+    def circuit_breaker(self):
+        return CircuitBreaker(self.shard)
+
+    def call(self, operation, **kwargs):
+        """
+        Calls the SNS client through the circuit breaker of the shard, raising CircuitOpen without calling SNS while it is open.
+        """
+        from .dispatch import schedule_spool_drain
 
-        return client
+        circuit_breaker = self.circuit_breaker
+        if not circuit_breaker.allow_request():
+            raise CircuitOpen(self.shard)
+
+        try:
+            result = getattr(self.client, operation)(**kwargs)
+        except Exception as exc:
+            if is_service_failure(exc):
+                circuit_breaker.record_failure()
+            elif circuit_breaker.record_success():
+                schedule_spool_drain()
+            raise
+
+        if circuit_breaker.record_success():
+            schedule_spool_drain()
+        return result
 
     @property
     def application_arn(self):
         if self.device.platform == AbstractSNSDevice.PLATFORM_IOS:
-            application_arn = DJANGO_SLOOP_SETTINGS.get("SNS_IOS_APPLICATION_ARN")
+            application_arn = self.shard_settings.get("SNS_IOS_APPLICATION_ARN")
         elif self.device.platform == AbstractSNSDevice.PLATFORM_ANDROID:
-            application_arn = DJANGO_SLOOP_SETTINGS.get("SNS_ANDROID_APPLICATION_ARN")
+            application_arn = self.shard_settings.get("SNS_ANDROID_APPLICATION_ARN")
         else:
             assert False
 
         return application_arn
 
-    def send_push_notification(self, message, url, badge_count, sound, extra, category, **kwargs):
+    def send_push_notification(self, message, url, badge_count, sound, extra, category, idempotency_key=None, collapse_key=None, **kwargs):
 
-        if self.device.platform == AbstractSNSDevice.PLATFORM_IOS:
-            data = self.generate_apns_push_notification_message(message, url, badge_count, sound, extra, category, **kwargs)
-        else:
-            data = self.generate_gcm_push_notification_message(message, url, badge_count, sound, extra, category, **kwargs)
+        data, message_attributes = self.build_push_notification(message, url, badge_count, sound, extra, category, collapse_key=collapse_key, **kwargs)
+        return self._send_payload(data, idempotency_key=idempotency_key, message_attributes=message_attributes, body=message)
 
-        return self._send_payload(data)
+    def send_silent_push_notification(self, extra, badge_count, content_available, idempotency_key=None, **kwargs):
 
-    def send_silent_push_notification(self, extra, badge_count, content_available, **kwargs):
+        data = self.build_silent_push_notification(extra, badge_count, content_available, **kwargs)
+        return self._send_payload(data, idempotency_key=idempotency_key)
 
+    def build_push_notification(self, message, url, badge_count, sound, extra, category, collapse_key=None, **kwargs):
+        """
+        Returns the payload of the device platform and the SNS message attributes.
+        """
+        message_attributes = None
         if self.device.platform == AbstractSNSDevice.PLATFORM_IOS:
-            data = self.generate_apns_silent_push_notification_message(extra, badge_count, content_available, **kwargs)
+            data = self.generate_apns_push_notification_message(message, url, badge_count, sound, extra, category, **kwargs)
+            if collapse_key:
+                message_attributes = {
+                    APNS_COLLAPSE_ID_ATTRIBUTE: {"DataType": "String", "StringValue": collapse_key}
+                }
         else:
-            data = self.generate_gcm_silent_push_notification_message(extra, badge_count, content_available, **kwargs)
+            data = self.generate_gcm_push_notification_message(message, url, badge_count, sound, extra, category, collapse_key=collapse_key, **kwargs)
 
-        return self._send_payload(data)
+        return data, message_attributes
 
-    def generate_gcm_push_notification_message(self, message, url, badge_count, sound, extra, category, **kwargs):
+    def build_silent_push_notification(self, extra, badge_count, content_available, **kwargs):
+        if self.device.platform == AbstractSNSDevice.PLATFORM_IOS:
+            return self.generate_apns_silent_push_notification_message(extra, badge_count, content_available, **kwargs)
+        return self.generate_gcm_silent_push_notification_message(extra, badge_count, content_available, **kwargs)
+
+    def generate_gcm_push_notification_message(self, message, url, badge_count, sound, extra, category, collapse_key=None, **kwargs):
         if not extra:
             extra = {}
 
@@ -78,6 +182,8 @@ class SNSHandler(object):
         data_bundle = {
             'data': data
         }
+        if collapse_key:
+            data_bundle['collapse_key'] = collapse_key
 
         data_string = json.dumps(data_bundle, ensure_ascii=False)
 
@@ -125,7 +231,7 @@ class SNSHandler(object):
         }
         apns_string = json.dumps(apns_bundle, ensure_ascii=False)
 
-        if DJANGO_SLOOP_SETTINGS.get("SNS_IOS_SANDBOX_ENABLED"):
+        if self.shard_settings.get("SNS_IOS_SANDBOX_ENABLED"):
             return {
                 'APNS_SANDBOX': apns_string
             }
@@ -149,7 +255,7 @@ class SNSHandler(object):
         }
         apns_string = json.dumps(apns_bundle, ensure_ascii=False)
 
-        if DJANGO_SLOOP_SETTINGS.get("SNS_IOS_SANDBOX_ENABLED"):
+        if self.shard_settings.get("SNS_IOS_SANDBOX_ENABLED"):
             return {
                 'APNS_SANDBOX': apns_string
             }
@@ -158,33 +264,143 @@ class SNSHandler(object):
                 'APNS': apns_string
             }
 
+    def create_platform_endpoint(self):
+        """
+        Creates an SNS endpoint for the device push token and returns its ARN without saving the device.
+        If the token already has an endpoint with different attributes, that endpoint is enabled and reused.
+        """
+        from botocore.exceptions import ClientError
+
+        try:
+            endpoint_response = self.call(
+                "create_platform_endpoint",
+                PlatformApplicationArn=self.application_arn,
+                Token=self.device.push_token,
+            )
+        except ClientError as exc:
+            match = EXISTING_ENDPOINT_RE.search(exc.response['Error'].get("Message") or "")
+            if exc.response['Error']["Code"] != "InvalidParameter" or not match:
+                raise
+            endpoint_arn = match.group(1)
+            self.set_endpoint_attributes(endpoint_arn)
+            return endpoint_arn
+
+        return endpoint_response['EndpointArn']
+
+    def set_endpoint_attributes(self, endpoint_arn):
+        self.call(
+            "set_endpoint_attributes",
+            EndpointArn=endpoint_arn,
+            Attributes={
+                "Token": self.device.push_token,
+                "Enabled": "true",
+            }
+        )
+
+    def refresh_platform_endpoint(self):
+        """
+        Points the device endpoint to the current push token and enables it, creating a new endpoint if it is gone.
+        """
+        from botocore.exceptions import ClientError
+
+        if not self.device.sns_platform_endpoint_arn:
+            return self.get_or_create_platform_endpoint_arn()
+
+        try:
+            self.set_endpoint_attributes(self.device.sns_platform_endpoint_arn)
+        except ClientError as exc:
+            if exc.response['Error']["Code"] != "NotFound":
+                raise
+            self.device.sns_platform_endpoint_arn = None
+            return self.get_or_create_platform_endpoint_arn()
+
+        return self.device.sns_platform_endpoint_arn
+
     def get_or_create_platform_endpoint_arn(self):
         if self.device.sns_platform_endpoint_arn:
             endpoint_arn = self.device.sns_platform_endpoint_arn
         else:
-            endpoint_response = self.client.create_platform_endpoint(
-                PlatformApplicationArn=self.application_arn,
-                Token=self.device.push_token,
-            )
-            endpoint_arn = endpoint_response['EndpointArn']
+            endpoint_arn = self.create_platform_endpoint()
+            # An existing endpoint may have been reused, take it over from the device that had the token before.
+            type(self.device)._default_manager.filter(sns_platform_endpoint_arn=endpoint_arn).exclude(pk=self.device.pk).update(sns_platform_endpoint_arn=None)
             self.device.sns_platform_endpoint_arn = endpoint_arn
-            self.device.save(update_fields=["sns_platform_endpoint_arn"])
+            self.device.sns_shard = self.shard
+            self.device.save(update_fields=["sns_platform_endpoint_arn", "sns_shard"])
 
         return endpoint_arn
 
-    def _send_payload(self, data):
+    def claim_idempotency_key(self, idempotency_key):
+        """
+        Returns False if a message with the same key was already sent to this device.
+        """
+        return get_cache().add(self.get_idempotency_cache_key(idempotency_key), True, DJANGO_SLOOP_SETTINGS["IDEMPOTENCY_KEY_TTL"])
+
+    def release_idempotency_key(self, idempotency_key):
+        get_cache().delete(self.get_idempotency_cache_key(idempotency_key))
+
+    def get_idempotency_cache_key(self, idempotency_key):
+        return "sloop:idempotency:%s:%s" % (self.device.pk, idempotency_key)
+
+    def spool_payload(self, message, message_attributes=None, body=""):
+        """
+        Keeps the payload in the spool until the circuit closes, see dispatch.drain_spool().
+        """
+        from .models import PushSpool
+
+        PushSpool.objects.create(
+            device=self.device,
+            body=body,
+            data=message,
+            message_attributes=json.dumps(message_attributes) if message_attributes else "",
+        )
+
+    def _send_payload(self, data, idempotency_key=None, message_attributes=None, body=""):
+        """
+        Publishes the payload and returns the message with the SNS response,
+        or None instead of the response if the idempotency key was already used or the payload was spooled.
+        """
+        return self.send_message(json.dumps(data, ensure_ascii=False), idempotency_key, message_attributes, body)
+
+    def send_message(self, message, idempotency_key=None, message_attributes=None, body=""):
+        """
+        Like _send_payload(), for a payload that is already serialized.
+        """
+        if idempotency_key and not self.claim_idempotency_key(idempotency_key):
+            return message, None
+
+        try:
+            return self._publish(message, message_attributes)
+        except CircuitOpen:
+            # The idempotency key stays claimed, the spooled payload is sent when the circuit closes.
+            self.spool_payload(message, message_attributes, body)
+            return message, None
+        except Exception:
+            if idempotency_key:
+                self.release_idempotency_key(idempotency_key)
+            raise
+
+    def _publish(self, message, message_attributes=None):
+        from botocore.exceptions import ClientError
+
         endpoint_arn = self.get_or_create_platform_endpoint_arn()
-        message = json.dumps(data, ensure_ascii=False)
 
         if settings.DEBUG:
             print("ARN:" + endpoint_arn)
             print(message)
 
+        publish_kwargs = {}
+        if message_attributes:
+            publish_kwargs["MessageAttributes"] = message_attributes
+
+        get_shard_rate_limiter(self.shard).wait()
+
         try:
-            publish_result = self.client.publish(
+            publish_result = self.call(
+                "publish",
                 TargetArn=endpoint_arn,
                 Message=message,
-                MessageStructure='json'
+                MessageStructure='json',
+                **publish_kwargs
             )
         except ClientError as exc:
             if exc.response['Error']["Code"] == "EndpointDisabled":
@@ -0,0 +1,74 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_sloop.broadcast import create_broadcast, get_broadcast_progress, run_broadcast
+from django_sloop.checks import is_process_local_cache
+from django_sloop.models import Broadcast
+
+
+class Command(BaseCommand):
+    help = "Sends a push notification to the matching active devices from a pool of processes, without Celery."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--message", help="Message of the notification.")
+        parser.add_argument("--url", default=None)
+        parser.add_argument("--sound", default=None)
+        parser.add_argument("--category", default=None)
+        parser.add_argument("--extra", type=json.loads, default=None, help="JSON object of custom data.")
+        parser.add_argument("--filter", type=json.loads, default=None, help='JSON object of device lookups, e.g. \'{"platform": "ios"}\'.')
+        parser.add_argument("--resume", type=int, default=None, help="Id of an interrupted broadcast to continue.")
+        parser.add_argument("--processes", type=int, default=4, help="Number of processes.")
+        parser.add_argument("--concurrency", type=int, default=10, help="Number of concurrent SNS requests per process.")
+        parser.add_argument("--rate", type=float, default=0, help="Maximum SNS requests per second per process, 0 for no limit.")
+        parser.add_argument("--range-size", type=int, default=10000, help="Size of the primary key range handed to a process.")
+        parser.add_argument("--batch-size", type=int, default=500, help="Number of devices sent between checkpoints.")
+        parser.add_argument("--report-interval", type=float, default=5, help="Seconds between progress reports.")
+
+    def handle(self, *args, **options):
+        if options["resume"]:
+            try:
+                broadcast = Broadcast.objects.get(pk=options["resume"])
+            except Broadcast.DoesNotExist:
+                raise CommandError("Broadcast %s does not exist." % options["resume"])
+            if broadcast.date_completed:
+                raise CommandError("Broadcast %s is already completed." % broadcast.pk)
+        elif options["message"]:
+            broadcast = create_broadcast(
+                options["message"], url=options["url"], sound=options["sound"], extra=options["extra"],
+                category=options["category"], filters=options["filter"], range_size=options["range_size"]
+            )
+            self.stdout.write("Created broadcast %d, resume it with --resume %d" % (broadcast.pk, broadcast.pk))
+        else:
+            raise CommandError("Pass --message or --resume.")
+
+        if is_process_local_cache():
+            self.stderr.write(
+                "Warning: the cache is not shared between processes, so devices are not marked as sent across processes. "
+                "If this broadcast is interrupted, --resume sends the batches that were in flight again."
+            )
+
+        self.started = time.monotonic()
+        self.initial_sent = get_broadcast_progress(broadcast)["sent"]
+        run_broadcast(
+            broadcast,
+            options["processes"],
+            self.report,
+            report_interval=options["report_interval"],
+            batch_size=options["batch_size"],
+            concurrency=options["concurrency"],
+            rate=options["rate"],
+        )
+
+        progress = get_broadcast_progress(broadcast)
+        self.stdout.write("Broadcast %d completed: %d sent, %d failed." % (broadcast.pk, progress["sent"], progress["failed"]))
+
+    def report(self, progress):
+        elapsed = time.monotonic() - self.started
+        throughput = (progress["sent"] - self.initial_sent) / elapsed if elapsed else 0
+        self.stdout.write(
+            "%d sent, %d failed, %d/%d ranges completed, %.1f notifications/s" % (
+                progress["sent"], progress["failed"], progress["completed_ranges"], progress["ranges"], throughput
+            )
+        )
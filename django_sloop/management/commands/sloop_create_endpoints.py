@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+
+from django_sloop.cache import invalidate_active_devices
+from django_sloop.handlers import SNSHandler
+from django_sloop.utils import get_device_model, iter_pk_ranges, run_concurrently
+
+
+class Command(BaseCommand):
+    help = "Creates the missing SNS endpoints of active devices."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Size of the primary key range processed per batch.")
+        parser.add_argument("--concurrency", type=int, default=10, help="Number of concurrent SNS requests.")
+        parser.add_argument("--rate", type=float, default=20, help="Maximum SNS requests per second, 0 for no limit.")
+        parser.add_argument("--start-id", type=int, default=None, help="Resume from this primary key.")
+
+    def handle(self, *args, **options):
+        device_model = get_device_model()
+        devices = device_model._default_manager.filter(deleted_at__isnull=True, sns_platform_endpoint_arn__isnull=True)
+        created = failed = 0
+
+        for lower, upper in iter_pk_ranges(devices, options["batch_size"], start_pk=options["start_id"]):
+            batch = list(devices.filter(pk__gte=lower, pk__lt=upper))
+            if not batch:
+                continue
+
+            results = run_concurrently(
+                lambda device: self.create_platform_endpoint(device),
+                batch,
+                concurrency=options["concurrency"],
+                rate=options["rate"],
+            )
+
+            updated_devices = []
+            for device, endpoint_arn, exc in results:
+                if exc is not None:
+                    failed += 1
+                    self.stderr.write("Could not create the endpoint of device %s: %s" % (device.pk, exc))
+                    continue
+                device.sns_platform_endpoint_arn, device.sns_shard = endpoint_arn
+                updated_devices.append(device)
+
+            # Endpoints reused for known tokens are taken over from the devices that had them before.
+            device_model._default_manager.filter(
+                sns_platform_endpoint_arn__in=[device.sns_platform_endpoint_arn for device in updated_devices]
+            ).update(sns_platform_endpoint_arn=None, sns_shard="")
+            device_model._default_manager.bulk_update(updated_devices, ["sns_platform_endpoint_arn", "sns_shard"])
+            invalidate_active_devices([device.user_id for device in updated_devices])
+            created += len(updated_devices)
+            self.stdout.write("Created %d endpoints, resume with --start-id %d" % (created, upper))
+
+        self.stdout.write("Created %d endpoints, %d failed." % (created, failed))
+
+    def create_platform_endpoint(self, device):
+        handler = SNSHandler(device)
+        return handler.create_platform_endpoint(), handler.shard
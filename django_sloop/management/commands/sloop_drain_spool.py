@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from django_sloop.tasks import drain_push_spool
+
+
+class Command(BaseCommand):
+    help = "Sends the push payloads spooled while the SNS circuit was open."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None, help="Number of payloads locked per transaction.")
+        parser.add_argument("--rate", type=float, default=None, help="Maximum publishes per second, 0 for no limit. Defaults to SPOOL_DRAIN_RATE.")
+
+    def handle(self, *args, **options):
+        self.stdout.write(drain_push_spool(batch_size=options["batch_size"], rate=options["rate"]))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from django_sloop.models import Segment
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the device ids of segments from their filters, meant to run daily for segments with active_days."
+
+    def add_arguments(self, parser):
+        parser.add_argument("names", nargs="*", help="Names of the segments, all segments by default.")
+
+    def handle(self, *args, **options):
+        segments = Segment.objects.order_by("name")
+        if options["names"]:
+            segments = segments.filter(name__in=options["names"])
+            missing = set(options["names"]) - set(segments.values_list("name", flat=True))
+            if missing:
+                raise CommandError("Unknown segments: %s" % ", ".join(sorted(missing)))
+
+        for segment in segments:
+            segment.materialize()
+            self.stdout.write("Segment %s has %d devices." % (segment.name, segment.device_count))
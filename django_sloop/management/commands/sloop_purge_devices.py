@@ -0,0 +1,77 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from django_sloop.handlers import SNSHandler
+from django_sloop.models import PushMessage
+from django_sloop.settings import DJANGO_SLOOP_SETTINGS
+from django_sloop.utils import get_device_model, iter_pk_ranges, run_concurrently
+
+
+class Command(BaseCommand):
+    help = "Deletes the SNS endpoints and rows of devices that were invalidated before the retention period."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=DJANGO_SLOOP_SETTINGS["DEVICE_RETENTION_DAYS"],
+                            help="Purge devices invalidated more than this many days ago. Defaults to DEVICE_RETENTION_DAYS.")
+        parser.add_argument("--batch-size", type=int, default=500, help="Size of the device primary key range purged per batch.")
+        parser.add_argument("--message-batch-size", type=int, default=1000, help="Number of push messages deleted per statement.")
+        parser.add_argument("--concurrency", type=int, default=10, help="Number of concurrent endpoint deletions.")
+        parser.add_argument("--rate", type=float, default=20, help="Maximum endpoint deletions per second, 0 for no limit.")
+        parser.add_argument("--sleep", type=float, default=0.1, help="Seconds to wait between batches.")
+        parser.add_argument("--start-id", type=int, default=None, help="Resume from this primary key.")
+        parser.add_argument("--dry-run", action="store_true", help="Only count the devices to purge.")
+
+    def handle(self, *args, **options):
+        if not options["days"]:
+            raise CommandError("Pass --days or set DJANGO_SLOOP_SETTINGS['DEVICE_RETENTION_DAYS'].")
+
+        device_model = get_device_model()
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        stale_devices = device_model._default_manager.filter(deleted_at__lt=cutoff)
+
+        if options["dry_run"]:
+            if options["start_id"] is not None:
+                stale_devices = stale_devices.filter(pk__gte=options["start_id"])
+            self.stdout.write("%d devices would be purged." % stale_devices.count())
+            return
+
+        purged = 0
+        for lower, upper in iter_pk_ranges(stale_devices, options["batch_size"], start_pk=options["start_id"]):
+            devices = list(stale_devices.filter(pk__gte=lower, pk__lt=upper).only("pk", "platform", "sns_platform_endpoint_arn", "sns_shard"))
+            if not devices:
+                continue
+
+            results = run_concurrently(
+                lambda device: device.sns_platform_endpoint_arn and SNSHandler(device).client.delete_endpoint(EndpointArn=device.sns_platform_endpoint_arn),
+                devices,
+                concurrency=options["concurrency"],
+                rate=options["rate"],
+            )
+
+            device_ids = []
+            for device, _, exc in results:
+                if exc is not None:
+                    # Keep the row so that the endpoint is retried on the next run.
+                    self.stderr.write("Could not delete the endpoint of device %s: %s" % (device.pk, exc))
+                else:
+                    device_ids.append(device.pk)
+
+            self.delete_push_messages(device_ids, options["message_batch_size"])
+            device_model._default_manager.filter(pk__in=device_ids).delete()
+
+            purged += len(device_ids)
+            self.stdout.write("Purged %d devices, resume with --start-id %d" % (purged, upper))
+            time.sleep(options["sleep"])
+
+        self.stdout.write("Purged %d devices in total." % purged)
+
+    def delete_push_messages(self, device_ids, batch_size):
+        messages = PushMessage.objects.filter(device_id__in=device_ids)
+        while True:
+            message_ids = list(messages.values_list("pk", flat=True)[:batch_size])
+            if not message_ids:
+                break
+            PushMessage.objects.filter(pk__in=message_ids).delete()
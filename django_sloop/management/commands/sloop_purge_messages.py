@@ -0,0 +1,54 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from django_sloop.models import Broadcast, Campaign, PushMessage
+from django_sloop.settings import DJANGO_SLOOP_SETTINGS
+from django_sloop.utils import iter_pk_ranges
+
+
+class Command(BaseCommand):
+    help = "Deletes push messages older than the retention period in primary key ranges, and the campaigns of that age."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=DJANGO_SLOOP_SETTINGS["PUSH_MESSAGE_RETENTION_DAYS"],
+                            help="Delete messages older than this many days. Defaults to PUSH_MESSAGE_RETENTION_DAYS.")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Size of the primary key range deleted per batch.")
+        parser.add_argument("--sleep", type=float, default=0.1, help="Seconds to wait between batches.")
+        parser.add_argument("--start-id", type=int, default=None, help="Resume from this primary key.")
+        parser.add_argument("--dry-run", action="store_true", help="Only count the expired messages.")
+
+    def handle(self, *args, **options):
+        if not options["days"]:
+            raise CommandError("Pass --days or set DJANGO_SLOOP_SETTINGS['PUSH_MESSAGE_RETENTION_DAYS'].")
+
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        expired = PushMessage.objects.filter(date_created__lt=cutoff)
+        # Campaigns of unfinished broadcasts are kept, so they can still be resumed.
+        expired_campaigns = Campaign.objects.filter(date_created__lt=cutoff).exclude(
+            pk__in=Broadcast.objects.filter(date_completed__isnull=True).values("campaign_id")
+        )
+
+        if options["dry_run"]:
+            if options["start_id"] is not None:
+                expired = expired.filter(pk__gte=options["start_id"])
+            self.stdout.write("%d push messages would be deleted." % expired.count())
+            self.stdout.write("%d campaigns would be deleted." % expired_campaigns.count())
+            return
+
+        total = 0
+        for lower, upper in iter_pk_ranges(expired, options["batch_size"], start_pk=options["start_id"]):
+            # PushMessage has no reverse relations, so this is a single DELETE statement.
+            deleted, _ = expired.filter(pk__gte=lower, pk__lt=upper).delete()
+            total += deleted
+            if deleted:
+                self.stdout.write("Deleted %d push messages, resume with --start-id %d" % (deleted, upper))
+                time.sleep(options["sleep"])
+
+        self.stdout.write("Deleted %d push messages in total." % total)
+
+        # There is one campaign per bulk send, so they are few enough to delete at once, with their broadcasts.
+        _, deleted = expired_campaigns.delete()
+        self.stdout.write("Deleted %d campaigns." % deleted.get(Campaign._meta.label, 0))
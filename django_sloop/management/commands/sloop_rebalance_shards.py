@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+
+from django_sloop.cache import invalidate_active_devices
+from django_sloop.handlers import SNSHandler
+from django_sloop.sharding import DEFAULT_SHARD, assign_shard
+from django_sloop.utils import get_device_model, iter_pk_ranges, run_concurrently
+
+
+class Command(BaseCommand):
+    help = "Moves the devices whose endpoints are not in their assigned SNS shard, e.g. after adding a shard."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Size of the primary key range processed per batch.")
+        parser.add_argument("--concurrency", type=int, default=10, help="Number of concurrent SNS requests.")
+        parser.add_argument("--rate", type=float, default=20, help="Maximum SNS requests per second, 0 for no limit.")
+        parser.add_argument("--start-id", type=int, default=None, help="Resume from this primary key.")
+        parser.add_argument("--dry-run", action="store_true", help="Only count the devices to move.")
+
+    def handle(self, *args, **options):
+        device_model = get_device_model()
+        devices = device_model._default_manager.filter(sns_platform_endpoint_arn__isnull=False)
+        moved = 0
+
+        for lower, upper in iter_pk_ranges(devices, options["batch_size"], start_pk=options["start_id"]):
+            batch = devices.filter(pk__gte=lower, pk__lt=upper).only("pk", "user_id", "platform", "sns_platform_endpoint_arn", "sns_shard")
+            misplaced = [device for device in batch if (device.sns_shard or DEFAULT_SHARD) != assign_shard(device.pk)]
+            if not misplaced or options["dry_run"]:
+                moved += len(misplaced)
+                continue
+
+            results = run_concurrently(
+                self.delete_endpoint,
+                misplaced,
+                concurrency=options["concurrency"],
+                rate=options["rate"],
+            )
+            device_ids = []
+            for device, _, exc in results:
+                if exc is not None:
+                    self.stderr.write("Could not delete the endpoint of device %s: %s" % (device.pk, exc))
+                else:
+                    device_ids.append(device.pk)
+
+            # The endpoints are created in the assigned shards on the next push, or by sloop_create_endpoints.
+            device_model._default_manager.filter(pk__in=device_ids).update(sns_platform_endpoint_arn=None, sns_shard="")
+            invalidate_active_devices([device.user_id for device in misplaced])
+            moved += len(device_ids)
+            self.stdout.write("Moved %d devices, resume with --start-id %d" % (moved, upper))
+
+        if options["dry_run"]:
+            self.stdout.write("%d devices would be moved." % moved)
+        else:
+            self.stdout.write("Moved %d devices in total. Run sloop_create_endpoints to create their new endpoints." % moved)
+
+    def delete_endpoint(self, device):
+        # Endpoints of shards that are no longer configured are deleted with the top level credentials, in their region.
+        SNSHandler(device, shard=device.sns_shard or DEFAULT_SHARD).client.delete_endpoint(EndpointArn=device.sns_platform_endpoint_arn)
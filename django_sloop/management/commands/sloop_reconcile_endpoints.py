@@ -0,0 +1,99 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from django_sloop.cache import invalidate_active_devices
+from django_sloop.handlers import SNSHandler
+from django_sloop.sharding import get_shards
+from django_sloop.utils import get_device_model, run_concurrently
+
+
+class Command(BaseCommand):
+    help = "Compares the SNS endpoints of the platform applications with the devices and fixes the devices."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report the differences.")
+        parser.add_argument("--delete-orphans", action="store_true", help="Delete SNS endpoints that do not belong to any device.")
+        parser.add_argument("--concurrency", type=int, default=10, help="Number of concurrent endpoint deletions.")
+        parser.add_argument("--rate", type=float, default=20, help="Maximum endpoint deletions per second, 0 for no limit.")
+
+    def handle(self, *args, **options):
+        device_model = get_device_model()
+        self.totals = dict(endpoints=0, invalidated=0, detached=0, orphans=0, deleted_orphans=0)
+
+        for shard in sorted(get_shards()):
+            for platform, platform_name in device_model.PLATFORM_CHOICES:
+                handler = SNSHandler(device_model(platform=platform), shard=shard)
+                if not handler.application_arn:
+                    continue
+
+                self.stdout.write("Reconciling %s endpoints of %s" % (platform_name, handler.application_arn))
+                for endpoints in self.iter_endpoint_pages(handler):
+                    self.reconcile_endpoints(handler, endpoints, options)
+
+        self.stdout.write(
+            "%(endpoints)d endpoints checked, %(invalidated)d devices invalidated, %(detached)d devices detached "
+            "from endpoints with another token, %(orphans)d orphaned endpoints, %(deleted_orphans)d deleted." % self.totals
+        )
+
+    def iter_endpoint_pages(self, handler):
+        kwargs = {"PlatformApplicationArn": handler.application_arn}
+        while True:
+            response = handler.client.list_endpoints_by_platform_application(**kwargs)
+            yield response.get("Endpoints", [])
+
+            if not response.get("NextToken"):
+                break
+            kwargs["NextToken"] = response["NextToken"]
+
+    def reconcile_endpoints(self, handler, endpoints, options):
+        device_model = get_device_model()
+        devices = device_model._default_manager.filter(sns_platform_endpoint_arn__in=[endpoint["EndpointArn"] for endpoint in endpoints])
+        devices_by_arn = {
+            device["sns_platform_endpoint_arn"]: device
+            for device in devices.values("pk", "user_id", "push_token", "deleted_at", "sns_platform_endpoint_arn")
+        }
+
+        disabled_devices = []
+        detached_devices = []
+        orphan_arns = []
+        for endpoint in endpoints:
+            endpoint_arn = endpoint["EndpointArn"]
+            attributes = endpoint.get("Attributes", {})
+            device = devices_by_arn.get(endpoint_arn)
+
+            if device is None:
+                orphan_arns.append(endpoint_arn)
+            elif attributes.get("Token") != device["push_token"]:
+                # The endpoint points to another token, the device gets a new endpoint on its next push.
+                detached_devices.append(device)
+                orphan_arns.append(endpoint_arn)
+            elif attributes.get("Enabled") == "false" and device["deleted_at"] is None:
+                disabled_devices.append(device)
+
+        self.totals["endpoints"] += len(endpoints)
+        self.totals["invalidated"] += len(disabled_devices)
+        self.totals["detached"] += len(detached_devices)
+        self.totals["orphans"] += len(orphan_arns)
+
+        if options["dry_run"]:
+            return
+
+        manager = device_model._default_manager
+        if disabled_devices:
+            manager.filter(pk__in=[device["pk"] for device in disabled_devices]).update(deleted_at=timezone.now())
+        if detached_devices:
+            manager.filter(pk__in=[device["pk"] for device in detached_devices]).update(sns_platform_endpoint_arn=None, sns_shard="")
+        invalidate_active_devices([device["user_id"] for device in disabled_devices + detached_devices])
+
+        if options["delete_orphans"] and orphan_arns:
+            results = run_concurrently(
+                lambda endpoint_arn: handler.client.delete_endpoint(EndpointArn=endpoint_arn),
+                orphan_arns,
+                concurrency=options["concurrency"],
+                rate=options["rate"],
+            )
+            for endpoint_arn, _, exc in results:
+                if exc is not None:
+                    self.stderr.write("Could not delete endpoint %s: %s" % (endpoint_arn, exc))
+                else:
+                    self.totals["deleted_orphans"] += 1
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from django_sloop.tasks import relay_push_outbox
+
+
+class Command(BaseCommand):
+    help = "Moves the notifications in the push outbox to Celery."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None, help="Number of notifications per batch task.")
+
+    def handle(self, *args, **options):
+        self.stdout.write(relay_push_outbox(batch_size=options["batch_size"]))
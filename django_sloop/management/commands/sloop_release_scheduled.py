@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from django_sloop.tasks import release_scheduled_pushes
+
+
+class Command(BaseCommand):
+    help = "Sends the scheduled push notifications that are due."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None, help="Number of notifications per batch task.")
+        parser.add_argument("--spread", type=float, default=None, help="Seconds to spread the batch tasks over.")
+
+    def handle(self, *args, **options):
+        self.stdout.write(release_scheduled_pushes(batch_size=options["batch_size"], spread=options["spread"]))
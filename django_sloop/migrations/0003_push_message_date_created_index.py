@@ -0,0 +1,37 @@
+# Generated by Django 4.2.30 on 2026-10-19 10:57
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class AlterFieldConcurrently(migrations.AlterField):
+    """
+    Builds the index of the field with CREATE INDEX CONCURRENTLY on PostgreSQL, so writes to the push message
+    table are not blocked while it is built. Other databases alter the field as usual.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != "postgresql":
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            field = model._meta.get_field(self.name)
+            schema_editor.execute(schema_editor._create_index_sql(model, fields=[field], concurrently=True))
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY cannot run in a transaction.
+    atomic = False
+
+    dependencies = [
+        ('django_sloop', '0002_change_meta'),
+    ]
+
+    operations = [
+        AlterFieldConcurrently(
+            model_name='pushmessage',
+            name='date_created',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-19 11:09
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_sloop', '0004_push_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledPush',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('notification', models.TextField()),
+                ('deliver_at', models.DateTimeField(db_index=True)),
+                ('date_created', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'Scheduled Push',
+                'verbose_name_plural': 'Scheduled Pushes',
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-19 11:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+from django_sloop.settings import DJANGO_SLOOP_SETTINGS
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(DJANGO_SLOOP_SETTINGS["DEVICE_MODEL"]),
+        ('django_sloop', '0005_scheduled_push'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushSpool',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('body', models.TextField(blank=True)),
+                ('data', models.TextField()),
+                ('message_attributes', models.TextField(blank=True)),
+                ('date_created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=DJANGO_SLOOP_SETTINGS["DEVICE_MODEL"])),
+            ],
+            options={
+                'verbose_name': 'Push Spool Entry',
+                'verbose_name_plural': 'Push Spool',
+            },
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.30 on 2026-10-19 11:23
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_sloop', '0008_broadcast'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Segment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('filters', models.TextField(blank=True, help_text='JSON object of device lookups, e.g. {"platform": "ios", "locale": "tr_TR"}.')),
+                ('active_days', models.PositiveIntegerField(blank=True, help_text='Only devices updated within this many days.', null=True)),
+                ('device_ids', models.BinaryField(default=b'')),
+                ('device_count', models.PositiveIntegerField(default=0, editable=False)),
+                ('date_created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('date_materialized', models.DateTimeField(blank=True, editable=False, null=True)),
+            ],
+            options={
+                'verbose_name': 'Segment',
+                'verbose_name_plural': 'Segments',
+            },
+        ),
+        migrations.CreateModel(
+            name='SegmentChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device_id', models.BigIntegerField()),
+                ('date_created', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'Segment Change',
+                'verbose_name_plural': 'Segment Changes',
+            },
+        ),
+    ]
@@ -1,16 +1,32 @@
+import datetime
+import hashlib
+import itertools
 import json
+from array import array
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.contrib.gis.db import models
+from django.db import models
+from django.db.models.signals import class_prepared
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connections, router, transaction
 from django.utils import timezone
 from django.utils.encoding import smart_str
 from django.utils.translation import gettext_lazy as _
 from django.template.defaultfilters import truncatechars
 
 from django_sloop.exceptions import DeviceIsNotActive
+from .cache import dump_active_device, get_active_device_cache_key, get_cache, invalidate_active_devices, load_active_device
+from .capping import FREQUENCY_CAP_DEFER, apply_frequency_cap, defer_notification
+from .dispatch import (
+    PRIORITY_BULK, PUSH_NOTIFICATION, SILENT_PUSH_NOTIFICATION, build_notification, coalesce_notification, create_campaign,
+    enqueue_campaign_rows, enqueue_notification, schedule_notification
+)
+from .dryrun import DryRunReport
+from .routing import ausing_read_database, bind_to_primary, mark_recent_writes, using_read_database
+from .segments import apply_device_changes, decode_device_ids, encode_device_ids, queue_segment_updates
 from .settings import DJANGO_SLOOP_SETTINGS
-from . import tasks
+from .utils import chunked, get_delivery_time, get_device_model, get_locale_timezone, render_localized_message, render_localized_messages
 
 
 class PushNotificationMixin(object):
@@ -21,57 +37,240 @@ class PushNotificationMixin(object):
     def get_badge_count(self):
         return 0
 
+    def get_push_timezone(self, device):
+        """
+        Returns the name of the timezone that scheduled notifications with a local time of day are delivered in.
+        """
+        return get_locale_timezone(device.locale)
+
     def get_active_pushable_device(self):
         """
         Finds and returns the last active device with push token for this user, if available
+
+        When ACTIVE_DEVICE_CACHE_TIMEOUT is set, the device is served from the cache with only its id, platform
+        and endpoint loaded; the remaining fields are deferred.
+
+        The device is read from READ_DATABASE unless the user changed a device within READ_YOUR_WRITES_TIMEOUT seconds.
+        """
+        timeout = DJANGO_SLOOP_SETTINGS["ACTIVE_DEVICE_CACHE_TIMEOUT"]
+        if timeout:
+            cache = get_cache()
+            cache_key = get_active_device_cache_key(self.pk)
+            cached_device = cache.get(cache_key)
+            if cached_device is not None:
+                return load_active_device(cached_device)
+
+        try:
+            device = bind_to_primary(using_read_database(self._get_active_devices(), user_id=self.pk).first())
+        except ObjectDoesNotExist:
+            return None
+
+        if timeout:
+            cache.set(cache_key, dump_active_device(device), timeout)
+        return device
+
+    async def aget_active_pushable_device(self):
         """
+        Like get_active_pushable_device(), with the async cache and ORM APIs.
+        """
+        timeout = DJANGO_SLOOP_SETTINGS["ACTIVE_DEVICE_CACHE_TIMEOUT"]
+        if timeout:
+            cache = get_cache()
+            cache_key = get_active_device_cache_key(self.pk)
+            cached_device = await cache.aget(cache_key)
+            if cached_device is not None:
+                return load_active_device(cached_device)
+
         try:
-            device = self.devices.filter(deleted_at__isnull=True).order_by("-date_created").first()
+            device = bind_to_primary(await (await ausing_read_database(self._get_active_devices(), user_id=self.pk)).afirst())
         except ObjectDoesNotExist:
             return None
+
+        if timeout:
+            await cache.aset(cache_key, dump_active_device(device), timeout)
         return device
 
-    def send_push_notification_async(self, message, url=None, sound=None, extra=None, category=None, **kwargs):
+    def _get_active_devices(self):
+        # Filtered by user_id rather than self.devices, which would relate the replica rows to this instance.
+        return get_device_model()._default_manager.filter(user_id=self.pk, deleted_at__isnull=True).order_by("-date_created")
+
+    def send_push_notification_async(self, message, url=None, sound=None, extra=None, category=None, idempotency_key=None, collapse_key=None, priority_class=None, deliver_at=None,
+                                     dry_run=False, **kwargs):
+        """
+        Sends a push notification to the user's last active device
+
+        A notification with an idempotency_key is sent at most once to the device within IDEMPOTENCY_KEY_TTL seconds,
+        even if its task is delivered more than once.
+
+        Notifications with the same collapse_key replace each other on the device. When COALESCE_WINDOW is set,
+        they are also buffered for that many seconds and sent as a single summarized notification.
+
+        priority_class selects the queue of the task, see dispatch.PRIORITY_CLASSES. Defaults to transactional.
+
+        deliver_at schedules the notification, either at an aware datetime or at the next occurrence of
+        a datetime.time in the timezone returned by get_push_timezone().
+
+        Returns False if the user has no active device or the notification was dropped by FREQUENCY_CAPS.
+
+        With dry_run, the payload is built and a DryRunReport is returned instead, without counting the notification
+        against FREQUENCY_CAPS.
+        """
         device = self.get_active_pushable_device()
         if not device:
             return False
+        return self._send_push_notification(device, message, url, sound, extra, category, idempotency_key, collapse_key, priority_class, deliver_at, dry_run, **kwargs)
+
+    async def asend_push_notification(self, message, url=None, sound=None, extra=None, category=None, idempotency_key=None, collapse_key=None, priority_class=None,
+                                      deliver_at=None, dry_run=False, **kwargs):
+        """
+        Like send_push_notification_async(), for async views. The device is looked up with the async ORM, the
+        rest runs in a single sync_to_async() call, since Celery publishes to the broker synchronously.
+        """
+        device = await self.aget_active_pushable_device()
+        if not device:
+            return False
+        return await sync_to_async(self._send_push_notification)(
+            device, message, url, sound, extra, category, idempotency_key, collapse_key, priority_class, deliver_at, dry_run, **kwargs
+        )
+
+    def _send_push_notification(self, device, message, url, sound, extra, category, idempotency_key, collapse_key, priority_class, deliver_at, dry_run, **kwargs):
+        sound = sound or DJANGO_SLOOP_SETTINGS.get("DEFAULT_SOUND") or None
+        if dry_run:
+            report = DryRunReport()
+            report.add(device.platform, device.build_push_notification_payload(message, url, self.get_badge_count(), sound, extra, category, collapse_key=collapse_key, **kwargs))
+            return report
 
         # Print message to console if this is a development environment.
         if settings.DEBUG:
             print("Push notification: %s / Receiver: %s" % (message, self))
 
-        sound = sound or DJANGO_SLOOP_SETTINGS.get("DEFAULT_SOUND") or None
-
-        tasks.send_push_notification.delay(
+        notification = build_notification(
+            PUSH_NOTIFICATION,
             device.id,
-            message,
-            url,
-            self.get_badge_count(),
-            sound,
-            extra,
-            category,
-            **kwargs
+            (message, url, self.get_badge_count(), sound, extra, category),
+            dict(kwargs, idempotency_key=idempotency_key, collapse_key=collapse_key),
+            priority_class=priority_class
         )
-
-    def send_silent_push_notification_async(self, extra=None, content_available=True, **kwargs):
+        if deliver_at is not None:
+            deliver_at = get_delivery_time(deliver_at, self.get_push_timezone(device))
+
+        if deliver_at is not None:
+            # Counted against FREQUENCY_CAPS when it is delivered, not when it is scheduled.
+            defer_notification(notification, self.pk, category=category)
+        else:
+            allowed_user_ids, retry_at = apply_frequency_cap([self.pk], category=category, priority_class=notification["priority_class"])
+            if not allowed_user_ids:
+                if DJANGO_SLOOP_SETTINGS["FREQUENCY_CAP_ACTION"] != FREQUENCY_CAP_DEFER:
+                    return False
+                defer_notification(notification, self.pk, category=category)
+                deliver_at = retry_at
+
+        if deliver_at is not None:
+            schedule_notification(notification, deliver_at)
+        elif collapse_key and DJANGO_SLOOP_SETTINGS["COALESCE_WINDOW"]:
+            coalesce_notification(notification, collapse_key)
+        else:
+            enqueue_notification(notification)
+
+    def send_silent_push_notification_async(self, extra=None, content_available=True, idempotency_key=None, priority_class=None, deliver_at=None, dry_run=False, **kwargs):
         """
         Sends a push notification to the user's last active device
         """
-        # Print message to console if this is a development environment.
-        if settings.DEBUG:
-            print("Silent push notification to: %s" % self)
-
         device = self.get_active_pushable_device()
         if not device:
             return False
+        return self._send_silent_push_notification(device, extra, content_available, idempotency_key, priority_class, deliver_at, dry_run, **kwargs)
+
+    async def asend_silent_push_notification(self, extra=None, content_available=True, idempotency_key=None, priority_class=None, deliver_at=None, dry_run=False, **kwargs):
+        """
+        Like send_silent_push_notification_async(), for async views.
+        """
+        device = await self.aget_active_pushable_device()
+        if not device:
+            return False
+        return await sync_to_async(self._send_silent_push_notification)(
+            device, extra, content_available, idempotency_key, priority_class, deliver_at, dry_run, **kwargs
+        )
+
+    def _send_silent_push_notification(self, device, extra, content_available, idempotency_key, priority_class, deliver_at, dry_run, **kwargs):
+        if dry_run:
+            report = DryRunReport()
+            report.add(device.platform, device.build_silent_push_notification_payload(extra, self.get_badge_count(), content_available, **kwargs))
+            return report
+
+        # Print message to console if this is a development environment.
+        if settings.DEBUG:
+            print("Silent push notification to: %s" % self)
 
-        tasks.send_silent_push_notification.delay(
+        notification = build_notification(
+            SILENT_PUSH_NOTIFICATION,
             device.id,
-            extra,
-            self.get_badge_count(),
-            content_available,
-            **kwargs
+            (extra, self.get_badge_count(), content_available),
+            dict(kwargs, idempotency_key=idempotency_key),
+            priority_class=priority_class
         )
+        if deliver_at is not None:
+            deliver_at = get_delivery_time(deliver_at, self.get_push_timezone(device))
+
+        if deliver_at is not None:
+            # Counted against FREQUENCY_CAPS when it is delivered, not when it is scheduled.
+            defer_notification(notification, self.pk)
+        else:
+            allowed_user_ids, retry_at = apply_frequency_cap([self.pk], priority_class=notification["priority_class"])
+            if not allowed_user_ids:
+                if DJANGO_SLOOP_SETTINGS["FREQUENCY_CAP_ACTION"] != FREQUENCY_CAP_DEFER:
+                    return False
+                defer_notification(notification, self.pk)
+                deliver_at = retry_at
+
+        if deliver_at is not None:
+            schedule_notification(notification, deliver_at)
+        else:
+            enqueue_notification(notification)
+
+
+class SNSDeviceQuerySet(models.QuerySet):
+
+    def active(self):
+        return self.filter(deleted_at__isnull=True)
+
+    def send_push_notification_async(self, message, url=None, sound=None, extra=None, category=None, context=None,
+                                     priority_class=PRIORITY_BULK, batch_size=None, deliver_at=None, dry_run=False, **kwargs):
+        """
+        Sends a push notification to every active device in the queryset through batch tasks.
+
+        message is either a string or a dict of Django template sources keyed by locale, language or "default".
+        Devices are grouped by locale, so each template is rendered with context once per locale.
+        Users over their FREQUENCY_CAPS are skipped. The payload is stored once in a Campaign and the batch tasks
+        only carry its id and the device ids. Returns the number of notifications enqueued.
+
+        deliver_at schedules the batches in ScheduledPush rows, either at an aware datetime or at the next occurrence
+        of a datetime.time in the LOCALE_TIMEZONES timezone of each device. FREQUENCY_CAPS are applied on delivery.
+
+        With dry_run, nothing is enqueued and a DryRunReport is returned. The devices are counted per locale and
+        platform in the database and one payload is built for each pair, so the devices are never loaded.
+        FREQUENCY_CAPS are not applied.
+        """
+        batch_size = batch_size or DJANGO_SLOOP_SETTINGS["CAMPAIGN_BATCH_SIZE"]
+        sound = sound or DJANGO_SLOOP_SETTINGS.get("DEFAULT_SOUND") or None
+        devices = using_read_database(self.active().order_by())
+
+        if dry_run:
+            report = DryRunReport()
+            for row in devices.values("locale", "platform").annotate(count=models.Count("pk")):
+                device = self.model(locale=row["locale"], platform=row["platform"])
+                localized_message = render_localized_message(message, row["locale"], context)
+                report.add(row["platform"], device.build_push_notification_payload(localized_message, url, None, sound, extra, category, **kwargs), row["count"])
+            return report
+
+        # Every locale is rendered before anything is stored or enqueued, so a missing template fails the whole send.
+        # Plain messages are sent to every locale under "".
+        localized = isinstance(message, dict)
+        locales = devices.values_list("locale", flat=True).distinct() if localized else [""]
+        campaign = create_campaign(render_localized_messages(message, locales, context), url, sound, extra, category, kwargs, priority_class=priority_class)
+
+        rows = devices.order_by("pk").values_list("pk", "user_id", "locale").iterator()
+        return enqueue_campaign_rows(campaign, rows, batch_size, localized=localized, category=category, priority_class=priority_class, deliver_at=deliver_at)
 
 
 class AbstractSNSDevice(models.Model):
@@ -90,18 +289,30 @@ class AbstractSNSDevice(models.Model):
     platform = models.CharField(max_length=255, choices=PLATFORM_CHOICES)
     model = models.CharField(max_length=255, blank=True)
     sns_platform_endpoint_arn = models.CharField(_("SNS Platform Endpoint"), max_length=255, null=True, blank=True, unique=True)
+    sns_shard = models.CharField(_("SNS Shard"), max_length=64, blank=True, default="")
 
     deleted_at = models.DateTimeField(null=True, blank=True)
 
     date_created = models.DateTimeField(default=timezone.now)
     date_updated = models.DateTimeField(auto_now=True)
 
+    objects = SNSDeviceQuerySet.as_manager()
+
     class Meta:
         verbose_name = _("Device")
         verbose_name_plural = _("Devices")
         unique_together = ("push_token", "platform")
         ordering = ("-date_updated",)
         get_latest_by = "date_updated"
+        indexes = [
+            # Covers get_active_pushable_device(); only active devices are indexed.
+            # Names over MAX_INDEX_NAME_LENGTH are shortened by shorten_active_device_index_name().
+            models.Index(
+                fields=["user", "date_created"],
+                name="%(app_label)s_%(class)s_active",
+                condition=models.Q(deleted_at__isnull=True),
+            ),
+        ]
         abstract = True
 
     def __str__(self):
@@ -114,30 +325,182 @@ class AbstractSNSDevice(models.Model):
         self.deleted_at = timezone.now()
         self.save()
 
+    async def ainvalidate(self):
+        self.deleted_at = timezone.now()
+        await self.asave()
+
+    @classmethod
+    def upsert_devices(cls, devices, batch_size=1000):
+        """
+        Inserts the given unsaved devices, or updates the rows with the same push token and platform,
+        with a single INSERT ... ON CONFLICT statement per batch when the database supports it.
+        Re-registered devices are revived and their endpoints are refreshed in a task after the commit.
+        With CREATE_ENDPOINTS_ON_REGISTRATION, the endpoints of the devices without one are created the same way.
+        Signals are not sent, the active device cache of the affected users is invalidated, their reads are sent
+        to the primary database and the segment updates are queued instead.
+        Of the devices with the same push token and platform, the last one is kept.
+        """
+        manager = cls._default_manager
+        connection = connections[router.db_for_write(cls)]
+
+        # PostgreSQL rejects an INSERT ... ON CONFLICT that updates the same row twice.
+        devices = list(dict(((device.push_token, device.platform), device) for device in devices).values())
+
+        registered = set((device.push_token, device.platform) for device in devices)
+        existing_devices = manager.filter(push_token__in=[push_token for push_token, platform in registered]).values_list(
+            "pk", "user_id", "push_token", "platform", "deleted_at", "sns_platform_endpoint_arn"
+        )
+        user_ids = [device.user_id for device in devices]
+        revived_device_ids = []
+        for pk, user_id, push_token, platform, deleted_at, endpoint_arn in existing_devices:
+            if (push_token, platform) not in registered:
+                continue
+            # Push tokens may move between users, their previous owners lose the device.
+            user_ids.append(user_id)
+            if deleted_at and endpoint_arn:
+                revived_device_ids.append(pk)
+
+        if getattr(connection.features, "supports_update_conflicts_with_target", False):
+            manager.bulk_create(
+                devices,
+                batch_size=batch_size,
+                update_conflicts=True,
+                unique_fields=["push_token", "platform"],
+                update_fields=["user", "locale", "model", "deleted_at", "date_updated"],
+            )
+        else:
+            for device in devices:
+                manager.update_or_create(
+                    push_token=device.push_token,
+                    platform=device.platform,
+                    defaults={
+                        "user_id": device.user_id,
+                        "locale": device.locale,
+                        "model": device.model,
+                        "deleted_at": device.deleted_at,
+                    }
+                )
+
+        invalidate_active_devices(user_ids)
+        mark_recent_writes(user_ids)
+        cls.refresh_platform_endpoints_on_commit(revived_device_ids)
+        if DJANGO_SLOOP_SETTINGS["SEGMENTS_ENABLED"] or DJANGO_SLOOP_SETTINGS["CREATE_ENDPOINTS_ON_REGISTRATION"]:
+            upserted_devices = [
+                (pk, endpoint_arn)
+                for pk, push_token, platform, endpoint_arn in manager.filter(push_token__in=[push_token for push_token, platform in registered]).values_list(
+                    "pk", "push_token", "platform", "sns_platform_endpoint_arn"
+                )
+                if (push_token, platform) in registered
+            ]
+            if DJANGO_SLOOP_SETTINGS["SEGMENTS_ENABLED"]:
+                queue_segment_updates([pk for pk, endpoint_arn in upserted_devices])
+            if DJANGO_SLOOP_SETTINGS["CREATE_ENDPOINTS_ON_REGISTRATION"]:
+                cls.create_platform_endpoints_on_commit([pk for pk, endpoint_arn in upserted_devices if not endpoint_arn])
+
+    @classmethod
+    def create_platform_endpoints_on_commit(cls, device_ids, batch_size=100):
+        from . import tasks
+
+        for index in range(0, len(device_ids), batch_size):
+            batch = device_ids[index:index + batch_size]
+            transaction.on_commit(lambda batch=batch: tasks.create_platform_endpoints.delay(batch))
+
+    @classmethod
+    def refresh_platform_endpoints_on_commit(cls, device_ids, batch_size=100):
+        from . import tasks
+
+        for index in range(0, len(device_ids), batch_size):
+            batch = device_ids[index:index + batch_size]
+            transaction.on_commit(lambda batch=batch: tasks.refresh_platform_endpoints.delay(batch))
+
+    def change_push_token(self, push_token):
+        """
+        Moves the device and its SNS endpoint to a new push token.
+        """
+        self.push_token = push_token
+        self.deleted_at = None
+        self.save()
+        if self.sns_platform_endpoint_arn:
+            self.refresh_platform_endpoints_on_commit([self.pk])
+        elif DJANGO_SLOOP_SETTINGS["CREATE_ENDPOINTS_ON_REGISTRATION"]:
+            self.create_platform_endpoints_on_commit([self.pk])
+
     def prepare_message(self, message):
         """
         Prepares message before sending.
         """
         return truncatechars(message, 255)
 
-    def send_push_notification(self, message, url=None, badge_count=None, sound=None, extra=None, category=None, **kwargs):
+    def prepare_coalesced_message(self, message, count, collapse_key):
+        """
+        Summarizes the notifications coalesced with the same collapse key, message is the last one of them.
+        """
+        if count == 1:
+            return message
+        return DJANGO_SLOOP_SETTINGS["COALESCED_MESSAGE_FORMAT"] % {
+            "message": message,
+            "count": count,
+            "collapse_key": collapse_key,
+        }
+
+    def build_push_notification_payload(self, message, url=None, badge_count=None, sound=None, extra=None, category=None, collapse_key=None, **kwargs):
         """
-        Sends push message using device push token
+        Returns the payload send_push_notification() would publish, extra is not modified.
+        """
+        from .handlers import SNSHandler
+
+        extra = dict(extra) if extra else extra
+        data, _ = SNSHandler(device=self).build_push_notification(self.prepare_message(message), url, badge_count, sound, extra, category, collapse_key=collapse_key, **kwargs)
+        return data
+
+    def build_silent_push_notification_payload(self, extra=None, badge_count=None, content_available=None, **kwargs):
+        from .handlers import SNSHandler
+
+        return SNSHandler(device=self).build_silent_push_notification(extra, badge_count, content_available, **kwargs)
+
+    def send_push_notification(self, message, url=None, badge_count=None, sound=None, extra=None, category=None, idempotency_key=None, collapse_key=None, dry_run=False, **kwargs):
+        """
+        Sends push message using device push token, or returns a DryRunReport of the payload with dry_run.
         """
         from .handlers import SNSHandler
 
         if self.deleted_at:
             raise DeviceIsNotActive
 
+        if dry_run:
+            report = DryRunReport()
+            report.add(self.platform, self.build_push_notification_payload(message, url, badge_count, sound, extra, category, collapse_key=collapse_key, **kwargs))
+            return report
+
         message = self.prepare_message(message)
 
         handler = SNSHandler(device=self)
-        message_payload, response = handler.send_push_notification(message, url, badge_count, sound, extra, category, **kwargs)
+        message_payload, response = handler.send_push_notification(message, url, badge_count, sound, extra, category, idempotency_key=idempotency_key, collapse_key=collapse_key, **kwargs)
+        return self.log_push_message(message_payload, response, body=message)
+
+    def send_push_message(self, message_payload, message_attributes=None, body="", handler=None):
+        """
+        Publishes a payload built by SNSHandler.build_push_notification() and serialized beforehand,
+        so bulk sends can build it once for many devices.
+        """
+        from .handlers import SNSHandler
+
+        if self.deleted_at:
+            raise DeviceIsNotActive
+
+        handler = handler or SNSHandler(device=self)
+        message_payload, response = handler.send_message(message_payload, message_attributes=message_attributes, body=body)
+        return self.log_push_message(message_payload, response, body=body)
+
+    def log_push_message(self, message_payload, response, body=""):
+        if response is None:
+            # Already sent with the same idempotency key, or spooled until SNS recovers.
+            return None
 
         if DJANGO_SLOOP_SETTINGS["LOG_SENT_MESSAGES"]:
             PushMessage.objects.create(
                 device=self,
-                body=message,
+                body=body,
                 data=message_payload,
                 sns_message_id=response.get("MessageId") or None,  # Can be null for failed message.
                 sns_response=json.dumps(response)
@@ -145,27 +508,41 @@ class AbstractSNSDevice(models.Model):
 
         return response
 
-    def send_silent_push_notification(self, extra=None, badge_count=None, content_available=None, **kwargs):
+    def send_silent_push_notification(self, extra=None, badge_count=None, content_available=None, idempotency_key=None, dry_run=False, **kwargs):
         """
-        Sends silent push notification
+        Sends silent push notification, or returns a DryRunReport of the payload with dry_run.
         """
         from .handlers import SNSHandler
 
         if self.deleted_at:
             raise DeviceIsNotActive
 
+        if dry_run:
+            report = DryRunReport()
+            report.add(self.platform, self.build_silent_push_notification_payload(extra, badge_count, content_available, **kwargs))
+            return report
+
         handler = SNSHandler(device=self)
-        message_payload, response = handler.send_silent_push_notification(extra, badge_count, content_available, **kwargs)
+        message_payload, response = handler.send_silent_push_notification(extra, badge_count, content_available, idempotency_key=idempotency_key, **kwargs)
+        return self.log_push_message(message_payload, response)
 
-        if DJANGO_SLOOP_SETTINGS["LOG_SENT_MESSAGES"]:
-            PushMessage.objects.create(
-                device=self,
-                data=message_payload,
-                sns_message_id=response.get("MessageId") or None,  # Can be null for failed message.
-                sns_response=json.dumps(response)
-            )
 
-        return response
+MAX_INDEX_NAME_LENGTH = 30
+
+
+def shorten_active_device_index_name(sender, **kwargs):
+    """
+    Replaces the active device index name of device models whose app label and class name make it longer
+    than Django allows with a fixed-length name derived from the model label.
+    """
+    if not issubclass(sender, AbstractSNSDevice) or sender._meta.abstract:
+        return
+    for index in sender._meta.indexes:
+        if index.name.endswith("_active") and len(index.name) > MAX_INDEX_NAME_LENGTH:
+            index.name = "sloop_active_%s" % hashlib.md5(sender._meta.label_lower.encode("utf-8")).hexdigest()[:10]
+
+
+class_prepared.connect(shorten_active_device_index_name, dispatch_uid="sloop_shorten_active_device_index_name")
 
 
 class PushMessage(models.Model):
@@ -176,9 +553,218 @@ class PushMessage(models.Model):
     sns_message_id = models.CharField(max_length=255, unique=True, blank=True, null=True)
     sns_response = models.TextField()
 
-    date_created = models.DateTimeField(default=timezone.now)
+    date_created = models.DateTimeField(default=timezone.now, db_index=True)
     date_updated = models.DateTimeField(auto_now=True)
 
     class Meta:
         verbose_name = "Push Message"
         verbose_name_plural = "Push Messages"
+
+
+class Campaign(models.Model):
+    """
+    The payload shared by the notifications of a bulk send, so the batch tasks only carry the campaign id and device ids.
+    """
+
+    payload = models.TextField()
+    priority_class = models.CharField(max_length=32, blank=True)
+
+    date_created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = "Campaign"
+        verbose_name_plural = "Campaigns"
+
+
+class Broadcast(models.Model):
+    """
+    A campaign sent by the sloop_broadcast command, split into primary key ranges that checkpoint their progress.
+    """
+
+    campaign = models.ForeignKey(Campaign, related_name="broadcasts", on_delete=models.CASCADE)
+    filters = models.TextField(blank=True)
+
+    date_created = models.DateTimeField(default=timezone.now)
+    date_completed = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Broadcast"
+        verbose_name_plural = "Broadcasts"
+
+
+class BroadcastRange(models.Model):
+    """
+    Devices with lower_pk <= pk < upper_pk of a broadcast. last_pk is the last device the range was sent to.
+    """
+
+    broadcast = models.ForeignKey(Broadcast, related_name="ranges", on_delete=models.CASCADE)
+    lower_pk = models.BigIntegerField()
+    upper_pk = models.BigIntegerField()
+    last_pk = models.BigIntegerField(null=True, blank=True)
+    sent = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+
+    date_updated = models.DateTimeField(auto_now=True)
+    date_completed = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Broadcast Range"
+        verbose_name_plural = "Broadcast Ranges"
+        unique_together = ("broadcast", "lower_pk")
+
+
+class Segment(models.Model):
+    """
+    A reusable audience of active devices, defined by device lookups and the recency of their registration.
+    The ids of the matching devices are kept as a compressed sorted array, see segments.encode_device_ids().
+    """
+
+    name = models.CharField(max_length=100, unique=True)
+    filters = models.TextField(blank=True, help_text="JSON object of device lookups, e.g. {\"platform\": \"ios\", \"locale\": \"tr_TR\"}.")
+    active_days = models.PositiveIntegerField(null=True, blank=True, help_text="Only devices updated within this many days.")
+    device_ids = models.BinaryField(default=b"", editable=False)
+    device_count = models.PositiveIntegerField(default=0, editable=False)
+
+    date_created = models.DateTimeField(default=timezone.now)
+    date_materialized = models.DateTimeField(null=True, blank=True, editable=False)
+
+    class Meta:
+        verbose_name = "Segment"
+        verbose_name_plural = "Segments"
+
+    def __str__(self):
+        return self.name
+
+    def get_queryset(self):
+        devices = get_device_model()._default_manager.filter(deleted_at__isnull=True, **json.loads(self.filters or "{}"))
+        if self.active_days:
+            devices = devices.filter(date_updated__gte=timezone.now() - datetime.timedelta(days=self.active_days))
+        return devices
+
+    def get_device_ids(self):
+        return decode_device_ids(self.device_ids)
+
+    def set_device_ids(self, device_ids):
+        self.device_ids = encode_device_ids(device_ids)
+        self.device_count = len(device_ids)
+
+    def materialize(self):
+        """
+        Rebuilds the device ids from the filters, which also drops the devices that fell out of active_days.
+        """
+        self.set_device_ids(array("Q", using_read_database(self.get_queryset()).order_by("pk").values_list("pk", flat=True).iterator()))
+        self.date_materialized = timezone.now()
+        self.save(update_fields=["device_ids", "device_count", "date_materialized"])
+
+    def update_devices(self, device_ids):
+        """
+        Adds or removes the given changed devices, with a single query for their current membership.
+        """
+        matched_device_ids = set(self.get_queryset().filter(pk__in=device_ids).values_list("pk", flat=True))
+        segment_device_ids = self.get_device_ids()
+        if apply_device_changes(segment_device_ids, device_ids, matched_device_ids):
+            self.set_device_ids(segment_device_ids)
+            self.save(update_fields=["device_ids", "device_count"])
+
+    def iter_devices(self, fields, chunk_size=10000):
+        """
+        Yields lists of the `fields` of the active devices of the segment, looked up by primary key in chunks
+        that stay within the query parameter limit of the database.
+        """
+        devices = using_read_database(get_device_model()._default_manager.active())
+        max_query_params = connections[devices.db].features.max_query_params
+        for chunk in chunked(self.get_device_ids(), min(chunk_size, max_query_params or chunk_size)):
+            yield list(devices.filter(pk__in=chunk).values_list(*fields))
+
+    def send_push_notification_async(self, message, url=None, sound=None, extra=None, category=None, context=None,
+                                     priority_class=PRIORITY_BULK, batch_size=None, chunk_size=10000, deliver_at=None, dry_run=False, **kwargs):
+        """
+        Sends a push notification to the devices of the segment like SNSDeviceQuerySet.send_push_notification_async(),
+        with a single campaign. Returns the number of notifications enqueued, or a DryRunReport with dry_run.
+        """
+        batch_size = batch_size or DJANGO_SLOOP_SETTINGS["CAMPAIGN_BATCH_SIZE"]
+        sound = sound or DJANGO_SLOOP_SETTINGS.get("DEFAULT_SOUND") or None
+        localized = isinstance(message, dict)
+
+        if dry_run:
+            counts = {}
+            for rows in self.iter_devices(("locale", "platform"), chunk_size):
+                for row in rows:
+                    counts[row] = counts.get(row, 0) + 1
+            report = DryRunReport()
+            for (locale, platform), count in counts.items():
+                device = get_device_model()(locale=locale, platform=platform)
+                localized_message = render_localized_message(message, locale, context)
+                report.add(platform, device.build_push_notification_payload(localized_message, url, None, sound, extra, category, **kwargs), count)
+            return report
+
+        # Plain messages are sent to every locale under "", localized ones are rendered once per locale up front.
+        locales = [""]
+        if localized:
+            locales = set()
+            for rows in self.iter_devices(("locale",), chunk_size):
+                locales.update(locale for locale, in rows)
+        campaign = create_campaign(render_localized_messages(message, locales, context), url, sound, extra, category, kwargs, priority_class=priority_class)
+
+        rows = itertools.chain.from_iterable(self.iter_devices(("pk", "user_id", "locale"), chunk_size))
+        return enqueue_campaign_rows(campaign, rows, batch_size, localized=localized, category=category, priority_class=priority_class, deliver_at=deliver_at)
+
+
+class SegmentChange(models.Model):
+    """
+    Devices saved or deleted since the last segment update, applied by tasks.update_segments.
+    """
+
+    device_id = models.BigIntegerField()
+
+    date_created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = "Segment Change"
+        verbose_name_plural = "Segment Changes"
+
+
+class PushOutbox(models.Model):
+    """
+    Notifications written in the transaction of the sender, relayed to Celery by tasks.relay_push_outbox.
+    """
+
+    notification = models.TextField()
+
+    date_created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = "Push Outbox Entry"
+        verbose_name_plural = "Push Outbox"
+
+
+class ScheduledPush(models.Model):
+    """
+    Notifications waiting for their delivery minute, released by tasks.release_scheduled_pushes.
+    """
+
+    notification = models.TextField()
+    deliver_at = models.DateTimeField(db_index=True)
+
+    date_created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = "Scheduled Push"
+        verbose_name_plural = "Scheduled Pushes"
+
+
+class PushSpool(models.Model):
+    """
+    Payloads that could not be published while the SNS circuit was open, drained by tasks.drain_push_spool.
+    """
+
+    device = models.ForeignKey(DJANGO_SLOOP_SETTINGS["DEVICE_MODEL"], related_name="+", on_delete=models.CASCADE)
+    body = models.TextField(blank=True)
+    data = models.TextField()
+    message_attributes = models.TextField(blank=True)
+
+    date_created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = "Push Spool Entry"
+        verbose_name_plural = "Push Spool"
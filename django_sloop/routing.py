@@ -0,0 +1,103 @@
+from django.db import router
+
+from .cache import get_cache
+from .settings import DJANGO_SLOOP_SETTINGS
+
+
+def get_recent_write_cache_key(user_id):
+    return "sloop:recent-write:%s" % user_id
+
+
+def mark_recent_writes(user_ids):
+    """
+    Sends the device reads of the users to the primary database for READ_YOUR_WRITES_TIMEOUT seconds,
+    so a device is found right after it is registered even if the replica lags behind.
+    """
+    if not DJANGO_SLOOP_SETTINGS["READ_DATABASE"] or not user_ids:
+        return
+    get_cache().set_many(dict((get_recent_write_cache_key(user_id), True) for user_id in set(user_ids)),
+                         DJANGO_SLOOP_SETTINGS["READ_YOUR_WRITES_TIMEOUT"])
+
+
+def get_read_database(model, user_id=None):
+    """
+    Returns READ_DATABASE, or the primary database of the model if it is not set or the user changed a device recently.
+    """
+    alias = DJANGO_SLOOP_SETTINGS["READ_DATABASE"]
+    if not alias:
+        return router.db_for_read(model)
+    if user_id is not None and get_cache().get(get_recent_write_cache_key(user_id)):
+        return router.db_for_write(model)
+    return alias
+
+
+async def aget_read_database(model, user_id=None):
+    """
+    Like get_read_database(), for async code.
+    """
+    alias = DJANGO_SLOOP_SETTINGS["READ_DATABASE"]
+    if not alias:
+        return router.db_for_read(model)
+    if user_id is not None and await get_cache().aget(get_recent_write_cache_key(user_id)):
+        return router.db_for_write(model)
+    return alias
+
+
+def using_read_database(queryset, user_id=None):
+    """
+    Routes the queryset to the read database unless it was given a database explicitly.
+    """
+    if queryset._db is not None:
+        return queryset
+    return queryset.using(get_read_database(queryset.model, user_id))
+
+
+async def ausing_read_database(queryset, user_id=None):
+    """
+    Like using_read_database(), for async code.
+    """
+    if queryset._db is not None:
+        return queryset
+    return queryset.using(await aget_read_database(queryset.model, user_id))
+
+
+def bind_to_primary(instance):
+    """
+    Makes the instances read from the replica save to the primary database, along with the rows related to them.
+    """
+    if instance is not None and DJANGO_SLOOP_SETTINGS["READ_DATABASE"]:
+        instance._state.db = router.db_for_write(type(instance))
+    return instance
+
+
+def get_device(device_id):
+    """
+    Returns the device from the read database, or from the primary database if it is not on the replica yet.
+    """
+    from .utils import get_device_model
+
+    device_model = get_device_model()
+    try:
+        device = using_read_database(device_model.objects.all()).get(id=device_id)
+    except device_model.DoesNotExist:
+        if not DJANGO_SLOOP_SETTINGS["READ_DATABASE"]:
+            raise
+        device = device_model.objects.db_manager(router.db_for_write(device_model)).get(id=device_id)
+    return bind_to_primary(device)
+
+
+def get_devices(device_ids):
+    """
+    Returns the devices by id like in_bulk(), looking the ones missing on the replica up in the primary database.
+    """
+    from .utils import get_device_model
+
+    device_model = get_device_model()
+    devices = using_read_database(device_model.objects.all()).in_bulk(device_ids)
+    if DJANGO_SLOOP_SETTINGS["READ_DATABASE"]:
+        missing_ids = set(device_ids) - set(devices)
+        if missing_ids:
+            devices.update(device_model.objects.db_manager(router.db_for_write(device_model)).in_bulk(missing_ids))
+        for device in devices.values():
+            bind_to_primary(device)
+    return devices
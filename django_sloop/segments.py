@@ -0,0 +1,89 @@
+import zlib
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+
+from django.db import transaction
+
+from .cache import get_cache
+from .settings import DJANGO_SLOOP_SETTINGS
+
+SEGMENT_UPDATE_LOCK_KEY = "sloop:segment-update"
+
+
+def encode_device_ids(device_ids):
+    """
+    Packs sorted device ids as zlib compressed 64 bit deltas, consecutive ids take a few bits each.
+    """
+    deltas = array("Q", (device_id - previous for previous, device_id in zip([0] + list(device_ids[:-1]), device_ids)))
+    return zlib.compress(deltas.tobytes())
+
+
+def decode_device_ids(data):
+    if not data:
+        return array("Q")
+    deltas = array("Q")
+    deltas.frombytes(zlib.decompress(bytes(data)))
+    return array("Q", accumulate(deltas))
+
+
+def apply_device_changes(device_ids, changed_device_ids, matched_device_ids):
+    """
+    Adds the matched and removes the unmatched changed ids from the sorted device_ids array in place.
+    Returns True if the array changed.
+    """
+    changed = False
+    for device_id in sorted(changed_device_ids):
+        index = bisect_left(device_ids, device_id)
+        present = index < len(device_ids) and device_ids[index] == device_id
+        if device_id in matched_device_ids and not present:
+            device_ids.insert(index, device_id)
+            changed = True
+        elif device_id not in matched_device_ids and present:
+            del device_ids[index]
+            changed = True
+    return changed
+
+
+def queue_segment_updates(device_ids):
+    """
+    Queues the devices for update_segments() after the current transaction commits, when SEGMENTS_ENABLED is set.
+    """
+    from .models import SegmentChange
+
+    if not DJANGO_SLOOP_SETTINGS["SEGMENTS_ENABLED"] or not device_ids:
+        return
+
+    SegmentChange.objects.bulk_create([SegmentChange(device_id=device_id) for device_id in device_ids])
+    transaction.on_commit(schedule_segment_update)
+
+
+def schedule_segment_update():
+    """
+    Schedules a single update task for all the device changes committed within SEGMENT_UPDATE_COUNTDOWN seconds.
+    """
+    from . import tasks
+
+    countdown = DJANGO_SLOOP_SETTINGS["SEGMENT_UPDATE_COUNTDOWN"]
+    if get_cache().add(SEGMENT_UPDATE_LOCK_KEY, True, timeout=countdown + 60):
+        tasks.update_segments.apply_async(countdown=countdown)
+
+
+def apply_segment_changes(batch_size):
+    """
+    Applies the queued device changes to every segment, one query per segment and batch.
+    """
+    from .models import Segment, SegmentChange
+
+    updated = 0
+    while True:
+        with transaction.atomic():
+            rows = list(SegmentChange.objects.select_for_update(skip_locked=True).order_by("pk")[:batch_size])
+            if not rows:
+                break
+            device_ids = set(row.device_id for row in rows)
+            for segment_id in Segment.objects.values_list("pk", flat=True):
+                Segment.objects.select_for_update().get(pk=segment_id).update_devices(device_ids)
+            SegmentChange.objects.filter(pk__in=[row.pk for row in rows]).delete()
+        updated += len(device_ids)
+    return updated
@@ -1,3 +1,4 @@
+from django.contrib.auth import get_user_model
 from rest_framework import serializers
 from rest_framework.fields import CurrentUserDefault
 
@@ -11,17 +12,87 @@ class DeviceSerializer(serializers.Serializer):
     platform = serializers.CharField(required=True)
     model = serializers.CharField(required=False, default="")
     locale = serializers.CharField(required=False, default="")
+    previous_push_token = serializers.CharField(required=False, write_only=True)
 
     def create(self, validated_data):
         device_model = get_device_model()
-        user = validated_data["user"]
-        device, created = device_model._default_manager.update_or_create(
-            push_token=validated_data["push_token"],
-            platform=validated_data["platform"],
-            defaults={
-                "user": user,
-                "locale": validated_data.get("locale"),
-                "model": validated_data.get("model")
-            }
-        )
-        return device
+        manager = device_model._default_manager
+
+        previous_push_token = validated_data.get("previous_push_token")
+        if previous_push_token and previous_push_token != validated_data["push_token"]:
+            previous_device = manager.filter(
+                user=validated_data["user"],
+                push_token=previous_push_token,
+                platform=validated_data["platform"],
+            ).first()
+            if previous_device:
+                if manager.filter(push_token=validated_data["push_token"], platform=validated_data["platform"]).exists():
+                    previous_device.invalidate()
+                else:
+                    previous_device.locale = validated_data.get("locale")
+                    previous_device.model = validated_data.get("model")
+                    previous_device.change_push_token(validated_data["push_token"])
+                    return previous_device
+
+        device_model.upsert_devices([
+            device_model(
+                user=validated_data["user"],
+                push_token=validated_data["push_token"],
+                platform=validated_data["platform"],
+                locale=validated_data.get("locale"),
+                model=validated_data.get("model"),
+            )
+        ])
+        return manager.get(push_token=validated_data["push_token"], platform=validated_data["platform"])
+
+
+class BulkDeviceListSerializer(serializers.ListSerializer):
+
+    max_devices = 10000
+    batch_size = 1000
+
+    def validate(self, attrs):
+        if len(attrs) > self.max_devices:
+            raise serializers.ValidationError("At most %d devices can be registered at once." % self.max_devices)
+
+        user_ids = set(item["user_id"] for item in attrs)
+        existing_user_ids = set(get_user_model()._default_manager.filter(pk__in=user_ids).values_list("pk", flat=True))
+        missing_user_ids = user_ids - existing_user_ids
+        if missing_user_ids:
+            raise serializers.ValidationError("Unknown users: %s" % ", ".join(str(user_id) for user_id in sorted(missing_user_ids)))
+
+        return attrs
+
+    def create(self, validated_data):
+        device_model = get_device_model()
+        devices = [device_model(**item) for item in validated_data]
+        device_model.upsert_devices(devices, batch_size=self.batch_size)
+        return devices
+
+
+class PlatformField(serializers.ChoiceField):
+    """
+    A choice of the PLATFORM_CHOICES of the device model, which is looked up when the field is bound.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(choices=(), **kwargs)
+
+    def bind(self, field_name, parent):
+        super().bind(field_name, parent)
+        self.choices = get_device_model().PLATFORM_CHOICES
+
+
+class BulkDeviceSerializer(serializers.Serializer):
+    """
+    Registers devices on behalf of any user, for server to server token migrations.
+    """
+
+    user_id = serializers.IntegerField(required=True)
+    push_token = serializers.CharField(required=True)
+    platform = PlatformField(required=True)
+    model = serializers.CharField(required=False, default="")
+    locale = serializers.CharField(required=False, default="")
+
+    class Meta:
+        list_serializer_class = BulkDeviceListSerializer
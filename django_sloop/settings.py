@@ -9,9 +9,41 @@ DJANGO_SLOOP_SETTINGS.setdefault("AWS_SECRET_ACCESS_KEY", None)
 DJANGO_SLOOP_SETTINGS.setdefault("SNS_IOS_APPLICATION_ARN", None)
 DJANGO_SLOOP_SETTINGS.setdefault("SNS_IOS_SANDBOX_ENABLED", False)
 DJANGO_SLOOP_SETTINGS.setdefault("SNS_ANDROID_APPLICATION_ARN", None)
+DJANGO_SLOOP_SETTINGS.setdefault("SNS_PUBLISH_RATE", None)
+DJANGO_SLOOP_SETTINGS.setdefault("SNS_SHARDS", {})
+DJANGO_SLOOP_SETTINGS.setdefault("SNS_CLIENT_CONFIG", None)
 DJANGO_SLOOP_SETTINGS.setdefault("LOG_SENT_MESSAGES", False)
 DJANGO_SLOOP_SETTINGS.setdefault("DEFAULT_SOUND", None)
 DJANGO_SLOOP_SETTINGS.setdefault("DEVICE_MODEL", None)
+DJANGO_SLOOP_SETTINGS.setdefault("PUSH_MESSAGE_RETENTION_DAYS", None)
+DJANGO_SLOOP_SETTINGS.setdefault("DEVICE_RETENTION_DAYS", None)
+DJANGO_SLOOP_SETTINGS.setdefault("CACHE_ALIAS", "default")
+DJANGO_SLOOP_SETTINGS.setdefault("ACTIVE_DEVICE_CACHE_TIMEOUT", None)
+DJANGO_SLOOP_SETTINGS.setdefault("CREATE_ENDPOINTS_ON_REGISTRATION", False)
+DJANGO_SLOOP_SETTINGS.setdefault("OUTBOX_ENABLED", False)
+DJANGO_SLOOP_SETTINGS.setdefault("OUTBOX_BATCH_SIZE", 500)
+DJANGO_SLOOP_SETTINGS.setdefault("OUTBOX_RELAY_COUNTDOWN", 1)
+DJANGO_SLOOP_SETTINGS.setdefault("IDEMPOTENCY_KEY_TTL", 60 * 60 * 24)
+DJANGO_SLOOP_SETTINGS.setdefault("COALESCE_WINDOW", None)
+DJANGO_SLOOP_SETTINGS.setdefault("COALESCED_MESSAGE_FORMAT", "%(count)d new notifications")
+DJANGO_SLOOP_SETTINGS.setdefault("QUEUES", {})
+DJANGO_SLOOP_SETTINGS.setdefault("LOCALE_TIMEZONES", {})
+DJANGO_SLOOP_SETTINGS.setdefault("SCHEDULE_BATCH_SIZE", 500)
+DJANGO_SLOOP_SETTINGS.setdefault("SCHEDULE_SPREAD", 50)
+DJANGO_SLOOP_SETTINGS.setdefault("FREQUENCY_CAPS", {})
+DJANGO_SLOOP_SETTINGS.setdefault("FREQUENCY_CAP_ACTION", "drop")
+DJANGO_SLOOP_SETTINGS.setdefault("CAMPAIGN_BATCH_SIZE", 500)
+DJANGO_SLOOP_SETTINGS.setdefault("CIRCUIT_BREAKER_ERROR_RATE", None)
+DJANGO_SLOOP_SETTINGS.setdefault("CIRCUIT_BREAKER_MIN_CALLS", 20)
+DJANGO_SLOOP_SETTINGS.setdefault("CIRCUIT_BREAKER_WINDOW", 60)
+DJANGO_SLOOP_SETTINGS.setdefault("CIRCUIT_BREAKER_COOLDOWN", 30)
+DJANGO_SLOOP_SETTINGS.setdefault("SPOOL_BATCH_SIZE", 100)
+DJANGO_SLOOP_SETTINGS.setdefault("SPOOL_DRAIN_RATE", 50)
+DJANGO_SLOOP_SETTINGS.setdefault("SEGMENTS_ENABLED", False)
+DJANGO_SLOOP_SETTINGS.setdefault("SEGMENT_UPDATE_COUNTDOWN", 5)
+DJANGO_SLOOP_SETTINGS.setdefault("SEGMENT_UPDATE_BATCH_SIZE", 1000)
+DJANGO_SLOOP_SETTINGS.setdefault("READ_DATABASE", None)
+DJANGO_SLOOP_SETTINGS.setdefault("READ_YOUR_WRITES_TIMEOUT", 10)
 
 
 if not DJANGO_SLOOP_SETTINGS.get("DEVICE_MODEL"):
@@ -0,0 +1,54 @@
+import hashlib
+
+from .settings import DJANGO_SLOOP_SETTINGS
+
+
+DEFAULT_SHARD = "default"
+
+SHARD_SETTINGS = (
+    "AWS_REGION_NAME",
+    "AWS_ACCESS_KEY_ID",
+    "AWS_SECRET_ACCESS_KEY",
+    "SNS_IOS_APPLICATION_ARN",
+    "SNS_IOS_SANDBOX_ENABLED",
+    "SNS_ANDROID_APPLICATION_ARN",
+    "SNS_PUBLISH_RATE",
+)
+
+
+def get_shards():
+    """
+    Returns the SNS_SHARDS setting, or a single "default" shard built from the top level settings.
+    """
+    return DJANGO_SLOOP_SETTINGS["SNS_SHARDS"] or {DEFAULT_SHARD: {}}
+
+
+def get_shard_settings(name):
+    """
+    Returns the settings of the shard, falling back to the top level settings for missing keys.
+    Shards that are not configured, like the "default" shard of endpoints created before sharding when SNS_SHARDS
+    leaves it out, get the top level settings.
+    """
+    shard_settings = dict((key, DJANGO_SLOOP_SETTINGS.get(key)) for key in SHARD_SETTINGS)
+    shard_settings.update(get_shards().get(name) or {})
+    return shard_settings
+
+
+def assign_shard(device_pk):
+    """
+    Picks a shard for the device with rendezvous hashing, so adding a shard only moves the devices it wins.
+    """
+    def score(name):
+        return hashlib.md5(("%s:%s" % (name, device_pk)).encode("utf-8")).hexdigest()
+
+    return max(sorted(get_shards()), key=score)
+
+
+def get_device_shard(device):
+    """
+    Returns the shard that owns the device endpoint, or the shard the endpoint will be created in.
+    Endpoints created before sharding was configured belong to the "default" shard.
+    """
+    if device.sns_platform_endpoint_arn:
+        return device.sns_shard or DEFAULT_SHARD
+    return assign_shard(device.pk)
@@ -0,0 +1,24 @@
+from .cache import invalidate_active_devices
+from .routing import mark_recent_writes
+from .segments import queue_segment_updates
+
+
+def invalidate_active_device(sender, instance, **kwargs):
+    """
+    Drops the cached active device of the device owner whenever a device is saved or deleted, and again on commit.
+    """
+    invalidate_active_devices([instance.user_id])
+
+
+def mark_recent_device_write(sender, instance, **kwargs):
+    """
+    Reads the devices of the device owner from the primary database for a while after a device is saved.
+    """
+    mark_recent_writes([instance.user_id])
+
+
+def queue_segment_update(sender, instance, **kwargs):
+    """
+    Queues the device for the segment update task whenever it is saved or deleted.
+    """
+    queue_segment_updates([instance.pk])
@@ -1,25 +1,199 @@
+import json
+
 from celery import shared_task
+from django.db import transaction
 
+from .dryrun import DryRunReport
+from .routing import get_device, get_devices
+from .settings import DJANGO_SLOOP_SETTINGS
 from .utils import get_device_model
 
 
 @shared_task()
-def send_push_notification(device_id, message, url, badge_count, sound, extra, category, **kwargs):
+def send_push_notification(device_id, message, url, badge_count, sound, extra, category, idempotency_key=None, collapse_key=None, dry_run=False, **kwargs):
     """
-    Sends a push notification message to the specified tokens
+    Sends a push notification message to the specified tokens, or returns the dry-run report of the payload
     """
-    device_model = get_device_model()
-    device = device_model.objects.get(id=device_id)
-    device.send_push_notification(message, url, badge_count, sound, extra, category, **kwargs)
+    device = get_device(device_id)
+    result = device.send_push_notification(message, url, badge_count, sound, extra, category, idempotency_key=idempotency_key, collapse_key=collapse_key, dry_run=dry_run, **kwargs)
+    if dry_run:
+        return result.as_dict()
     return "Message: %s" % message
 
 
 @shared_task()
-def send_silent_push_notification(device_id, extra, badge_count, content_available, **kwargs):
+def send_silent_push_notification(device_id, extra, badge_count, content_available, idempotency_key=None, dry_run=False, **kwargs):
     """
-    Sends a push notification message to the specified tokens
+    Sends a push notification message to the specified tokens, or returns the dry-run report of the payload
     """
-    device_model = get_device_model()
-    device = device_model.objects.get(id=device_id)
-    device.send_silent_push_notification(extra, badge_count, content_available, **kwargs)
+    device = get_device(device_id)
+    result = device.send_silent_push_notification(extra, badge_count, content_available, idempotency_key=idempotency_key, dry_run=dry_run, **kwargs)
+    if dry_run:
+        return result.as_dict()
     return "Silent push"
+
+
+@shared_task()
+def create_platform_endpoint(device_id):
+    """
+    Creates the SNS endpoint of the specified device ahead of its first push notification
+    """
+    from .handlers import SNSHandler
+
+    device = get_device(device_id)
+    if device.deleted_at or device.sns_platform_endpoint_arn:
+        return "Skipped"
+
+    return SNSHandler(device).get_or_create_platform_endpoint_arn()
+
+
+@shared_task()
+def create_platform_endpoints(device_ids):
+    """
+    Creates the SNS endpoints of the specified devices ahead of their first push notifications
+    """
+    from .handlers import SNSHandler
+
+    devices = [device for device in get_devices(device_ids).values() if not device.deleted_at and not device.sns_platform_endpoint_arn]
+    for device in devices:
+        SNSHandler(device).get_or_create_platform_endpoint_arn()
+    return "Created %d endpoints" % len(devices)
+
+
+@shared_task()
+def refresh_platform_endpoints(device_ids):
+    """
+    Re-enables the SNS endpoints of the specified devices and points them to their current push tokens
+    """
+    from .handlers import SNSHandler
+
+    device_model = get_device_model()
+    devices = list(device_model.objects.filter(id__in=device_ids, deleted_at__isnull=True))
+    for device in devices:
+        SNSHandler(device).refresh_platform_endpoint()
+    return "Refreshed %d endpoints" % len(devices)
+
+
+@shared_task()
+def send_push_notification_batch(notifications, dry_run=False):
+    """
+    Sends the notifications built by dispatch.build_notification(), or returns the dry-run report of their payloads
+    """
+    from .dispatch import send_notifications
+
+    if dry_run:
+        report = DryRunReport()
+        send_notifications(notifications, report=report)
+        return report.as_dict()
+    return "Sent %d of %d notifications" % (send_notifications(notifications), len(notifications))
+
+
+@shared_task()
+def send_campaign_batch(campaign_id, locale, device_ids, dry_run=False):
+    """
+    Sends the campaign to the specified devices, the payload is loaded once per worker.
+    Returns the dry-run report of the payloads with dry_run.
+    """
+    from .dispatch import send_campaign
+
+    if dry_run:
+        report = DryRunReport()
+        send_campaign(campaign_id, locale, device_ids, report=report)
+        return report.as_dict()
+    return "Sent %d of %d notifications" % (send_campaign(campaign_id, locale, device_ids), len(device_ids))
+
+
+@shared_task()
+def relay_push_outbox(batch_size=None):
+    """
+    Moves the notifications in the outbox to batch tasks
+
+    The batch tasks are published before the relayed rows are deleted, so a crash in between relays them again.
+    Notifications without an idempotency key get one derived from their outbox row, which drops those duplicates
+    within IDEMPOTENCY_KEY_TTL seconds.
+    """
+    from .cache import get_cache
+    from .dispatch import OUTBOX_RELAY_LOCK_KEY, enqueue_notification_batches
+    from .models import PushOutbox
+
+    # Notifications committed from now on schedule another relay.
+    get_cache().delete(OUTBOX_RELAY_LOCK_KEY)
+
+    batch_size = batch_size or DJANGO_SLOOP_SETTINGS["OUTBOX_BATCH_SIZE"]
+    relayed = 0
+    while True:
+        with transaction.atomic():
+            rows = list(PushOutbox.objects.select_for_update(skip_locked=True).order_by("pk")[:batch_size])
+            if not rows:
+                break
+            notifications = []
+            for row in rows:
+                notification = json.loads(row.notification)
+                if not notification["kwargs"].get("idempotency_key"):
+                    notification["kwargs"]["idempotency_key"] = "outbox-%d" % row.pk
+                notifications.append(notification)
+            enqueue_notification_batches(notifications, batch_size)
+            PushOutbox.objects.filter(pk__in=[row.pk for row in rows]).delete()
+        relayed += len(rows)
+
+    return "Relayed %d notifications" % relayed
+
+
+@shared_task()
+def flush_coalesced_notification(device_id, collapse_key):
+    """
+    Sends the notifications buffered for the device and collapse key as a single notification
+    """
+    from .dispatch import pop_coalesced_notification, send_notification
+
+    notification, count = pop_coalesced_notification(device_id, collapse_key)
+    if notification is None:
+        return "Nothing to send"
+
+    device = get_device(device_id)
+    message = notification["args"][0]
+    notification["args"][0] = device.prepare_coalesced_message(message, count, collapse_key)
+    send_notification(device, notification)
+    return "Coalesced %d notifications" % count
+
+
+@shared_task()
+def release_scheduled_pushes(batch_size=None, spread=None):
+    """
+    Sends the scheduled notifications that are due, meant to run every minute from Celery beat
+    """
+    from .dispatch import release_scheduled_notifications
+
+    batch_size = batch_size or DJANGO_SLOOP_SETTINGS["SCHEDULE_BATCH_SIZE"]
+    spread = DJANGO_SLOOP_SETTINGS["SCHEDULE_SPREAD"] if spread is None else spread
+    return "Released %d notifications" % release_scheduled_notifications(batch_size, spread=spread)
+
+
+@shared_task()
+def drain_push_spool(batch_size=None, rate=None):
+    """
+    Sends the payloads spooled while the SNS circuit was open, scheduled when a circuit closes
+    """
+    from .cache import get_cache
+    from .dispatch import SPOOL_DRAIN_LOCK_KEY, drain_spool
+
+    batch_size = batch_size or DJANGO_SLOOP_SETTINGS["SPOOL_BATCH_SIZE"]
+    rate = DJANGO_SLOOP_SETTINGS["SPOOL_DRAIN_RATE"] if rate is None else rate
+    try:
+        return "Drained %d payloads" % drain_spool(batch_size, rate=rate)
+    finally:
+        get_cache().delete(SPOOL_DRAIN_LOCK_KEY)
+
+
+@shared_task()
+def update_segments(batch_size=None):
+    """
+    Applies the queued device changes to the segments
+    """
+    from .cache import get_cache
+    from .segments import SEGMENT_UPDATE_LOCK_KEY, apply_segment_changes
+
+    # Changes committed from now on schedule another update.
+    get_cache().delete(SEGMENT_UPDATE_LOCK_KEY)
+    batch_size = batch_size or DJANGO_SLOOP_SETTINGS["SEGMENT_UPDATE_BATCH_SIZE"]
+    return "Updated %d devices" % apply_segment_changes(batch_size)
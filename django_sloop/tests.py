@@ -1,15 +1,30 @@
+import asyncio
+import datetime
 import json
+import os
+import subprocess
+import sys
 import time
+import zoneinfo
+from datetime import timedelta
+from io import StringIO
 from random import randint
 from unittest import skipIf
 
+from asgiref.sync import sync_to_async
 from botocore.exceptions import ClientError
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, isolate_apps
 from django.urls import reverse
-from mock import Mock
+from django.utils import timezone
+from mock import Mock, patch
 
+from django_sloop.cache import get_cache
+from django_sloop.models import PushMessage, PushOutbox, ScheduledPush
 from django_sloop.utils import get_device_model
 from .handlers import SNSHandler
 from .settings import DJANGO_SLOOP_SETTINGS
@@ -74,6 +89,48 @@ class SNSHandlerTests(TestCase):
         # create_platform_endpoint() is not called.
         self.assertFalse(sns_client.create_platform_endpoint.called)
 
+    def test_create_platform_endpoint_reuses_existing_endpoint(self):
+        sns_client = Mock()
+        sns_client.create_platform_endpoint.side_effect = ClientError(error_response={
+            "Error": {
+                "Code": "InvalidParameter",
+                "Message": "Invalid parameter: Token Reason: Endpoint existing_arn already exists with the same Token, but different attributes."
+            }
+        }, operation_name="CreatePlatformEndpoint")
+        SNSHandler.client = sns_client
+        self.android_device.sns_platform_endpoint_arn = "existing_arn"
+        self.android_device.save()
+
+        handler = SNSHandler(self.ios_device)
+        self.assertEqual(handler.get_or_create_platform_endpoint_arn(), "existing_arn")
+
+        sns_client.set_endpoint_attributes.assert_called_once_with(
+            EndpointArn="existing_arn",
+            Attributes={"Token": TEST_IOS_PUSH_TOKEN, "Enabled": "true"},
+        )
+        self.ios_device.refresh_from_db()
+        self.android_device.refresh_from_db()
+        self.assertEqual(self.ios_device.sns_platform_endpoint_arn, "existing_arn")
+        self.assertIsNone(self.android_device.sns_platform_endpoint_arn)
+
+    def test_refresh_deleted_platform_endpoint(self):
+        sns_client = Mock()
+        sns_client.set_endpoint_attributes.side_effect = ClientError(error_response={
+            "Error": {
+                "Code": "NotFound"
+            }
+        }, operation_name="SetEndpointAttributes")
+        sns_client.create_platform_endpoint.return_value = {
+            'EndpointArn': TEST_SNS_ENDPOINT_ARN
+        }
+        SNSHandler.client = sns_client
+        self.ios_device.sns_platform_endpoint_arn = "deleted_arn"
+        self.ios_device.save()
+
+        self.assertEqual(SNSHandler(self.ios_device).refresh_platform_endpoint(), TEST_SNS_ENDPOINT_ARN)
+        self.ios_device.refresh_from_db()
+        self.assertEqual(self.ios_device.sns_platform_endpoint_arn, TEST_SNS_ENDPOINT_ARN)
+
 
 class DeviceTests(TestCase):
 
@@ -309,6 +366,101 @@ class DeviceAPITests(TestCase):
         device = self.user.devices.get(**data)
         self.assertEqual(response.data, DeviceSerializer(device).data)
 
+    def test_api_create_existing_device_moves_it_to_the_new_user(self):
+        other_client, other_user = self.create_test_user_client()
+        data = {
+            "push_token": self.ios_device.push_token,
+            "platform": Device.PLATFORM_IOS,
+            "locale": "tr_TR",
+        }
+        response = other_client.post(self.create_delete_url, data=data)
+        self.assertEqual(response.status_code, self.status.HTTP_201_CREATED)
+
+        self.ios_device.refresh_from_db()
+        self.assertEqual(self.ios_device.user, other_user)
+        self.assertEqual(self.ios_device.locale, "tr_TR")
+        self.assertEqual(Device.objects.filter(push_token=self.ios_device.push_token).count(), 1)
+
+    def test_api_create_deleted_device_revives_it(self):
+        sns_client = Mock()
+        SNSHandler.client = sns_client
+        self.ios_device.sns_platform_endpoint_arn = "test_ios_arn"
+        self.ios_device.invalidate()
+
+        data = {
+            "push_token": self.ios_device.push_token,
+            "platform": Device.PLATFORM_IOS
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.create_delete_url, data=data)
+        self.assertEqual(response.status_code, self.status.HTTP_201_CREATED)
+
+        self.ios_device.refresh_from_db()
+        self.assertIsNone(self.ios_device.deleted_at)
+        sns_client.set_endpoint_attributes.assert_called_once_with(
+            EndpointArn="test_ios_arn",
+            Attributes={"Token": TEST_IOS_PUSH_TOKEN, "Enabled": "true"},
+        )
+
+    def test_api_create_device_with_previous_push_token(self):
+        sns_client = Mock()
+        SNSHandler.client = sns_client
+        self.ios_device.sns_platform_endpoint_arn = "test_ios_arn"
+        self.ios_device.save()
+
+        data = {
+            "push_token": "refreshed_ios_push_token",
+            "previous_push_token": self.ios_device.push_token,
+            "platform": Device.PLATFORM_IOS
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.create_delete_url, data=data)
+        self.assertEqual(response.status_code, self.status.HTTP_201_CREATED)
+
+        self.ios_device.refresh_from_db()
+        self.assertEqual(self.ios_device.push_token, "refreshed_ios_push_token")
+        self.assertEqual(self.ios_device.sns_platform_endpoint_arn, "test_ios_arn")
+        sns_client.set_endpoint_attributes.assert_called_once_with(
+            EndpointArn="test_ios_arn",
+            Attributes={"Token": "refreshed_ios_push_token", "Enabled": "true"},
+        )
+
+    def test_api_bulk_create_devices(self):
+        bulk_url = reverse("django_sloop:bulk-create-device")
+        data = [
+            {"user_id": self.user.id, "push_token": "bulk_token_1", "platform": Device.PLATFORM_IOS},
+            {"user_id": self.user.id, "push_token": "bulk_token_2", "platform": Device.PLATFORM_ANDROID},
+            {"user_id": self.user.id, "push_token": self.ios_device.push_token, "platform": Device.PLATFORM_IOS, "locale": "tr_TR"},
+        ]
+        response = self.client.post(bulk_url, data=data)
+        self.assertEqual(response.status_code, self.status.HTTP_403_FORBIDDEN)
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.post(bulk_url, data=data + [{"user_id": 0, "push_token": "bulk_token_3", "platform": Device.PLATFORM_IOS}])
+        self.assertEqual(response.status_code, self.status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(bulk_url, data=data)
+        self.assertEqual(response.status_code, self.status.HTTP_201_CREATED)
+        self.assertEqual(response.data, {"count": 3})
+        self.assertEqual(self.user.devices.count(), 4)
+        self.ios_device.refresh_from_db()
+        self.assertEqual(self.ios_device.locale, "tr_TR")
+
+    def test_api_bulk_create_validates_platform(self):
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.post(reverse("django_sloop:bulk-create-device"), data=[{"user_id": self.user.id, "push_token": "bulk_token", "platform": "symbian"}])
+        self.assertEqual(response.status_code, self.status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Device.objects.filter(push_token="bulk_token").exists())
+
+    def test_upsert_keeps_the_last_of_duplicate_devices(self):
+        Device.upsert_devices([
+            Device(user=self.user, push_token="duplicate_token", platform=Device.PLATFORM_IOS, locale="en_US"),
+            Device(user=self.user, push_token="duplicate_token", platform=Device.PLATFORM_IOS, locale="tr_TR"),
+        ])
+        self.assertEqual(Device.objects.get(push_token="duplicate_token").locale, "tr_TR")
+
     def test_api_delete_device(self):
         non_device_owner_client, non_device_owner = self.create_test_user_client()
 
@@ -323,3 +475,1261 @@ class DeviceAPITests(TestCase):
         self.assertEqual(response.status_code, self.status.HTTP_204_NO_CONTENT)
         self.ios_device.refresh_from_db()
         self.assertIsNotNone(self.ios_device.deleted_at)
+
+    def test_async_api_create_and_delete_device(self):
+        from .views import AsyncCreateDeleteDeviceView
+
+        url = reverse("django_sloop:async-create-delete-device")
+        self.assertTrue(asyncio.iscoroutinefunction(AsyncCreateDeleteDeviceView.as_view()))
+
+        data = {
+            "push_token": "test_ios_push_token2",
+            "platform": Device.PLATFORM_IOS
+        }
+        response = self.client.post(url, data=data)
+        self.assertEqual(response.status_code, self.status.HTTP_201_CREATED)
+        device = self.user.devices.get(**data)
+
+        response = self.APIClient().post(url, data=data, format="json")
+        self.assertIn(response.status_code, (self.status.HTTP_401_UNAUTHORIZED, self.status.HTTP_403_FORBIDDEN))
+
+        non_device_owner_client, non_device_owner = self.create_test_user_client()
+        response = non_device_owner_client.delete(url, data={"push_token": device.push_token})
+        self.assertEqual(response.status_code, self.status.HTTP_404_NOT_FOUND)
+
+        response = self.client.delete(url, data={"push_token": device.push_token})
+        self.assertEqual(response.status_code, self.status.HTTP_204_NO_CONTENT)
+        device.refresh_from_db()
+        self.assertIsNotNone(device.deleted_at)
+
+
+class PurgeMessagesCommandTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("username", "username@test.com", "test123")
+        self.device = Device.objects.create(user=self.user, push_token=TEST_IOS_PUSH_TOKEN, platform=Device.PLATFORM_IOS)
+        old = timezone.now() - timedelta(days=60)
+        for i in range(5):
+            PushMessage.objects.create(device=self.device, body="old", data="{}", sns_response="{}", date_created=old)
+        self.recent_message = PushMessage.objects.create(device=self.device, body="recent", data="{}", sns_response="{}")
+
+    def test_purge_expired_messages(self):
+        call_command("sloop_purge_messages", days=30, batch_size=2, sleep=0, stdout=StringIO())
+        self.assertEqual(list(PushMessage.objects.all()), [self.recent_message])
+
+    def test_purge_dry_run(self):
+        out = StringIO()
+        call_command("sloop_purge_messages", days=30, dry_run=True, stdout=out)
+        self.assertIn("5 push messages would be deleted", out.getvalue())
+        self.assertEqual(PushMessage.objects.count(), 6)
+
+    def test_purge_expired_campaigns(self):
+        from .models import Broadcast, Campaign
+
+        old = timezone.now() - timedelta(days=60)
+        expired = Campaign.objects.create(payload="{}", date_created=old)
+        Broadcast.objects.create(campaign=expired, date_completed=old)
+        running = Campaign.objects.create(payload="{}", date_created=old)
+        Broadcast.objects.create(campaign=running)
+        recent = Campaign.objects.create(payload="{}")
+
+        out = StringIO()
+        call_command("sloop_purge_messages", days=30, sleep=0, stdout=out)
+        self.assertIn("Deleted 1 campaigns", out.getvalue())
+        self.assertEqual(set(Campaign.objects.all()), {running, recent})
+        self.assertEqual(Broadcast.objects.get().campaign, running)
+
+
+class ActiveDeviceLookupTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("username", "username@test.com", "test123")
+
+    def test_get_active_pushable_device(self):
+        Device.objects.create(user=self.user, push_token="old_token", platform=Device.PLATFORM_IOS, date_created=timezone.now() - timedelta(days=1))
+        newest = Device.objects.create(user=self.user, push_token="new_token", platform=Device.PLATFORM_IOS)
+        Device.objects.create(user=self.user, push_token="deleted_token", platform=Device.PLATFORM_IOS, deleted_at=timezone.now(), date_created=timezone.now() + timedelta(days=1))
+        self.assertEqual(self.user.get_active_pushable_device(), newest)
+
+    @isolate_apps("test_app.devices")
+    def test_long_device_model_names_get_a_short_index_name(self):
+        from .models import AbstractSNSDevice
+
+        class NotificationDevice(AbstractSNSDevice):
+            class Meta(AbstractSNSDevice.Meta):
+                app_label = "devices"
+
+        index_name = NotificationDevice._meta.indexes[0].name
+        self.assertTrue(index_name.startswith("sloop_active_"))
+        self.assertLessEqual(len(index_name), 30)
+        # The user model is not installed in the isolated registry, so only the index errors are checked.
+        self.assertEqual([error.id for error in NotificationDevice.check(databases=["default"]) if error.id.startswith("models.E")], [])
+        self.assertEqual(Device._meta.indexes[0].name, "devices_device_active")
+
+    @skipIf(connection.vendor != "sqlite", "Query plan format is backend specific.")
+    def test_active_device_lookup_uses_index(self):
+        plan = self.user.devices.filter(deleted_at__isnull=True).order_by("-date_created").explain()
+        self.assertIn("USING INDEX %s_active" % Device._meta.db_table, plan)
+
+    @skipIf(not os.environ.get("SLOOP_BENCHMARK"), "Set SLOOP_BENCHMARK=1 to run benchmarks.")
+    def test_benchmark_active_device_lookup(self):
+        """
+        The lookup time must stay flat while the device table grows by orders of magnitude.
+        """
+        timings = []
+        for size in (10000, 100000, 1000000):
+            missing = size - Device.objects.count()
+            User.objects.bulk_create([User(username="benchmark_%d_%d" % (size, i)) for i in range(missing // 10)])
+            user_ids = list(User.objects.values_list("id", flat=True))
+            devices = [
+                Device(user_id=user_ids[i % len(user_ids)], push_token="benchmark_%d_%d" % (size, i), platform=Device.PLATFORM_IOS)
+                for i in range(missing)
+            ]
+            Device.objects.bulk_create(devices, batch_size=5000)
+
+            users = list(User.objects.order_by("?")[:100])
+            started = time.time()
+            for user in users:
+                user.get_active_pushable_device()
+            timings.append((time.time() - started) / len(users))
+
+        # 100x more rows must not cost anywhere near 100x more time.
+        self.assertLess(timings[-1], timings[0] * 5)
+
+
+class ActiveDeviceCacheTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("username", "username@test.com", "test123")
+        self.device = Device.objects.create(user=self.user, push_token=TEST_IOS_PUSH_TOKEN, platform=Device.PLATFORM_IOS, sns_platform_endpoint_arn="test_ios_arn")
+        self.settings_patcher = patch.dict(DJANGO_SLOOP_SETTINGS, {"ACTIVE_DEVICE_CACHE_TIMEOUT": 60})
+        self.settings_patcher.start()
+        get_cache().clear()
+
+    def tearDown(self):
+        self.settings_patcher.stop()
+        get_cache().clear()
+
+    def test_active_device_is_served_from_cache(self):
+        self.assertEqual(self.user.get_active_pushable_device(), self.device)
+
+        with self.assertNumQueries(0):
+            device = self.user.get_active_pushable_device()
+            self.assertEqual(device.id, self.device.id)
+            self.assertEqual(device.platform, Device.PLATFORM_IOS)
+            self.assertEqual(device.sns_platform_endpoint_arn, "test_ios_arn")
+
+    def test_cache_is_invalidated_on_device_changes(self):
+        self.user.get_active_pushable_device()
+        self.device.invalidate()
+        self.assertIsNone(self.user.get_active_pushable_device())
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.user.get_active_pushable_device())
+
+        new_device = Device.objects.create(user=self.user, push_token=TEST_ANDROID_PUSH_TOKEN, platform=Device.PLATFORM_ANDROID)
+        self.assertEqual(self.user.get_active_pushable_device(), new_device)
+
+        new_device.delete()
+        self.assertIsNone(self.user.get_active_pushable_device())
+
+    def test_cache_is_invalidated_again_on_commit(self):
+        from .cache import dump_active_device, get_active_device_cache_key
+
+        cache_key = get_active_device_cache_key(self.user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.device.invalidate()
+                # Another process looks the device up before the commit and caches the old row.
+                get_cache().set(cache_key, dump_active_device(self.device))
+
+        self.assertIsNone(get_cache().get(cache_key))
+        self.assertIsNone(self.user.get_active_pushable_device())
+
+
+class EndpointProvisioningTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("username", "username@test.com", "test123")
+        self.ios_device = Device.objects.create(user=self.user, push_token=TEST_IOS_PUSH_TOKEN, platform=Device.PLATFORM_IOS)
+        self.android_device = Device.objects.create(user=self.user, push_token=TEST_ANDROID_PUSH_TOKEN, platform=Device.PLATFORM_ANDROID)
+        self.deleted_device = Device.objects.create(user=self.user, push_token="deleted_token", platform=Device.PLATFORM_IOS, deleted_at=timezone.now())
+        self.sns_client = Mock()
+        self.sns_client.create_platform_endpoint.side_effect = lambda PlatformApplicationArn, Token: {
+            "EndpointArn": "arn_" + Token
+        }
+        SNSHandler.client = self.sns_client
+
+    def test_create_endpoints_command(self):
+        call_command("sloop_create_endpoints", batch_size=1, rate=0, stdout=StringIO())
+
+        self.ios_device.refresh_from_db()
+        self.android_device.refresh_from_db()
+        self.deleted_device.refresh_from_db()
+        self.assertEqual(self.ios_device.sns_platform_endpoint_arn, "arn_" + TEST_IOS_PUSH_TOKEN)
+        self.assertEqual(self.android_device.sns_platform_endpoint_arn, "arn_" + TEST_ANDROID_PUSH_TOKEN)
+        self.assertIsNone(self.deleted_device.sns_platform_endpoint_arn)
+        self.assertEqual(self.sns_client.create_platform_endpoint.call_count, 2)
+
+    def test_create_endpoint_on_registration(self):
+        from .serializers import DeviceSerializer
+
+        request = Mock(user=self.user)
+        serializer = DeviceSerializer(data={"push_token": "new_token", "platform": Device.PLATFORM_IOS}, context={"request": request})
+        serializer.is_valid(raise_exception=True)
+
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"CREATE_ENDPOINTS_ON_REGISTRATION": True}), self.captureOnCommitCallbacks(execute=True):
+            device = serializer.save()
+
+        device.refresh_from_db()
+        self.assertEqual(device.sns_platform_endpoint_arn, "arn_new_token")
+
+    def test_create_endpoint_on_push_token_change(self):
+        from .serializers import DeviceSerializer
+
+        request = Mock(user=self.user)
+        data = {"push_token": "changed_token", "previous_push_token": TEST_IOS_PUSH_TOKEN, "platform": Device.PLATFORM_IOS}
+        serializer = DeviceSerializer(data=data, context={"request": request})
+        serializer.is_valid(raise_exception=True)
+
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"CREATE_ENDPOINTS_ON_REGISTRATION": True}), self.captureOnCommitCallbacks(execute=True):
+            device = serializer.save()
+
+        self.assertEqual(device.pk, self.ios_device.pk)
+        device.refresh_from_db()
+        self.assertEqual(device.sns_platform_endpoint_arn, "arn_changed_token")
+
+    def test_create_endpoints_on_bulk_registration(self):
+        from .serializers import BulkDeviceSerializer
+
+        data = [{"user_id": self.user.pk, "push_token": "bulk_token_%d" % i, "platform": Device.PLATFORM_ANDROID} for i in range(3)]
+        data.append({"user_id": self.user.pk, "push_token": TEST_IOS_PUSH_TOKEN, "platform": Device.PLATFORM_IOS})
+        Device.objects.filter(pk=self.ios_device.pk).update(sns_platform_endpoint_arn="ios_arn")
+        serializer = BulkDeviceSerializer(data=data, many=True)
+        serializer.is_valid(raise_exception=True)
+
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"CREATE_ENDPOINTS_ON_REGISTRATION": True}), self.captureOnCommitCallbacks(execute=True) as callbacks:
+            serializer.save()
+
+        self.assertEqual(
+            set(Device.objects.filter(push_token__startswith="bulk_token").values_list("sns_platform_endpoint_arn", flat=True)),
+            {"arn_bulk_token_%d" % i for i in range(3)}
+        )
+        # The endpoints are created in one batch task, and the existing endpoint is kept.
+        self.assertEqual(self.sns_client.create_platform_endpoint.call_count, 3)
+        self.assertEqual(len(callbacks), 1)
+
+
+class ReconcileEndpointsCommandTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("username", "username@test.com", "test123")
+        self.enabled_device = Device.objects.create(user=self.user, push_token="enabled_token", platform=Device.PLATFORM_IOS, sns_platform_endpoint_arn="enabled_arn")
+        self.disabled_device = Device.objects.create(user=self.user, push_token="disabled_token", platform=Device.PLATFORM_IOS, sns_platform_endpoint_arn="disabled_arn")
+        self.changed_device = Device.objects.create(user=self.user, push_token="new_token", platform=Device.PLATFORM_IOS, sns_platform_endpoint_arn="changed_arn")
+
+        pages = {
+            None: {
+                "Endpoints": [
+                    {"EndpointArn": "enabled_arn", "Attributes": {"Enabled": "true", "Token": "enabled_token"}},
+                    {"EndpointArn": "disabled_arn", "Attributes": {"Enabled": "false", "Token": "disabled_token"}},
+                ],
+                "NextToken": "page_2",
+            },
+            "page_2": {
+                "Endpoints": [
+                    {"EndpointArn": "changed_arn", "Attributes": {"Enabled": "true", "Token": "old_token"}},
+                    {"EndpointArn": "orphan_arn", "Attributes": {"Enabled": "true", "Token": "orphan_token"}},
+                ],
+            },
+        }
+        self.sns_client = Mock()
+        self.sns_client.list_endpoints_by_platform_application.side_effect = lambda PlatformApplicationArn, NextToken=None: (
+            pages[NextToken] if PlatformApplicationArn == DJANGO_SLOOP_SETTINGS["SNS_IOS_APPLICATION_ARN"] else {"Endpoints": []}
+        )
+        SNSHandler.client = self.sns_client
+
+    def test_reconcile_endpoints(self):
+        out = StringIO()
+        call_command("sloop_reconcile_endpoints", delete_orphans=True, rate=0, stdout=out)
+
+        self.enabled_device.refresh_from_db()
+        self.disabled_device.refresh_from_db()
+        self.changed_device.refresh_from_db()
+        self.assertIsNone(self.enabled_device.deleted_at)
+        self.assertIsNotNone(self.disabled_device.deleted_at)
+        self.assertIsNone(self.changed_device.sns_platform_endpoint_arn)
+
+        deleted_arns = sorted(call_kwargs["EndpointArn"] for _, call_kwargs in self.sns_client.delete_endpoint.call_args_list)
+        self.assertEqual(deleted_arns, ["changed_arn", "orphan_arn"])
+        self.assertIn("4 endpoints checked, 1 devices invalidated", out.getvalue())
+
+    def test_reconcile_endpoints_dry_run(self):
+        call_command("sloop_reconcile_endpoints", dry_run=True, delete_orphans=True, stdout=StringIO())
+
+        self.disabled_device.refresh_from_db()
+        self.assertIsNone(self.disabled_device.deleted_at)
+        self.assertFalse(self.sns_client.delete_endpoint.called)
+
+
+class PushMessageAdminTests(TestCase):
+
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser("admin", "admin@test.com", "test123")
+        self.client.force_login(self.admin_user)
+        self.changelist_url = reverse("admin:django_sloop_pushmessage_changelist")
+
+    def create_push_messages(self, count):
+        start = PushMessage.objects.count()
+        for index in range(start, start + count):
+            user = User.objects.create_user("username%d" % index, "username@test.com", "test123")
+            device = Device.objects.create(user=user, push_token="test_push_token_%d" % index, platform=Device.PLATFORM_IOS)
+            PushMessage.objects.create(
+                device=device, body="test_message", data="{}", sns_message_id="test_message_id_%d" % index,
+                sns_response=json.dumps({"Error": {"Message": "Endpoint is disabled"}} if index % 2 else {"MessageId": "test_message_id_%d" % index})
+            )
+
+    def get_changelist_queries(self, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.changelist_url, params)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        self.create_push_messages(1)
+        _, one_row_queries = self.get_changelist_queries()
+        self.create_push_messages(10)
+        response, queries = self.get_changelist_queries()
+
+        self.assertEqual(queries, one_row_queries)
+        self.assertEqual(response.context["cl"].result_count, 11)
+        self.assertContains(response, "Endpoint is disabled")
+
+    def test_changelist_searches_message_id_exactly(self):
+        self.create_push_messages(3)
+        response, _ = self.get_changelist_queries(q="test_message_id_1")
+        self.assertEqual([message.sns_message_id for message in response.context["cl"].result_list], ["test_message_id_1"])
+
+        response, _ = self.get_changelist_queries(q="test_message")
+        self.assertEqual(response.context["cl"].result_count, 0)
+
+
+class PurgeDevicesCommandTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("username", "username@test.com", "test123")
+        old = timezone.now() - timedelta(days=60)
+        self.stale_device = Device.objects.create(user=self.user, push_token="stale_token", platform=Device.PLATFORM_IOS, sns_platform_endpoint_arn="stale_arn", deleted_at=old)
+        self.failing_device = Device.objects.create(user=self.user, push_token="failing_token", platform=Device.PLATFORM_IOS, sns_platform_endpoint_arn="failing_arn", deleted_at=old)
+        self.recent_device = Device.objects.create(user=self.user, push_token="recent_token", platform=Device.PLATFORM_IOS, sns_platform_endpoint_arn="recent_arn", deleted_at=timezone.now())
+        self.active_device = Device.objects.create(user=self.user, push_token="active_token", platform=Device.PLATFORM_IOS)
+        for device in (self.stale_device, self.active_device):
+            PushMessage.objects.create(device=device, body="test", data="{}", sns_response="{}")
+
+        def delete_endpoint(EndpointArn):
+            if EndpointArn == "failing_arn":
+                raise ClientError(error_response={"Error": {"Code": "InternalError"}}, operation_name="DeleteEndpoint")
+
+        self.sns_client = Mock()
+        self.sns_client.delete_endpoint.side_effect = delete_endpoint
+        SNSHandler.client = self.sns_client
+
+    def test_purge_devices(self):
+        call_command("sloop_purge_devices", days=30, sleep=0, rate=0, stdout=StringIO(), stderr=StringIO())
+
+        self.assertEqual(set(Device.objects.all()), {self.failing_device, self.recent_device, self.active_device})
+        self.assertEqual(PushMessage.objects.get().device, self.active_device)
+        deleted_arns = sorted(call_kwargs["EndpointArn"] for _, call_kwargs in self.sns_client.delete_endpoint.call_args_list)
+        self.assertEqual(deleted_arns, ["failing_arn", "stale_arn"])
+
+
+class ShardingTests(TestCase):
+
+    shards = {
+        "eu": {"AWS_REGION_NAME": "eu-west-1", "SNS_IOS_APPLICATION_ARN": "eu_ios_arn", "SNS_ANDROID_APPLICATION_ARN": "eu_android_arn"},
+        "us": {"AWS_REGION_NAME": "us-east-1", "SNS_IOS_APPLICATION_ARN": "us_ios_arn", "SNS_ANDROID_APPLICATION_ARN": "us_android_arn"},
+    }
+
+    def setUp(self):
+        self.user = User.objects.create_user("username", "username@test.com", "test123")
+        self.sns_client = Mock()
+        self.sns_client.create_platform_endpoint.side_effect = lambda PlatformApplicationArn, Token: {
+            "EndpointArn": PlatformApplicationArn + "/" + Token
+        }
+        self.sns_client.publish.return_value = {"MessageId": "test_message_id"}
+        SNSHandler.client = self.sns_client
+
+    def test_adding_a_shard_only_moves_devices_to_it(self):
+        from .sharding import assign_shard
+
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"SNS_SHARDS": self.shards}):
+            before = dict((pk, assign_shard(pk)) for pk in range(1000))
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"SNS_SHARDS": dict(self.shards, ap={})}):
+            after = dict((pk, assign_shard(pk)) for pk in range(1000))
+
+        self.assertEqual(set(before.values()), {"eu", "us"})
+        moved = [pk for pk in before if before[pk] != after[pk]]
+        self.assertTrue(moved)
+        self.assertEqual({after[pk] for pk in moved}, {"ap"})
+
+    def test_endpoint_is_created_in_the_assigned_shard(self):
+        from .sharding import assign_shard
+
+        device = Device.objects.create(user=self.user, push_token=TEST_IOS_PUSH_TOKEN, platform=Device.PLATFORM_IOS)
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"SNS_SHARDS": self.shards}):
+            shard = assign_shard(device.pk)
+            device.send_push_notification("test")
+
+        device.refresh_from_db()
+        self.assertEqual(device.sns_shard, shard)
+        self.assertEqual(device.sns_platform_endpoint_arn, "%s_ios_arn/%s" % (shard, TEST_IOS_PUSH_TOKEN))
+
+    def test_rebalance_shards(self):
+        from .sharding import assign_shard
+
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"SNS_SHARDS": self.shards}):
+            devices = [
+                Device.objects.create(user=self.user, push_token="token_%d" % i, platform=Device.PLATFORM_IOS, sns_platform_endpoint_arn="arn_%d" % i)
+                for i in range(10)
+            ]
+            for device in devices:
+                # Endpoints created before sharding belong to the default shard, which is no longer configured.
+                device.sns_shard = assign_shard(device.pk) if device.pk % 2 else ""
+                device.save()
+
+            call_command("sloop_rebalance_shards", rate=0, stdout=StringIO())
+
+        moved = [device for device in devices if not device.sns_shard]
+        for device in devices:
+            device.refresh_from_db()
+        self.assertTrue(moved)
+        self.assertTrue(all(device.sns_platform_endpoint_arn is None and device.sns_shard == "" for device in moved))
+        self.assertTrue(all(device.sns_platform_endpoint_arn for device in devices if device not in moved))
+        self.assertEqual(self.sns_client.delete_endpoint.call_count, len(moved))
+
+    def test_endpoints_created_before_sharding_without_a_default_shard(self):
+        from .handlers import get_endpoint_client, reset_shard_clients
+        from .sharding import get_shard_settings
+
+        device = Device.objects.create(user=self.user, push_token=TEST_IOS_PUSH_TOKEN, platform=Device.PLATFORM_IOS, sns_platform_endpoint_arn="legacy_arn")
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"SNS_SHARDS": self.shards, "SNS_IOS_APPLICATION_ARN": "top_level_ios_arn"}):
+            self.assertEqual(get_shard_settings("")["SNS_IOS_APPLICATION_ARN"], "top_level_ios_arn")
+            self.assertEqual(get_shard_settings("removed")["SNS_IOS_APPLICATION_ARN"], "top_level_ios_arn")
+            device.send_push_notification("test")
+            self.assertEqual(self.sns_client.publish.call_args[1]["TargetArn"], "legacy_arn")
+
+            self.addCleanup(reset_shard_clients)
+            client = get_endpoint_client("arn:aws:sns:ap-southeast-1:123456789012:endpoint/APNS/app/00000000")
+            self.assertEqual(client.meta.region_name, "ap-southeast-1")
+
+
+class BroadcastCommandTests(TestCase):
+
+    def setUp(self):
+        from .dispatch import get_campaign_payload
+
+        get_campaign_payload.cache_clear()
+        self.devices = []
+        for i in range(5):
+            user = User.objects.create_user("username%d" % i, "username@test.com", "test123")
+            self.devices.append(Device.objects.create(
+                user=user, push_token="token_%d" % i, platform=Device.PLATFORM_IOS, sns_platform_endpoint_arn="arn_%d" % i
+            ))
+        Device.objects.create(user=user, push_token="android_token", platform=Device.PLATFORM_ANDROID, sns_platform_endpoint_arn="android_arn")
+        self.sns_client = Mock()
+        self.sns_client.publish.side_effect = lambda **kwargs: {"MessageId": "test_message_" + str(randint(0, 999999))}
+        SNSHandler.client = self.sns_client
+        get_cache().clear()
+
+    def get_target_arns(self):
+        return [call_kwargs["TargetArn"] for _, call_kwargs in self.sns_client.publish.call_args_list]
+
+    def test_broadcast(self):
+        out = StringIO()
+        call_command(
+            "sloop_broadcast", message="test_message", filter={"platform": Device.PLATFORM_IOS},
+            processes=1, concurrency=1, range_size=2, batch_size=1, stdout=out
+        )
+
+        self.assertEqual(sorted(self.get_target_arns()), ["arn_%d" % i for i in range(5)])
+        self.assertIn("3/3 ranges completed", out.getvalue())
+        self.assertIn("5 sent, 0 failed.", out.getvalue())
+
+    def test_resume_broadcast(self):
+        from .models import Broadcast, BroadcastRange
+
+        def publish(**kwargs):
+            if self.sns_client.publish.call_count == 4:
+                raise KeyboardInterrupt
+            return {"MessageId": "test_message_" + str(randint(0, 999999))}
+
+        self.sns_client.publish.side_effect = publish
+        with self.assertRaises(KeyboardInterrupt):
+            call_command("sloop_broadcast", message="test_message", filter={"platform": Device.PLATFORM_IOS},
+                         processes=1, concurrency=1, batch_size=2, stdout=StringIO())
+
+        broadcast = Broadcast.objects.get()
+        self.assertEqual(BroadcastRange.objects.get().last_pk, self.devices[1].pk)
+
+        self.sns_client.publish.side_effect = lambda **kwargs: {"MessageId": "test_message_" + str(randint(0, 999999))}
+        stderr = StringIO()
+        call_command("sloop_broadcast", resume=broadcast.pk, processes=1, concurrency=1, batch_size=2, stdout=StringIO(), stderr=stderr)
+        # The test settings use the local-memory cache, which only works here because the broadcast runs in this process.
+        self.assertIn("cache is not shared between processes", stderr.getvalue())
+
+        # Of the batch in flight when the process died, the sent device is skipped and the interrupted one is sent again.
+        self.assertEqual(self.get_target_arns(), ["arn_0", "arn_1", "arn_2", "arn_3", "arn_3", "arn_4"])
+        self.assertEqual(BroadcastRange.objects.get().sent, 5)
+        broadcast.refresh_from_db()
+        self.assertIsNotNone(broadcast.date_completed)
+
+
+class SegmentTests(TestCase):
+
+    def setUp(self):
+        from .dispatch import get_campaign_payload
+
+        get_campaign_payload.cache_clear()
+        self.user = User.objects.create_user("username", "username@test.com", "test123")
+        self.ios_device = Device.objects.create(user=self.user, push_token="ios_token", platform=Device.PLATFORM_IOS, locale="tr_TR", sns_platform_endpoint_arn="ios_arn")
+        self.android_device = Device.objects.create(user=self.user, push_token="android_token", platform=Device.PLATFORM_ANDROID, locale="tr_TR")
+        self.old_device = Device.objects.create(user=self.user, push_token="old_token", platform=Device.PLATFORM_IOS, locale="tr_TR")
+        Device.objects.filter(pk=self.old_device.pk).update(date_updated=timezone.now() - timedelta(days=60))
+        self.sns_client = Mock()
+        self.sns_client.publish.side_effect = lambda **kwargs: {"MessageId": "test_message_" + str(randint(0, 999999))}
+        SNSHandler.client = self.sns_client
+        get_cache().clear()
+
+    def test_encode_device_ids(self):
+        from .segments import decode_device_ids, encode_device_ids
+
+        device_ids = list(range(1, 100001)) + [10 ** 12]
+        data = encode_device_ids(device_ids)
+        self.assertLess(len(data), len(device_ids) * 8 / 100)
+        self.assertEqual(list(decode_device_ids(data)), device_ids)
+        self.assertEqual(list(decode_device_ids(encode_device_ids([]))), [])
+
+    def test_materialize_segment(self):
+        from .models import Segment
+
+        segment = Segment.objects.create(name="ios-tr", filters=json.dumps({"platform": Device.PLATFORM_IOS, "locale": "tr_TR"}), active_days=30)
+        call_command("sloop_materialize_segments", stdout=StringIO())
+
+        segment.refresh_from_db()
+        self.assertEqual(list(segment.get_device_ids()), [self.ios_device.pk])
+        self.assertEqual(segment.device_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(segment.send_push_notification_async("test_message"), 1)
+        self.assertEqual(self.sns_client.publish.call_args[1]["TargetArn"], "ios_arn")
+
+    def test_segment_is_sent_through_a_single_campaign(self):
+        from .models import Campaign, Segment
+
+        other_user = User.objects.create_user("other", "other@test.com", "test123")
+        other_device = Device.objects.create(user=other_user, push_token="other_token", platform=Device.PLATFORM_IOS, locale="en_US", sns_platform_endpoint_arn="other_arn")
+        segment = Segment.objects.create(name="ios", filters=json.dumps({"platform": Device.PLATFORM_IOS, "sns_platform_endpoint_arn__isnull": False}))
+        segment.materialize()
+
+        with self.assertRaises(KeyError):
+            segment.send_push_notification_async({"tr": "Merhaba"}, chunk_size=1)
+        self.assertFalse(Campaign.objects.exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            enqueued = segment.send_push_notification_async({"tr": "Merhaba", "en": "Hello"}, chunk_size=1)
+
+        self.assertEqual(enqueued, 2)
+        self.assertEqual(Campaign.objects.count(), 1)
+        messages = {kwargs["TargetArn"]: json.loads(kwargs["Message"])["APNS"] for _, kwargs in self.sns_client.publish.call_args_list}
+        self.assertIn("Merhaba", messages[self.ios_device.sns_platform_endpoint_arn])
+        self.assertIn("Hello", messages[other_device.sns_platform_endpoint_arn])
+        self.assertEqual(segment.send_push_notification_async({"tr": "Merhaba", "en": "Hello"}, chunk_size=1, dry_run=True).total, 2)
+
+    def test_segments_are_updated_by_device_signals(self):
+        from .models import Segment, SegmentChange
+
+        segment = Segment.objects.create(name="ios", filters=json.dumps({"platform": Device.PLATFORM_IOS}))
+        segment.materialize()
+
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"SEGMENTS_ENABLED": True}):
+            with self.captureOnCommitCallbacks(execute=True):
+                new_device = Device.objects.create(user=self.user, push_token="new_token", platform=Device.PLATFORM_IOS)
+                self.ios_device.invalidate()
+            with self.captureOnCommitCallbacks(execute=True):
+                Device.upsert_devices([Device(user=self.user, push_token="ios_token", platform=Device.PLATFORM_IOS)])
+
+        segment.refresh_from_db()
+        self.assertEqual(list(segment.get_device_ids()), sorted([self.ios_device.pk, self.old_device.pk, new_device.pk]))
+        self.assertFalse(SegmentChange.objects.exists())
+
+
+class DryRunTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("username", "username@test.com", "test123")
+        for i in range(3):
+            Device.objects.create(user=self.user, push_token="ios_token_%d" % i, platform=Device.PLATFORM_IOS, locale="en_US")
+        Device.objects.create(user=self.user, push_token="android_token", platform=Device.PLATFORM_ANDROID, locale="tr_TR")
+        self.sns_client = Mock()
+        SNSHandler.client = self.sns_client
+        get_cache().clear()
+
+    def test_queryset_dry_run(self):
+        from .models import Campaign
+
+        with self.assertNumQueries(1), patch.dict(DJANGO_SLOOP_SETTINGS, {"SNS_PUBLISH_RATE": 2}):
+            report = Device.objects.all().send_push_notification_async({"en": "Hello", "default": "Merhaba"}, extra={"data": "x" * 5000}, dry_run=True)
+            report = report.as_dict()
+
+        self.assertEqual(report["total"], 4)
+        self.assertEqual(report["platforms"], {Device.PLATFORM_IOS: 3, Device.PLATFORM_ANDROID: 1})
+        self.assertEqual(report["oversized"], 4)
+        self.assertGreater(report["payload_size"]["p50"], 5000)
+        self.assertEqual(report["eta_seconds"], 2)
+        self.assertFalse(self.sns_client.publish.called)
+        self.assertFalse(Campaign.objects.exists())
+
+    def test_mixin_and_task_dry_run(self):
+        from . import tasks
+
+        report = self.user.send_push_notification_async("test_message", dry_run=True)
+        self.assertEqual(report.platforms, {Device.PLATFORM_ANDROID: 1})
+        self.assertEqual(self.user.send_silent_push_notification_async(extra={}, dry_run=True).total, 1)
+
+        device = Device.objects.filter(platform=Device.PLATFORM_IOS).first()
+        result = tasks.send_push_notification.delay(device.pk, "test_message", None, None, None, None, None, dry_run=True).get()
+        self.assertEqual(result["platforms"], {Device.PLATFORM_IOS: 1})
+        self.assertEqual(result["oversized"], 0)
+        self.assertFalse(self.sns_client.publish.called)
+        self.assertFalse(PushMessage.objects.exists())
+
+
+class ReadReplicaTests(TransactionTestCase):
+    # The replica is a mirror of the default database with its own connection, which only sees committed rows.
+
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        self.user = User.objects.create_user("username", "username@test.com", "test123")
+        self.device = Device.objects.create(user=self.user, push_token=TEST_IOS_PUSH_TOKEN, platform=Device.PLATFORM_IOS, sns_platform_endpoint_arn="test_ios_arn")
+        self.sns_client = Mock()
+        self.sns_client.publish.return_value = {"MessageId": "test_message_id"}
+        SNSHandler.client = self.sns_client
+        get_cache().clear()
+
+        settings_patcher = patch.dict(DJANGO_SLOOP_SETTINGS, {"READ_DATABASE": "replica", "LOG_SENT_MESSAGES": True})
+        settings_patcher.start()
+        self.addCleanup(settings_patcher.stop)
+
+    def test_reads_go_to_the_replica_and_writes_to_the_primary(self):
+        from .routing import get_device
+
+        with CaptureQueriesContext(connections["replica"]) as replica_queries:
+            device = get_device(self.device.pk)
+            device.send_push_notification("test_message")
+            self.assertEqual(self.user.get_active_pushable_device(), self.device)
+
+        self.assertEqual(len(replica_queries), 2)
+        self.assertTrue(all(query["sql"].startswith("SELECT") for query in replica_queries))
+        self.assertEqual(PushMessage.objects.using("default").get().device, self.device)
+
+    def test_reads_go_to_the_primary_after_registration(self):
+        from .routing import mark_recent_writes
+
+        mark_recent_writes([self.user.pk])
+        with CaptureQueriesContext(connections["replica"]) as replica_queries:
+            self.assertEqual(self.user.get_active_pushable_device(), self.device)
+        self.assertEqual(len(replica_queries), 0)
+
+
+class ImportTimeTests(TestCase):
+    # Budget in seconds for importing the sloop modules in django.setup(), measured with -X importtime.
+    IMPORT_TIME_BUDGET = 0.5
+
+    def run_setup(self, *options):
+        script = (
+            "import sys, django; django.setup(); "
+            "print(','.join(m for m in ('boto3', 'botocore', 'django_sloop.handlers', 'django_sloop.tasks') if m in sys.modules))"
+        )
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE)
+        return subprocess.run([sys.executable, *options, "-c", script], env=env, capture_output=True, text=True, check=True)
+
+    def test_setup_does_not_load_the_send_path(self):
+        self.assertEqual(self.run_setup().stdout.strip(), "")
+
+    @skipIf(not os.environ.get("SLOOP_BENCHMARK"), "Set SLOOP_BENCHMARK=1 to run benchmarks.")
+    def test_benchmark_setup_import_time(self):
+        result = self.run_setup("-X", "importtime")
+
+        # importtime prints every module after the ones it imported, indented by depth, so read it backwards
+        # and add up the cumulative time of the sloop modules that were not imported by another sloop module.
+        total, stack = 0, []
+        for line in reversed(result.stderr.splitlines()):
+            if not line.startswith("import time:") or "|" not in line or "[us]" in line:
+                continue
+            _, cumulative, name = line.split("|")
+            depth = len(name) - len(name.lstrip())
+            while stack and stack[-1][0] >= depth:
+                stack.pop()
+            is_sloop = name.strip().split(".")[0] == "django_sloop"
+            if is_sloop and not any(inside for _, inside in stack):
+                total += int(cumulative)
+            stack.append((depth, is_sloop))
+
+        self.assertGreater(total, 0)
+        self.assertLess(total / 1e6, self.IMPORT_TIME_BUDGET)
+
+
+class PushNotificationMixinTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("username", "username@test.com", "test123")
+        self.device = Device.objects.create(user=self.user, push_token=TEST_IOS_PUSH_TOKEN, platform=Device.PLATFORM_IOS, sns_platform_endpoint_arn="test_ios_arn")
+        self.sns_client = Mock()
+        self.sns_client.publish.side_effect = lambda **kwargs: {"MessageId": "test_message_" + str(randint(0, 999999))}
+        SNSHandler.client = self.sns_client
+        get_cache().clear()
+
+    def test_send_push_notification_async(self):
+        self.user.send_push_notification_async("test_message", extra={"foo": "bar"})
+        self.user.send_silent_push_notification_async(extra={"foo": "bar"})
+
+        self.assertEqual(self.sns_client.publish.call_count, 2)
+        self.assertEqual(self.device.push_messages.count(), 2)
+
+    async def test_asend_push_notification(self):
+        self.assertEqual(await self.user.aget_active_pushable_device(), self.device)
+
+        await self.user.asend_push_notification("test_message", extra={"foo": "bar"})
+        await self.user.asend_silent_push_notification(extra={"foo": "bar"})
+        report = await self.user.asend_push_notification("test_message", dry_run=True)
+
+        self.assertEqual(report.total, 1)
+        self.assertEqual(self.sns_client.publish.call_count, 2)
+        self.assertEqual(await self.device.push_messages.acount(), 2)
+
+    async def test_sync_and_async_lookups_share_the_cached_device(self):
+        devices = Device.objects.filter(pk=self.device.pk)
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"ACTIVE_DEVICE_CACHE_TIMEOUT": 60}):
+            # update() sends no signals, so the cache keeps what the other lookup stored.
+            await sync_to_async(self.user.get_active_pushable_device)()
+            await devices.aupdate(deleted_at=timezone.now())
+            device = await self.user.aget_active_pushable_device()
+            self.assertEqual(device, self.device)
+            self.assertEqual(device.sns_platform_endpoint_arn, "test_ios_arn")
+
+            await get_cache().aclear()
+            self.assertIsNone(await self.user.aget_active_pushable_device())
+            await devices.aupdate(deleted_at=None)
+            self.assertIsNone(await sync_to_async(self.user.get_active_pushable_device)())
+
+    async def test_asend_push_notification_without_active_device(self):
+        self.device.deleted_at = timezone.now()
+        await self.device.asave()
+
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"ACTIVE_DEVICE_CACHE_TIMEOUT": 60}):
+            self.assertFalse(await self.user.asend_push_notification("test_message"))
+            self.assertFalse(await self.user.asend_silent_push_notification())
+        self.assertFalse(self.sns_client.publish.called)
+
+    def test_send_push_notification_through_outbox(self):
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"OUTBOX_ENABLED": True}):
+            with self.captureOnCommitCallbacks(execute=True):
+                with transaction.atomic():
+                    self.user.send_push_notification_async("test_message")
+                    self.user.send_silent_push_notification_async()
+                    self.assertEqual(PushOutbox.objects.count(), 2)
+                    self.assertFalse(self.sns_client.publish.called)
+
+        self.assertEqual(PushOutbox.objects.count(), 0)
+        self.assertEqual(self.sns_client.publish.call_count, 2)
+
+    def test_notifications_relayed_twice_are_sent_once(self):
+        from django.db.models import QuerySet
+
+        from .tasks import relay_push_outbox
+
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"OUTBOX_ENABLED": True}):
+            self.user.send_push_notification_async("test_message")
+            self.user.send_silent_push_notification_async()
+
+        # The relay crashes after publishing the batch, before the relayed rows are deleted.
+        with patch.object(QuerySet, "delete", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                relay_push_outbox()
+        self.assertEqual(PushOutbox.objects.count(), 2)
+        relay_push_outbox()
+
+        self.assertEqual(PushOutbox.objects.count(), 0)
+        self.assertEqual(self.sns_client.publish.call_count, 2)
+
+    def test_rolled_back_notifications_are_not_sent(self):
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"OUTBOX_ENABLED": True}):
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                try:
+                    with transaction.atomic():
+                        self.user.send_push_notification_async("test_message")
+                        raise ValueError
+                except ValueError:
+                    pass
+
+        self.assertEqual(callbacks, [])
+        self.assertEqual(PushOutbox.objects.count(), 0)
+        self.assertFalse(self.sns_client.publish.called)
+
+    def test_idempotency_key_suppresses_duplicate_sends(self):
+        self.user.send_push_notification_async("test_message", idempotency_key="order_1_shipped")
+        self.user.send_push_notification_async("test_message", idempotency_key="order_1_shipped")
+        self.user.send_push_notification_async("test_message", idempotency_key="order_2_shipped")
+
+        self.assertEqual(self.sns_client.publish.call_count, 2)
+        self.assertEqual(self.device.push_messages.count(), 2)
+
+    def test_idempotency_key_is_released_when_publish_fails(self):
+        self.sns_client.publish.side_effect = ClientError(error_response={"Error": {"Code": "Throttling"}}, operation_name="Publish")
+        with self.assertRaises(ClientError):
+            self.device.send_silent_push_notification(extra={}, idempotency_key="sync_1")
+
+        self.sns_client.publish.side_effect = None
+        self.sns_client.publish.return_value = {"MessageId": "test_message_id"}
+        self.device.send_silent_push_notification(extra={}, idempotency_key="sync_1")
+        self.assertIsNone(self.device.send_silent_push_notification(extra={}, idempotency_key="sync_1"))
+        self.assertEqual(self.sns_client.publish.call_count, 2)
+
+    def test_coalesce_notifications(self):
+        from . import tasks
+
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"COALESCE_WINDOW": 10}), patch.object(tasks.flush_coalesced_notification, "apply_async") as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                for i in range(5):
+                    self.user.send_push_notification_async("message %d" % i, collapse_key="chat_1")
+                self.user.send_push_notification_async("other", collapse_key="chat_2")
+                self.assertFalse(apply_async.called)
+
+        self.assertEqual(apply_async.call_count, 2)
+        apply_async.assert_any_call((self.device.id, "chat_1"), countdown=10)
+        self.assertFalse(self.sns_client.publish.called)
+
+        tasks.flush_coalesced_notification(self.device.id, "chat_1")
+        tasks.flush_coalesced_notification(self.device.id, "chat_1")
+
+        self.sns_client.publish.assert_called_once()
+        call_kwargs = self.sns_client.publish.call_args[1]
+        self.assertEqual(call_kwargs["MessageAttributes"], {
+            "AWS.SNS.MOBILE.APNS.COLLAPSE_ID": {"DataType": "String", "StringValue": "chat_1"}
+        })
+        message = json.loads(json.loads(call_kwargs["Message"])["APNS"])
+        self.assertEqual(message["aps"]["alert"], "5 new notifications")
+
+    def test_coalescing_warns_about_a_local_cache(self):
+        from django.test import override_settings
+
+        from .checks import check_coalesce_cache
+
+        self.assertEqual(check_coalesce_cache(None), [])
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"COALESCE_WINDOW": 10}):
+            with override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}):
+                self.assertEqual([warning.id for warning in check_coalesce_cache(None)], ["django_sloop.W001"])
+            with override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": "redis://"}}):
+                self.assertEqual(check_coalesce_cache(None), [])
+
+    def test_notifications_coalesced_during_a_flush_are_not_lost(self):
+        from . import dispatch
+
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"COALESCE_WINDOW": 10}), patch.object(dispatch, "schedule_coalesced_flush") as schedule_flush:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.user.send_push_notification_async("message 1", collapse_key="chat_1")
+                self.user.send_push_notification_async("message 2", collapse_key="chat_1")
+            self.assertEqual(schedule_flush.call_count, 1)
+
+            # Another notification is buffered between reading the buffer and clearing it.
+            get = get_cache().get
+
+            def get_and_buffer(key, *args, **kwargs):
+                value = get(key, *args, **kwargs)
+                if key.endswith(":notification"):
+                    with self.captureOnCommitCallbacks(execute=True):
+                        self.user.send_push_notification_async("message 3", collapse_key="chat_1")
+                return value
+
+            with patch.object(get_cache(), "get", side_effect=get_and_buffer):
+                notification, count = dispatch.pop_coalesced_notification(self.device.id, "chat_1")
+
+            self.assertEqual((notification["args"][0], count), ("message 2", 2))
+            self.assertEqual(schedule_flush.call_count, 2)
+            notification, count = dispatch.pop_coalesced_notification(self.device.id, "chat_1")
+            self.assertEqual((notification["args"][0], count), ("message 3", 1))
+            self.assertEqual(dispatch.pop_coalesced_notification(self.device.id, "chat_1"), (None, 0))
+
+    def test_rolled_back_notifications_are_not_coalesced(self):
+        from . import tasks
+
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"COALESCE_WINDOW": 10}), patch.object(tasks.flush_coalesced_notification, "apply_async") as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                try:
+                    with transaction.atomic():
+                        self.user.send_push_notification_async("message", collapse_key="chat_1")
+                        raise ValueError
+                except ValueError:
+                    pass
+
+        self.assertFalse(apply_async.called)
+        self.assertIsNone(get_cache().get("sloop:coalesce:%s:chat_1:count" % self.device.id))
+
+    def test_gcm_collapse_key(self):
+        android_device = Device.objects.create(user=self.user, push_token=TEST_ANDROID_PUSH_TOKEN, platform=Device.PLATFORM_ANDROID, sns_platform_endpoint_arn="test_android_arn")
+        android_device.send_push_notification("test_message", collapse_key="chat_1")
+
+        call_kwargs = self.sns_client.publish.call_args[1]
+        self.assertNotIn("MessageAttributes", call_kwargs)
+        message = json.loads(json.loads(call_kwargs["Message"])["GCM"])
+        self.assertEqual(message["collapse_key"], "chat_1")
+        self.assertNotIn("collapse_key", message["data"])
+
+    def test_priority_class_routing(self):
+        from . import tasks
+
+        queues = {"transactional": "sloop_transactional", "silent": "sloop_silent", "bulk": "sloop_bulk"}
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"QUEUES": queues}), \
+                patch.object(tasks.send_push_notification, "apply_async") as push_apply_async, \
+                patch.object(tasks.send_silent_push_notification, "apply_async") as silent_apply_async:
+            self.user.send_push_notification_async("test_message")
+            self.user.send_push_notification_async("test_message", priority_class="bulk")
+            self.user.send_silent_push_notification_async()
+
+        self.assertEqual([call[1]["queue"] for call in push_apply_async.call_args_list], ["sloop_transactional", "sloop_bulk"])
+        self.assertEqual(silent_apply_async.call_args[1]["queue"], "sloop_silent")
+
+    def test_scheduled_push_notification(self):
+        from .dispatch import release_scheduled_notifications
+
+        deliver_at = timezone.now() + timedelta(hours=2)
+        self.user.send_push_notification_async("test_message", deliver_at=deliver_at)
+        self.user.send_silent_push_notification_async(deliver_at=deliver_at)
+
+        scheduled_push = ScheduledPush.objects.first()
+        self.assertEqual(scheduled_push.deliver_at, deliver_at.replace(second=0, microsecond=0))
+        self.assertEqual(ScheduledPush.objects.count(), 2)
+
+        self.assertEqual(release_scheduled_notifications(batch_size=10), 0)
+        self.assertFalse(self.sns_client.publish.called)
+
+        self.assertEqual(release_scheduled_notifications(batch_size=10, now=deliver_at), 2)
+        self.assertEqual(self.sns_client.publish.call_count, 2)
+        self.assertEqual(ScheduledPush.objects.count(), 0)
+
+    def test_scheduled_push_notification_at_local_time(self):
+        self.device.locale = "tr_TR"
+        self.device.save()
+
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"LOCALE_TIMEZONES": {"tr_TR": "Europe/Istanbul"}}):
+            self.user.send_push_notification_async("test_message", deliver_at=datetime.time(9, 0))
+
+        deliver_at = ScheduledPush.objects.get().deliver_at.astimezone(zoneinfo.ZoneInfo("Europe/Istanbul"))
+        self.assertEqual((deliver_at.hour, deliver_at.minute), (9, 0))
+        self.assertTrue(timezone.now() < deliver_at <= timezone.now() + timedelta(days=1))
+
+    def test_frequency_cap_drops_notifications(self):
+        caps = {"default": (2, 3600), "marketing": (1, 3600)}
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"FREQUENCY_CAPS": caps}):
+            self.assertIsNone(self.user.send_push_notification_async("test_message", category="marketing"))
+            self.assertFalse(self.user.send_push_notification_async("test_message", category="marketing"))
+            self.assertIsNone(self.user.send_push_notification_async("test_message"))
+            self.assertIsNone(self.user.send_silent_push_notification_async())
+            self.assertFalse(self.user.send_push_notification_async("test_message"))
+
+        self.assertEqual(self.sns_client.publish.call_count, 3)
+
+    def test_frequency_cap_defers_notifications(self):
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"FREQUENCY_CAPS": {"transactional": (1, 3600)}, "FREQUENCY_CAP_ACTION": "defer"}):
+            self.user.send_push_notification_async("test_message")
+            self.user.send_push_notification_async("test_message")
+
+        self.assertEqual(self.sns_client.publish.call_count, 1)
+        scheduled_push = ScheduledPush.objects.get()
+        self.assertGreater(scheduled_push.deliver_at, timezone.now())
+        self.assertEqual(scheduled_push.deliver_at.timestamp() % 3600, 0)
+
+    def test_deferred_notifications_are_capped_again_on_release(self):
+        from .dispatch import release_scheduled_notifications
+
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"FREQUENCY_CAPS": {"transactional": (1, 3600)}, "FREQUENCY_CAP_ACTION": "defer"}):
+            for _ in range(4):
+                self.user.send_push_notification_async("test_message")
+            self.assertEqual(self.sns_client.publish.call_count, 1)
+            self.assertEqual(ScheduledPush.objects.count(), 3)
+
+            # At the start of the next window, all of the previous window still overlaps the sliding window.
+            next_window = ScheduledPush.objects.first().deliver_at
+            self.assertEqual(release_scheduled_notifications(batch_size=10, now=next_window), 0)
+            self.assertEqual(set(ScheduledPush.objects.values_list("deliver_at", flat=True)), {next_window + timedelta(minutes=1)})
+
+            # A minute later one of them goes out, and counts against the cap like any other notification.
+            self.assertEqual(release_scheduled_notifications(batch_size=10, now=next_window + timedelta(minutes=1)), 1)
+            self.assertEqual(self.sns_client.publish.call_count, 2)
+            self.assertEqual(set(ScheduledPush.objects.values_list("deliver_at", flat=True)), {next_window + timedelta(hours=1)})
+            self.assertEqual(release_scheduled_notifications(batch_size=10, now=next_window + timedelta(hours=1, minutes=1)), 1)
+            self.assertEqual(self.sns_client.publish.call_count, 3)
+
+    def test_sliding_window_counter(self):
+        from .capping import apply_frequency_cap
+
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"FREQUENCY_CAPS": {"default": (4, 100)}}):
+            for _ in range(4):
+                self.assertEqual(apply_frequency_cap([self.user.pk], now=1050)[0], [self.user.pk])
+            self.assertEqual(apply_frequency_cap([self.user.pk], now=1099)[0], [])
+            # Half of the previous window still counts, 4 * 0.5 = 2 more notifications are allowed.
+            self.assertEqual(apply_frequency_cap([self.user.pk], now=1150)[0], [self.user.pk])
+            self.assertEqual(apply_frequency_cap([self.user.pk], now=1150)[0], [self.user.pk])
+            self.assertEqual(apply_frequency_cap([self.user.pk], now=1150)[0], [])
+
+    def test_concurrent_sends_do_not_exceed_the_cap(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        from .capping import apply_frequency_cap
+
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"FREQUENCY_CAPS": {"default": (3, 3600)}}):
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(lambda _: apply_frequency_cap([self.user.pk])[0], range(20)))
+
+        self.assertEqual(sum(len(allowed_user_ids) for allowed_user_ids in results), 3)
+
+    def test_scheduled_notifications_are_capped_on_delivery(self):
+        from .dispatch import release_scheduled_notifications
+
+        deliver_at = timezone.now() + timedelta(days=1)
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"FREQUENCY_CAPS": {"default": (2, 3600)}}):
+            self.assertEqual([self.user.send_push_notification_async("test_message", deliver_at=deliver_at) for _ in range(5)], [None] * 5)
+            self.assertEqual(ScheduledPush.objects.count(), 5)
+
+            # Scheduling does not count against today's window.
+            self.assertIsNone(self.user.send_push_notification_async("test_message"))
+            self.assertEqual(self.sns_client.publish.call_count, 1)
+
+            self.assertEqual(release_scheduled_notifications(batch_size=10, now=deliver_at), 2)
+            self.assertEqual(self.sns_client.publish.call_count, 3)
+            self.assertEqual(ScheduledPush.objects.count(), 0)
+
+    def test_bulk_sends_defer_capped_devices(self):
+        from .dispatch import release_scheduled_notifications
+
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"FREQUENCY_CAPS": {"default": (1, 3600)}, "FREQUENCY_CAP_ACTION": "defer"}):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(Device.objects.send_push_notification_async("test_message"), 1)
+                self.assertEqual(Device.objects.send_push_notification_async("test_message"), 0)
+            self.assertEqual(self.sns_client.publish.call_count, 1)
+
+            scheduled_push = ScheduledPush.objects.get()
+            self.assertEqual(json.loads(scheduled_push.notification)["priority_class"], "bulk")
+            self.assertEqual(release_scheduled_notifications(batch_size=10, now=scheduled_push.deliver_at + timedelta(hours=1)), 1)
+            self.assertEqual(self.sns_client.publish.call_count, 2)
+
+
+class CircuitBreakerTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("username", "username@test.com", "test123")
+        self.device = Device.objects.create(user=self.user, push_token=TEST_IOS_PUSH_TOKEN, platform=Device.PLATFORM_IOS, sns_platform_endpoint_arn="test_ios_arn")
+        self.sns_client = Mock()
+        self.sns_client.publish.side_effect = ClientError(error_response={"Error": {"Code": "InternalError"}}, operation_name="Publish")
+        SNSHandler.client = self.sns_client
+        get_cache().clear()
+
+        settings_patcher = patch.dict(DJANGO_SLOOP_SETTINGS, {
+            "CIRCUIT_BREAKER_ERROR_RATE": 0.5, "CIRCUIT_BREAKER_MIN_CALLS": 3, "CIRCUIT_BREAKER_COOLDOWN": 60,
+            "SPOOL_DRAIN_RATE": 0, "LOG_SENT_MESSAGES": True,
+        })
+        settings_patcher.start()
+        self.addCleanup(settings_patcher.stop)
+
+    def test_circuit_opens_and_spools_payloads(self):
+        from .models import PushSpool
+
+        for _ in range(3):
+            with self.assertRaises(ClientError):
+                self.device.send_push_notification("failing")
+        self.assertEqual(self.sns_client.publish.call_count, 3)
+
+        self.assertIsNone(self.device.send_push_notification("spooled", idempotency_key="spooled_1"))
+        self.assertIsNone(self.device.send_push_notification("spooled", idempotency_key="spooled_1"))
+        self.assertEqual(self.sns_client.publish.call_count, 3)
+        self.assertEqual(PushSpool.objects.get().body, "spooled")
+
+    def test_spool_is_drained_when_the_circuit_closes(self):
+        from .models import PushSpool
+
+        for _ in range(3):
+            with self.assertRaises(ClientError):
+                self.device.send_silent_push_notification(extra={})
+        self.device.send_push_notification("spooled")
+        self.assertEqual(PushSpool.objects.count(), 1)
+
+        self.sns_client.publish.side_effect = lambda **kwargs: {"MessageId": "test_message_" + str(randint(0, 999999))}
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"CIRCUIT_BREAKER_COOLDOWN": 0}):
+            self.device.send_push_notification("trial")
+
+        self.assertFalse(PushSpool.objects.exists())
+        self.assertEqual(sorted(PushMessage.objects.values_list("body", flat=True)), ["spooled", "trial"])
+        self.assertEqual(self.sns_client.publish.call_count, 5)
+
+    def test_client_errors_do_not_open_the_circuit(self):
+        self.sns_client.publish.side_effect = ClientError(error_response={"Error": {"Code": "InvalidParameter"}}, operation_name="Publish")
+        for _ in range(5):
+            with self.assertRaises(ClientError):
+                self.device.send_silent_push_notification(extra={})
+        self.assertEqual(self.sns_client.publish.call_count, 5)
+
+
+class DeviceQuerySetTests(TestCase):
+
+    def setUp(self):
+        from .dispatch import get_campaign_payload
+
+        get_campaign_payload.cache_clear()
+        self.sns_client = Mock()
+        self.sns_client.publish.side_effect = lambda **kwargs: {"MessageId": "test_message_" + str(randint(0, 999999))}
+        SNSHandler.client = self.sns_client
+        get_cache().clear()
+
+        self.devices = []
+        for i, locale in enumerate(["en_US", "en_GB", "tr_TR", "de_DE"]):
+            user = User.objects.create_user("username%d" % i, "username@test.com", "test123")
+            self.devices.append(Device.objects.create(
+                user=user, push_token="token_%d" % i, platform=Device.PLATFORM_IOS, locale=locale, sns_platform_endpoint_arn="arn_%d" % i
+            ))
+        Device.objects.create(user=user, push_token="deleted_token", platform=Device.PLATFORM_IOS, deleted_at=timezone.now())
+
+    def get_sent_messages(self):
+        messages = {}
+        for _, call_kwargs in self.sns_client.publish.call_args_list:
+            messages[call_kwargs["TargetArn"]] = json.loads(json.loads(call_kwargs["Message"])["APNS"])["aps"]["alert"]
+        return messages
+
+    def test_send_push_notification_to_queryset(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(Device.objects.filter(locale__startswith="en").send_push_notification_async("test_message"), 2)
+        self.assertEqual(self.get_sent_messages(), {"arn_0": "test_message", "arn_1": "test_message"})
+
+    def test_batch_tasks_carry_the_campaign_id(self):
+        from . import tasks
+        from .models import Campaign
+
+        with patch.object(tasks.send_campaign_batch, "apply_async") as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                Device.objects.all().send_push_notification_async("test_message", extra={"data": "x" * 1000}, batch_size=2)
+
+        campaign = Campaign.objects.get()
+        self.assertEqual(json.loads(campaign.payload)["extra"], {"data": "x" * 1000})
+        batches = [call_args[0][0] for call_args in apply_async.call_args_list]
+        # Plain messages share their batches across locales.
+        self.assertEqual(len(batches), 2)
+        self.assertTrue(all(batch[0] == campaign.pk and len(json.dumps(batch)) < 100 for batch in batches))
+
+    def test_campaign_batches_are_queued_on_commit(self):
+        from . import tasks
+
+        with patch.object(tasks.send_campaign_batch, "apply_async") as apply_async:
+            with self.captureOnCommitCallbacks() as callbacks:
+                Device.objects.all().send_push_notification_async({"default": "test_message"})
+                self.assertFalse(apply_async.called)
+            self.assertEqual(len(callbacks), 4)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                with transaction.atomic():
+                    try:
+                        with transaction.atomic():
+                            Device.objects.all().send_push_notification_async("test_message")
+                            raise ValueError
+                    except ValueError:
+                        pass
+        self.assertFalse(apply_async.called)
+
+    def test_campaign_payload_is_loaded_once(self):
+        from .dispatch import get_campaign_payload
+
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            Device.objects.all().send_push_notification_async("test_message", url="http://example.com", extra={"foo": "bar"}, batch_size=1)
+
+        campaign_queries = [query for query in queries if query["sql"].startswith("SELECT") and "django_sloop_campaign" in query["sql"]]
+        self.assertEqual(len(campaign_queries), 1)
+        self.assertEqual(get_campaign_payload.cache_info().hits, 3)
+
+        messages = [json.loads(json.loads(call_kwargs["Message"])["APNS"]) for _, call_kwargs in self.sns_client.publish.call_args_list]
+        self.assertEqual(len(messages), 4)
+        self.assertTrue(all(message["aps"]["custom"] == {"foo": "bar", "url": "http://example.com"} for message in messages))
+
+    def test_scheduled_campaign_at_local_time(self):
+        from .dispatch import release_scheduled_notifications
+        from .models import Campaign
+
+        timezones = {"tr_TR": "Europe/Istanbul", "de_DE": "Europe/Berlin"}
+        with patch.dict(DJANGO_SLOOP_SETTINGS, {"LOCALE_TIMEZONES": timezones}):
+            self.assertEqual(Device.objects.all().send_push_notification_async("test_message", deliver_at=datetime.time(9, 0)), 4)
+
+        # One batch per timezone, the en_US and en_GB devices fall back to TIME_ZONE.
+        self.assertEqual(Campaign.objects.count(), 1)
+        self.assertEqual(ScheduledPush.objects.count(), 3)
+        for scheduled_push in ScheduledPush.objects.all():
+            batch = json.loads(scheduled_push.notification)
+            locale = Device.objects.get(pk=batch["devices"][0][0]).locale
+            deliver_at = scheduled_push.deliver_at.astimezone(zoneinfo.ZoneInfo(timezones.get(locale, settings.TIME_ZONE)))
+            self.assertEqual((deliver_at.hour, deliver_at.minute), (9, 0))
+        self.assertFalse(self.sns_client.publish.called)
+
+        last_delivery = ScheduledPush.objects.order_by("-deliver_at").first().deliver_at
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(release_scheduled_notifications(batch_size=10, now=last_delivery), 4)
+        self.assertEqual(self.get_sent_messages(), dict(("arn_%d" % i, "test_message") for i in range(4)))
+        self.assertFalse(ScheduledPush.objects.exists())
+
+    def test_campaign_payload_is_built_once_per_batch(self):
+        from .handlers import SNSHandler as Handler
+
+        with patch.object(Handler, "build_push_notification", autospec=True, side_effect=Handler.build_push_notification) as build:
+            with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(Device.objects.all().send_push_notification_async("test_message", extra={"foo": "bar"}), 4)
+
+        self.assertEqual(build.call_count, 1)
+        self.assertEqual(self.sns_client.publish.call_count, 4)
+        self.assertEqual(len(set(call_kwargs["Message"] for _, call_kwargs in self.sns_client.publish.call_args_list)), 1)
+        # A single pass over the devices, rather than one query per locale.
+        device_queries = [query for query in queries if query["sql"].startswith('SELECT "devices_device"."id", "devices_device"."user_id", "devices_device"."locale" FROM')]
+        self.assertEqual(len(device_queries), 1)
+
+    def test_send_localized_push_notification(self):
+        from .utils import get_compiled_template
+
+        get_compiled_template.cache_clear()
+        messages = {
+            "en_GB": "Cheers {{ name }}",
+            "en": "Hello {{ name }}",
+            "tr": "Merhaba {{ name }}",
+            "default": "Hi {{ name }}",
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(Device.objects.all().send_push_notification_async(messages, context={"name": "Sloop"}), 4)
+
+        self.assertEqual(self.get_sent_messages(), {
+            "arn_0": "Hello Sloop",
+            "arn_1": "Cheers Sloop",
+            "arn_2": "Merhaba Sloop",
+            "arn_3": "Hi Sloop",
+        })
+        self.assertEqual(get_compiled_template.cache_info().currsize, 4)
+
+    def test_localized_push_notification_is_not_html_escaped(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Device.objects.filter(locale="en_US").send_push_notification_async({"default": "Hi {{ name }}"}, context={"name": "Tom & O'Brien <3"})
+        self.assertEqual(self.get_sent_messages(), {"arn_0": "Hi Tom & O'Brien <3"})
+
+    def test_missing_locale_fails_before_sending(self):
+        from . import tasks
+        from .models import Campaign
+
+        with patch.object(tasks.send_campaign_batch, "apply_async") as apply_async:
+            with self.assertRaises(KeyError) as context:
+                Device.objects.all().send_push_notification_async({"en": "Hello", "tr": "Merhaba"}, batch_size=1)
+
+        self.assertIn("de_DE", str(context.exception))
+        self.assertFalse(apply_async.called)
+        self.assertFalse(Campaign.objects.exists())
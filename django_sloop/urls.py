@@ -1,8 +1,10 @@
 from django.urls import path
-from .views import CreateDeleteDeviceView
+from .views import AsyncCreateDeleteDeviceView, BulkCreateDeviceView, CreateDeleteDeviceView
 
 app_name = 'django_sloop'
 
 urlpatterns = (
     path('', CreateDeleteDeviceView.as_view(), name="create-delete-device"),
+    path('bulk/', BulkCreateDeviceView.as_view(), name="bulk-create-device"),
+    path('async/', AsyncCreateDeleteDeviceView.as_view(), name="async-create-delete-device"),
 )
@@ -1,7 +1,153 @@
+import datetime
+import threading
+import time
+import zoneinfo
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+
 from django.apps import apps
+from django.conf import settings
+from django.db import models
+from django.template import Context, Template
+from django.utils import timezone
 
 from .settings import DJANGO_SLOOP_SETTINGS
 
 
 def get_device_model():
     return apps.get_model(*DJANGO_SLOOP_SETTINGS["DEVICE_MODEL"].split("."))
+
+
+def iter_pk_ranges(queryset, batch_size, start_pk=None):
+    """
+    Yields (lower, upper) primary key ranges covering the queryset, upper bound excluded.
+    Filtering by these ranges keeps every batch on the primary key index.
+    """
+    if start_pk is not None:
+        queryset = queryset.filter(pk__gte=start_pk)
+
+    bounds = queryset.aggregate(min_pk=models.Min("pk"), max_pk=models.Max("pk"))
+    if bounds["min_pk"] is None:
+        return
+
+    lower = bounds["min_pk"]
+    while lower <= bounds["max_pk"]:
+        upper = lower + batch_size
+        yield lower, upper
+        lower = upper
+
+
+class RateLimiter(object):
+    """
+    Lets at most `rate` calls per second through wait(), shared between threads.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+def run_concurrently(func, items, concurrency, rate=None):
+    """
+    Calls func(item) for every item from a thread pool, at most `rate` calls per second.
+    Returns (item, result, exception) tuples in the order of the items.
+    """
+    rate_limiter = RateLimiter(rate)
+
+    def call(item):
+        rate_limiter.wait()
+        try:
+            return item, func(item), None
+        except Exception as exc:
+            return item, None, exc
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(call, items))
+
+
+def get_locale_timezone(locale):
+    """
+    Returns the name of the timezone mapped to the locale in LOCALE_TIMEZONES, or TIME_ZONE.
+    """
+    return DJANGO_SLOOP_SETTINGS["LOCALE_TIMEZONES"].get(locale) or settings.TIME_ZONE
+
+
+def get_delivery_time(deliver_at, timezone_name):
+    """
+    Returns deliver_at if it is a datetime, or the next occurrence of the datetime.time deliver_at in the timezone.
+    """
+    if not isinstance(deliver_at, datetime.time):
+        return deliver_at
+
+    tz = zoneinfo.ZoneInfo(timezone_name)
+    local_now = timezone.now().astimezone(tz)
+    delivery_time = datetime.datetime.combine(local_now.date(), deliver_at, tzinfo=tz)
+    if delivery_time <= local_now:
+        delivery_time = datetime.datetime.combine(local_now.date() + datetime.timedelta(days=1), deliver_at, tzinfo=tz)
+    return delivery_time
+
+
+def chunked(iterable, size):
+    """
+    Yields lists of at most `size` items from the iterable.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+@lru_cache(maxsize=256)
+def get_compiled_template(source):
+    return Template(source)
+
+
+def render_localized_message(messages, locale, context=None):
+    """
+    Renders the template of the locale from a dict of Django template sources keyed by locale ("tr_TR"),
+    language ("tr") or "default". Templates are compiled once per process. Plain strings are returned as they are.
+
+    Raises KeyError if there is no template for the locale.
+    """
+    if not isinstance(messages, dict):
+        return messages
+
+    language = (locale or "").split("_")[0]
+    for key in (locale, language, "default"):
+        if key in messages:
+            # Push notifications are plain text, so the context is not HTML escaped.
+            return get_compiled_template(messages[key]).render(Context(context or {}, autoescape=False))
+
+    raise KeyError("No message for locale %s" % locale)
+
+
+def render_localized_messages(messages, locales, context=None):
+    """
+    Renders the message of every locale, keyed by locale. Raises a single KeyError that lists all the locales
+    without a template, so a send can fail before anything is enqueued.
+    """
+    rendered, missing_locales = {}, []
+    for locale in locales:
+        try:
+            rendered[locale or ""] = render_localized_message(messages, locale, context)
+        except KeyError:
+            missing_locales.append(locale or "")
+    if missing_locales:
+        raise KeyError("No message for locales: %s" % ", ".join(sorted(repr(locale) for locale in missing_locales)))
+    return rendered
@@ -1,9 +1,13 @@
+from asgiref.sync import sync_to_async
+from django.http import Http404
+from rest_framework import status
 from rest_framework.generics import CreateAPIView, get_object_or_404
 from rest_framework.mixins import DestroyModelMixin
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.response import Response
 
 from .utils import get_device_model
-from .serializers import DeviceSerializer
+from .serializers import BulkDeviceSerializer, DeviceSerializer
 
 
 class CreateDeleteDeviceView(CreateAPIView, DestroyModelMixin):
@@ -25,3 +29,69 @@ class CreateDeleteDeviceView(CreateAPIView, DestroyModelMixin):
         """
         device_model = get_device_model()
         return get_object_or_404(device_model._default_manager, push_token=self.request.data.get('push_token'), user=self.request.user)
+
+
+class AsyncCreateDeleteDeviceView(CreateDeleteDeviceView):
+    """
+    CreateDeleteDeviceView for ASGI deployments, which runs on the event loop.
+
+    Authentication, permissions and throttling run in one sync_to_async() call, since DRF only supports them
+    synchronously. Deletes use the async ORM. Registrations run in a transaction, which the async ORM does not
+    support, so the serializer saves in a single sync_to_async() call.
+    """
+
+    view_is_async = True
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+            method = request.method.lower()
+            if method == "post":
+                response = await self.acreate(request, *args, **kwargs)
+            elif method == "delete":
+                response = await self.adestroy(request, *args, **kwargs)
+            elif method == "options":
+                response = self.options(request, *args, **kwargs)
+            else:
+                response = self.http_method_not_allowed(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+    async def acreate(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        await sync_to_async(self.perform_create)(serializer)
+        headers = self.get_success_headers(serializer.data)
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+
+    async def adestroy(self, request, *args, **kwargs):
+        device_model = get_device_model()
+        try:
+            instance = await device_model._default_manager.aget(push_token=request.data.get('push_token'), user=request.user)
+        except device_model.DoesNotExist:
+            raise Http404
+        await instance.ainvalidate()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class BulkCreateDeviceView(CreateAPIView):
+    """
+    An endpoint for registering devices of many users at once.
+    """
+    serializer_class = BulkDeviceSerializer
+    permission_classes = (IsAdminUser,)
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        self.perform_create(serializer)
+        return Response({"count": len(serializer.validated_data)}, status=status.HTTP_201_CREATED)
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-19 10:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='device',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['user', 'date_created'], name='devices_device_active'),
+        ),
+    ]
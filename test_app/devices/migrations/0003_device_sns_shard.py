@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 11:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0002_device_active_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='sns_shard',
+            field=models.CharField(blank=True, default='', max_length=64, verbose_name='SNS Shard'),
+        ),
+    ]
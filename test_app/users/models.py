@@ -5,4 +5,11 @@ from django_sloop.models import PushNotificationMixin
 User.add_to_class("send_push_notification_async", PushNotificationMixin.send_push_notification_async)
 User.add_to_class("get_active_pushable_device", PushNotificationMixin.get_active_pushable_device)
 User.add_to_class("send_silent_push_notification_async", PushNotificationMixin.send_silent_push_notification_async)
+User.add_to_class("aget_active_pushable_device", PushNotificationMixin.aget_active_pushable_device)
+User.add_to_class("_get_active_devices", PushNotificationMixin._get_active_devices)
+User.add_to_class("asend_push_notification", PushNotificationMixin.asend_push_notification)
+User.add_to_class("asend_silent_push_notification", PushNotificationMixin.asend_silent_push_notification)
+User.add_to_class("_send_push_notification", PushNotificationMixin._send_push_notification)
+User.add_to_class("_send_silent_push_notification", PushNotificationMixin._send_silent_push_notification)
+User.add_to_class("get_push_timezone", PushNotificationMixin.get_push_timezone)
 User.add_to_class("get_badge_count", lambda x: 0)